@@ -0,0 +1,152 @@
+import os, logging, asyncio, math, time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+# requests forwarded to the CPU-bound VLM service at the same time
+VLM_MAX_CONCURRENCY = int(os.getenv("VLM_MAX_CONCURRENCY", "2"))
+# requests allowed to wait for a free slot before new ones are rejected
+VLM_MAX_QUEUE = int(os.getenv("VLM_MAX_QUEUE", "8"))
+VLM_QUEUE_TIMEOUT = float(os.getenv("VLM_QUEUE_TIMEOUT", "120"))
+# service time assumed for Retry-After until the first request has finished
+VLM_SERVICE_TIME_INITIAL = float(os.getenv("VLM_SERVICE_TIME_INITIAL", "10"))
+# weight of the newest sample in the moving averages of service and wait time
+EWMA_ALPHA = 0.2
+
+logger = logging.getLogger("mylogger")
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be admitted to the VLM service.
+
+    Attributes:
+        retry_after: Seconds after which the client should retry.
+    """
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionController():
+    """
+    Concurrency limit with a bounded wait queue in front of the VLM service.
+
+    At most `max_concurrency` requests hold a slot at the same time. Further
+    requests wait in FIFO order, up to `max_queue` of them; beyond that requests
+    are rejected right away with a Retry-After estimate derived from the observed
+    service time, instead of all piling onto the CPU and timing out together.
+    """
+    def __init__(self, max_concurrency: int = VLM_MAX_CONCURRENCY, max_queue: int = VLM_MAX_QUEUE):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.service_time = VLM_SERVICE_TIME_INITIAL
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @asynccontextmanager
+    async def slot(self, bounded: bool = True) -> AsyncIterator[None]:
+        """
+        Hold a VLM slot for the duration of the block.
+
+        Args:
+            bounded: Apply the queue limit and queue timeout. Callers that are
+                already bounded themselves (e.g. the job workers) pass False
+                and simply wait for their turn.
+
+        Raises:
+            Overloaded: If the wait queue is full or the wait timed out.
+        """
+        await self._acquire(bounded)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.service_time += EWMA_ALPHA * (time.monotonic() - start - self.service_time)
+            self._release()
+
+    def retry_after(self) -> int:
+        """
+        Estimate when a new request could be admitted.
+
+        Returns:
+            int: Seconds until the current queue has drained at the observed service time.
+        """
+        rounds = math.ceil((len(self.waiters) + 1) / self.max_concurrency)
+        return max(1, math.ceil(rounds * self.service_time))
+
+    def stats(self) -> dict:
+        """
+        Admission counters, queue depth and timings.
+
+        Returns:
+            dict: Limits, in-flight and queued requests, moving averages of wait and
+                service time and admitted/rejected/timed-out counters.
+        """
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.active,
+            "queue_depth": len(self.waiters),
+            "wait_time_avg": round(self.wait_time, 3),
+            "wait_time_max": round(self.max_wait_time, 3),
+            "service_time_avg": round(self.service_time, 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+    async def _acquire(self, bounded: bool):
+        """
+        Take a free slot or wait in the queue for one to be handed over.
+        """
+        start = time.monotonic()
+        if self.active < self.max_concurrency and not self.waiters:
+            self.active += 1
+            self._admit(start)
+            return
+        if bounded and len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded("VLM service is busy, too many queued requests", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=VLM_QUEUE_TIMEOUT if bounded else None)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as we gave up, pass it on
+                self._release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise Overloaded("Timed out waiting for the VLM service", self.retry_after())
+            raise
+        self._admit(start)
+
+    def _admit(self, start: float):
+        """
+        Record the wait time of an admitted request.
+        """
+        waited = time.monotonic() - start
+        self.wait_time += EWMA_ALPHA * (waited - self.wait_time)
+        self.max_wait_time = max(self.max_wait_time, waited)
+        self.admitted += 1
+
+    def _release(self):
+        """
+        Hand the slot to the next waiter, or free it if nobody is waiting.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
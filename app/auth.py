@@ -78,14 +78,11 @@ def create_access_token(subject: str, expires_delta: timedelta) -> str:
     payload = {"sub": subject, "iat": now, "exp": now + expires_delta}
     return jwt.encode(payload, os.getenv("SECRET_KEY"), algorithm=os.getenv("ALGORITHM"))
 
-def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
-    """Resolve the current authenticated user from a bearer token.
-
-    This function decodes the JWT access token, extracts the subject claim, and
-    returns a corresponding User instance.
+def decode_access_token(token: str) -> User:
+    """Resolve the user a JWT access token was issued to.
 
     Args:
-        token: Bearer token extracted from the Authorization header.
+        token: Encoded access token.
 
     Returns:
         A User object representing the authenticated principal.
@@ -105,4 +102,21 @@ def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
             raise cred_exc
     except JWTError:
         raise cred_exc
-    return User(username=username)
\ No newline at end of file
+    return User(username=username)
+
+def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+    """Resolve the current authenticated user from a bearer token.
+
+    This function decodes the JWT access token, extracts the subject claim, and
+    returns a corresponding User instance.
+
+    Args:
+        token: Bearer token extracted from the Authorization header.
+
+    Returns:
+        A User object representing the authenticated principal.
+
+    Raises:
+        HTTPException: If the token is invalid, expired, or missing required claims.
+    """
+    return decode_access_token(token)
\ No newline at end of file
@@ -0,0 +1,180 @@
+import os, logging, hashlib, json, time, asyncio, uuid
+from collections import OrderedDict
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# optional second tier on disk, e.g. "/data/answer_cache"; empty disables it
+ANSWER_CACHE_DIR = os.getenv("ANSWER_CACHE_DIR", "")
+
+logger = logging.getLogger("mylogger")
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a query so that trivially different phrasings share a cache entry.
+
+    Args:
+        query: Natural-language question as sent by the client.
+
+    Returns:
+        str: Lower-cased query with collapsed whitespace and without trailing punctuation.
+    """
+    return " ".join(query.lower().split()).rstrip("?.! ")
+
+def make_cache_key(img_bytes: bytes, query: str, max_new_tokens: int | None, model: str, answer_type: str = "free", answer_options: list[str] | None = None) -> str:
+    """
+    Build the content address of an answer.
+
+    Args:
+        img_bytes: Raw bytes of the chart image.
+        query: Natural-language question about the chart.
+        max_new_tokens: Maximum number of tokens generated for the answer, None for the default budget of the VLM service.
+        model: Identity of the model that answers, as reported by the VLM service.
+        answer_type: "free", "binary" or "options"; fixed answers are cached apart from free ones.
+        answer_options: Allowed answers for answer_type "options".
+
+    Returns:
+        str: Hex SHA-256 digest over the image hash, normalized query, token budget,
+            model and, for fixed answers, the allowed answers.
+    """
+    image_hash = hashlib.sha256(img_bytes).hexdigest()
+    fields = [image_hash, normalize_query(query), max_new_tokens, model]
+    if answer_type != "free":
+        # free answers keep the keys they had before answer types existed
+        fields += [answer_type, answer_options or []]
+    key = json.dumps(fields)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class AnswerCache():
+    """
+    Content-addressed cache of VLM answers.
+
+    Answers are kept in an in-memory LRU tier bounded by entry count and TTL. If a
+    cache directory is configured, answers are also written to disk as one JSON file
+    per key, so they survive a gateway restart and are promoted back into memory on
+    their next hit.
+    """
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL, cache_dir: str = ANSWER_CACHE_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def open(self):
+        """
+        Create the disk tier directory and drop expired answers from it.
+        """
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        for file in self.cache_dir.glob("*.json"):
+            if now - file.stat().st_mtime > self.ttl:
+                file.unlink(missing_ok=True)
+        logger.info(f"Answer cache disk tier at {self.cache_dir}")
+
+    async def get(self, key: str) -> str | None:
+        """
+        Look up an answer, first in memory and then on disk.
+
+        Args:
+            key: Cache key from `make_cache_key`.
+
+        Returns:
+            str | None: The cached answer, or None on a miss or an expired entry.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            created, text = entry
+            if time.time() - created <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return text
+            del self.entries[key]
+
+        if self.cache_dir is not None:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                self._remember(key, *entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[1]
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, text: str):
+        """
+        Store an answer in memory and, if enabled, on disk.
+
+        Args:
+            key: Cache key from `make_cache_key`.
+            text: Answer of the VLM service.
+        """
+        created = time.time()
+        self._remember(key, created, text)
+        if self.cache_dir is not None:
+            await asyncio.to_thread(self._write_disk, key, created, text)
+
+    def stats(self) -> dict:
+        """
+        Counters of the cache, used to judge its size and TTL.
+
+        Returns:
+            dict: Size, limits and hit/miss/eviction counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk": str(self.cache_dir) if self.cache_dir is not None else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _remember(self, key: str, created: float, text: str):
+        """
+        Insert into the memory tier and evict the least recently used entries.
+        """
+        self.entries[key] = (created, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _read_disk(self, key: str) -> tuple[float, str] | None:
+        """
+        Read an answer file of the disk tier, removing it if it has expired.
+        """
+        file = self.cache_dir / f"{key}.json"
+        try:
+            entry = json.loads(file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            file.unlink(missing_ok=True)
+            return None
+        return entry["created"], entry["text"]
+
+    def _write_disk(self, key: str, created: float, text: str):
+        """
+        Write an answer file of the disk tier atomically.
+        """
+        file = self.cache_dir / f"{key}.json"
+        tmp = file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        try:
+            tmp.write_text(json.dumps({"created": created, "text": text}), encoding="utf-8")
+            tmp.replace(file)
+        except OSError as e:
+            logger.warning(f"Could not write answer cache entry {key}: {e}")
@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from datetime import datetime
 
 class Token(BaseModel):
     """
@@ -19,3 +20,22 @@ class User(BaseModel):
         username: Unique username identifying the user.
     """
     username: str
+
+class JobStatus(BaseModel):
+    """
+    Status of an asynchronous VLM query job.
+
+    Attributes:
+        job_id: Id of the job, used to poll for its result.
+        status: One of "queued", "running", "done" or "failed".
+        text: Answer of the VLM service once the job is done.
+        error: Error detail if the job failed.
+        created_at: Time the job was submitted (UTC).
+        finished_at: Time the job finished (UTC).
+    """
+    job_id: str
+    status: str
+    text: str | None = None
+    error: str | None = None
+    created_at: datetime
+    finished_at: datetime | None = None
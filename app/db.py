@@ -1,5 +1,6 @@
-from sqlmodel import SQLModel, create_engine, Field, Session, select
+from sqlmodel import SQLModel, create_engine, Field, Session, select, col, delete, func, Column, JSON
 import os
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv(".env")
@@ -18,6 +19,37 @@ class AdminUser(SQLModel, table=True):
     username: str = Field(index=True)
     hashed_password: str 
 
+class VLMJob(SQLModel, table=True):
+    """SQLModel table definition for an asynchronous VLM query job.
+
+    Attributes:
+        id: Primary key, a random job id handed out to the client.
+        status: One of "queued", "running", "done" or "failed" (indexed).
+        query: Natural-language question about the chart.
+        extension: Image file extension hint (e.g., "png", "jpg").
+        max_new_tokens: Maximum number of tokens to generate at the VLM service, None for
+            the budget of the answer type.
+        answer_type: "free", "short", "binary" or "options", see `/vlm/query`.
+        answer_options: Allowed answers for answer_type "options".
+        image: Raw chart image bytes, dropped once the job has finished.
+        result: Answer of the VLM service for a finished job.
+        error: Error detail for a failed job.
+        created_at: Time the job was submitted (UTC).
+        finished_at: Time the job finished (UTC), used for the retention window.
+    """
+    id: str = Field(primary_key=True)
+    status: str = Field(default="queued", index=True)
+    query: str
+    extension: str = "png"
+    max_new_tokens: int | None = None
+    answer_type: str = "free"
+    answer_options: list[str] | None = Field(default=None, sa_column=Column(JSON))
+    image: bytes | None = None
+    result: str | None = None
+    error: str | None = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_at: datetime | None = Field(default=None, index=True)
+
 connect_args = {"check_same_thread": False}
 engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
 
@@ -65,3 +97,96 @@ def create_admin_if_not_exists(admin_user: AdminUser):
 
         session.add(admin_user)
         session.commit()
+
+def create_job(job: VLMJob) -> VLMJob:
+    """Insert a new job record.
+
+    Args:
+        job: The VLMJob instance to persist.
+
+    Returns:
+        The persisted VLMJob, refreshed from the database.
+    """
+    with Session(engine) as session:
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job
+
+def get_job(job_id: str) -> VLMJob | None:
+    """Fetch a job by id.
+
+    Args:
+        job_id: Id of the job.
+
+    Returns:
+        The matching VLMJob if found; otherwise None.
+    """
+    with Session(engine) as session:
+        return session.get(VLMJob, job_id)
+
+def count_pending_jobs() -> int:
+    """Count jobs that are queued or running.
+
+    Returns:
+        The number of unfinished jobs.
+    """
+    with Session(engine) as session:
+        statement = select(func.count()).select_from(VLMJob).where(col(VLMJob.status).in_(["queued", "running"]))
+        return session.exec(statement).one()
+
+def requeue_unfinished_jobs() -> list[str]:
+    """Reset jobs interrupted by a restart and list all queued jobs.
+
+    Jobs left in "running" state were interrupted by a gateway restart and are
+    queued again.
+
+    Returns:
+        Ids of all queued jobs, oldest first.
+    """
+    with Session(engine) as session:
+        for job in session.exec(select(VLMJob).where(VLMJob.status == "running")).all():
+            job.status = "queued"
+            session.add(job)
+        session.commit()
+        statement = select(VLMJob.id).where(VLMJob.status == "queued").order_by(VLMJob.created_at)
+        return list(session.exec(statement).all())
+
+def update_job_status(job_id: str, status: str, result: str | None = None, error: str | None = None):
+    """Update the status of a job and store its outcome once finished.
+
+    Finishing a job ("done" or "failed") records the finish time and drops the
+    stored image.
+
+    Args:
+        job_id: Id of the job.
+        status: New status of the job.
+        result: Answer of the VLM service, if done.
+        error: Error detail, if failed.
+    """
+    with Session(engine) as session:
+        job = session.get(VLMJob, job_id)
+        if job is None:
+            return
+        job.status = status
+        if status in ("done", "failed"):
+            job.result = result
+            job.error = error
+            job.image = None
+            job.finished_at = datetime.now(timezone.utc)
+        session.add(job)
+        session.commit()
+
+def delete_jobs_finished_before(cutoff: datetime) -> int:
+    """Delete finished jobs whose retention window has passed.
+
+    Args:
+        cutoff: Jobs finished before this time (UTC) are deleted.
+
+    Returns:
+        The number of deleted jobs.
+    """
+    with Session(engine) as session:
+        result = session.exec(delete(VLMJob).where(col(VLMJob.finished_at) < cutoff))
+        session.commit()
+        return result.rowcount
@@ -0,0 +1,135 @@
+import os, logging, asyncio, time
+from io import BytesIO
+from PIL import Image, ImageOps, ExifTags, UnidentifiedImageError
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+IMAGE_NORMALIZE = os.getenv("IMAGE_NORMALIZE", "true").lower() == "true"
+# InternVL cuts images into 448 px tiles, at most 12 of them (a 4x3 grid), so
+# anything beyond 4 tiles on the long side is thrown away by the processor anyway
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1792"))
+# format of re-encoded images: "webp", "jpeg" or "png"
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+
+logger = logging.getLogger("mylogger")
+
+class InvalidImage(Exception):
+    """
+    Raised when an uploaded chart image cannot be decoded.
+    """
+
+class ImageNormalizer():
+    """
+    Pipeline stage preparing uploaded chart images before they are forwarded.
+
+    Each image is decoded once, rotated upright according to its EXIF orientation,
+    flattened onto white if it is transparent and downscaled to at most
+    `IMAGE_MAX_SIDE` pixels on its long side, then re-encoded as `IMAGE_FORMAT`.
+    Images that need none of it are forwarded unchanged. The work runs in a
+    worker thread so the event loop is not blocked.
+    """
+    def __init__(self, enabled: bool = IMAGE_NORMALIZE, max_side: int = IMAGE_MAX_SIDE, image_format: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY):
+        self.enabled = enabled
+        self.max_side = max_side
+        self.image_format = image_format
+        self.quality = quality
+        self.images = 0
+        self.rewritten = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pixels_in = 0
+        self.pixels_out = 0
+        self.seconds = 0.0
+
+    async def normalize(self, img_bytes: bytes, extension: str) -> tuple[bytes, str]:
+        """
+        Normalize an uploaded image.
+
+        Args:
+            img_bytes: Raw bytes of the uploaded chart image.
+            extension: Image file extension hint (e.g., "png", "jpg").
+
+        Returns:
+            tuple[bytes, str]: Bytes and extension of the image to forward.
+
+        Raises:
+            InvalidImage: If the image cannot be decoded.
+        """
+        if not self.enabled:
+            return img_bytes, extension
+        start = time.perf_counter()
+        out_bytes, out_extension, size_in, size_out = await asyncio.to_thread(self._normalize, img_bytes, extension)
+        elapsed = time.perf_counter() - start
+
+        self.images += 1
+        self.bytes_in += len(img_bytes)
+        self.bytes_out += len(out_bytes)
+        self.pixels_in += size_in[0] * size_in[1]
+        self.pixels_out += size_out[0] * size_out[1]
+        self.seconds += elapsed
+        if out_bytes is not img_bytes:
+            self.rewritten += 1
+            logger.info(
+                f"Normalized chart image {size_in[0]}x{size_in[1]} ({len(img_bytes)} B) to "
+                f"{size_out[0]}x{size_out[1]} {out_extension} ({len(out_bytes)} B) in {elapsed * 1000:.0f} ms"
+            )
+        return out_bytes, out_extension
+
+    def stats(self) -> dict:
+        """
+        Counters of the normalization stage.
+
+        Returns:
+            dict: Settings, processed and rewritten images, bytes and pixels before
+                and after normalization and the average processing time.
+        """
+        return {
+            "enabled": self.enabled,
+            "max_side": self.max_side,
+            "format": self.image_format,
+            "images": self.images,
+            "rewritten": self.rewritten,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "pixels_in": self.pixels_in,
+            "pixels_out": self.pixels_out,
+            "pixels_saved": self.pixels_in - self.pixels_out,
+            "time_avg": round(self.seconds / self.images, 4) if self.images else 0.0,
+        }
+
+    def _normalize(self, img_bytes: bytes, extension: str) -> tuple[bytes, str, tuple[int, int], tuple[int, int]]:
+        """
+        Decode, orient, flatten, downscale and re-encode an image; runs in a worker thread.
+        """
+        try:
+            with Image.open(BytesIO(img_bytes)) as img:
+                size_in = img.size
+                orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+                scale = self.max_side / max(size_in)
+                transparent = "A" in img.getbands() or "transparency" in img.info
+                if scale >= 1 and orientation == 1 and not transparent:
+                    return img_bytes, extension, size_in, size_in
+
+                if scale < 1:
+                    # let the JPEG decoder skip detail that is scaled away anyway
+                    img.draft("RGB", (int(size_in[0] * scale), int(size_in[1] * scale)))
+                img = ImageOps.exif_transpose(img)
+                if transparent:
+                    # transparent chart backgrounds would turn black in RGB, put them on white
+                    img = Image.alpha_composite(Image.new("RGBA", img.size, "white"), img.convert("RGBA"))
+                img = img.convert("RGB")
+                img.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+        except UnidentifiedImageError:
+            raise InvalidImage("Invalid image: unknown image format")
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise InvalidImage(f"Invalid image: {e}")
+
+        out = BytesIO()
+        if self.image_format == "png":
+            img.save(out, format="PNG", optimize=True)
+        else:
+            img.save(out, format=self.image_format.upper(), quality=self.quality)
+        return out.getvalue(), self.image_format, size_in, img.size
@@ -0,0 +1,176 @@
+import os, logging, uuid, asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+from dotenv import load_dotenv
+from db import VLMJob, create_job, get_job, count_pending_jobs, requeue_unfinished_jobs, update_job_status, delete_jobs_finished_before
+
+load_dotenv(".env")
+
+JOBS_MAX_PENDING = int(os.getenv("JOBS_MAX_PENDING", "100"))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+JOBS_RETENTION_SECONDS = float(os.getenv("JOBS_RETENTION_SECONDS", "3600"))
+# upper bound for a single long-poll on GET /vlm/jobs/{id}
+JOBS_MAX_WAIT = float(os.getenv("JOBS_MAX_WAIT", "60"))
+
+logger = logging.getLogger("mylogger")
+
+JobRunner = Callable[[bytes, str, str, int | None, str, list[str] | None], Awaitable[str]]
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job is submitted while the bounded job queue is full.
+    """
+
+class JobQueue():
+    """
+    Bounded queue of asynchronous VLM query jobs persisted in the SQLite database.
+
+    Jobs are written to the database on submit, so queued jobs survive a gateway
+    restart. A fixed number of worker tasks take job ids from an in-memory queue,
+    run them and store the answer. Finished jobs are kept for the retention window
+    and deleted afterwards.
+    """
+    def __init__(self):
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        self.finished: dict[str, asyncio.Event] = {}
+        self.tasks: list[asyncio.Task] = []
+        self.runner: JobRunner | None = None
+        self.completed = 0
+        self.failed = 0
+
+    async def open(self, runner: JobRunner):
+        """
+        Requeue jobs left over from a previous run and start the workers.
+
+        Args:
+            runner: Coroutine function answering a job from image bytes,
+                extension, query, max_new_tokens, answer_type and answer_options.
+        """
+        self.runner = runner
+        for job_id in await asyncio.to_thread(requeue_unfinished_jobs):
+            self.queue.put_nowait(job_id)
+        if not self.queue.empty():
+            logger.info(f"Resuming {self.queue.qsize()} queued VLM jobs")
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(JOBS_WORKERS)]
+        self.tasks.append(asyncio.create_task(self._purge()))
+
+    async def aclose(self):
+        """
+        Stop the workers. Interrupted jobs are resumed on the next start.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, img_bytes: bytes, extension: str, query: str, max_new_tokens: int | None, answer_type: str = "free", answer_options: list[str] | None = None) -> VLMJob:
+        """
+        Persist a new job and queue it.
+
+        Args:
+            img_bytes: Raw bytes of the chart image.
+            extension: Image file extension hint (e.g., "png", "jpg").
+            query: Natural-language prompt/question to ask the model about the chart.
+            max_new_tokens: Maximum number of tokens to generate at the VLM service, None for
+                the budget of the answer type.
+            answer_type: "free", "short", "binary" or "options", see `/vlm/query`.
+            answer_options: Allowed answers for answer_type "options".
+
+        Returns:
+            VLMJob: The queued job.
+
+        Raises:
+            JobQueueFull: If `JOBS_MAX_PENDING` jobs are already queued or running.
+        """
+        if await asyncio.to_thread(count_pending_jobs) >= JOBS_MAX_PENDING:
+            raise JobQueueFull(f"Too many pending jobs (limit {JOBS_MAX_PENDING})")
+        job = VLMJob(
+            id=uuid.uuid4().hex,
+            query=query,
+            extension=extension,
+            max_new_tokens=max_new_tokens,
+            answer_type=answer_type,
+            answer_options=answer_options,
+            image=img_bytes,
+        )
+        job = await asyncio.to_thread(create_job, job)
+        self.queue.put_nowait(job.id)
+        return job
+
+    async def wait(self, job_id: str, timeout: float) -> VLMJob | None:
+        """
+        Fetch a job, waiting up to `timeout` seconds for it to finish.
+
+        Args:
+            job_id: Id of the job.
+            timeout: Seconds to wait for an unfinished job, capped at `JOBS_MAX_WAIT`.
+
+        Returns:
+            VLMJob | None: The job in its current state, or None if it does not exist.
+        """
+        if timeout <= 0:
+            return await asyncio.to_thread(get_job, job_id)
+        # registered before the status is read, so a job finishing in between still wakes this waiter
+        event = self.finished.setdefault(job_id, asyncio.Event())
+        job = await asyncio.to_thread(get_job, job_id)
+        if job is None or job.status in ("done", "failed"):
+            # no worker sets the event anymore, release the waiters registered with it
+            self.finished.pop(job_id, None)
+            event.set()
+            return job
+        try:
+            await asyncio.wait_for(event.wait(), timeout=min(timeout, JOBS_MAX_WAIT))
+        except asyncio.TimeoutError:
+            pass
+        return await asyncio.to_thread(get_job, job_id)
+
+    def stats(self) -> dict:
+        """
+        Job queue counters.
+
+        Returns:
+            dict: Queue length, limits and completed/failed counters.
+        """
+        return {
+            "queued": self.queue.qsize(),
+            "max_pending": JOBS_MAX_PENDING,
+            "workers": JOBS_WORKERS,
+            "retention_seconds": JOBS_RETENTION_SECONDS,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    async def _work(self):
+        """
+        Worker loop running queued jobs one at a time.
+        """
+        while True:
+            job_id = await self.queue.get()
+            job = await asyncio.to_thread(get_job, job_id)
+            if job is None or job.status != "queued" or job.image is None:
+                continue
+            await asyncio.to_thread(update_job_status, job_id, "running")
+            try:
+                text = await self.runner(job.image, job.extension, job.query, job.max_new_tokens, job.answer_type, job.answer_options)
+                await asyncio.to_thread(update_job_status, job_id, "done", result=text)
+                self.completed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"VLM job {job_id} failed: {e}")
+                await asyncio.to_thread(update_job_status, job_id, "failed", error=str(getattr(e, "detail", e)))
+                self.failed += 1
+            event = self.finished.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    async def _purge(self):
+        """
+        Periodically delete finished jobs older than the retention window.
+        """
+        while True:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=JOBS_RETENTION_SECONDS)
+            deleted = await asyncio.to_thread(delete_jobs_finished_before, cutoff)
+            if deleted:
+                logger.info(f"Deleted {deleted} expired VLM jobs")
+            await asyncio.sleep(min(JOBS_RETENTION_SECONDS, 60))
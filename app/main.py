@@ -1,19 +1,39 @@
-from db import create_db_and_tables, AdminUser, create_admin_if_not_exists
-from auth import create_access_token, authenticate_user, get_current_user, get_password_hash
+from db import create_db_and_tables, AdminUser, VLMJob, create_admin_if_not_exists
+from auth import create_access_token, authenticate_user, get_current_user, get_password_hash, decode_access_token
 from pwdlib import PasswordHash
-from fastapi import FastAPI, UploadFile, File, Form,  Depends,HTTPException, status
+from fastapi import FastAPI, UploadFile, File, Form,  Depends,HTTPException, status, Header, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import  OAuth2PasswordRequestForm
-import os, logging, uuid, httpx, base64
+import os, logging, uuid, json, asyncio
 from dotenv import load_dotenv
 import uvicorn
-from contextlib import asynccontextmanager
-from config import Token, User
+from contextlib import asynccontextmanager, aclosing
+from config import Token, User, JobStatus
+from upstream import VLMClient, VLMResponseError
+from cache import AnswerCache, make_cache_key
+from singleflight import SingleFlight
+from jobs import JobQueue, JobQueueFull
+from admission import AdmissionController, Overloaded
+from sessions import SessionStore, WSSession, WS_HEARTBEAT_INTERVAL, WS_AUTH_TIMEOUT
+from images import ImageNormalizer, InvalidImage
 from datetime import timedelta
-from typing import Annotated
+from typing import Annotated, AsyncIterator, Awaitable, Literal, TypeVar
 
 load_dotenv(".env")
-VLM_URL = os.getenv("VLM_URL", "http://vlm:5001/vlm/generate")
+
+# seconds between checks whether the client of a pending query disconnected
+CLIENT_DISCONNECT_POLL = float(os.getenv("CLIENT_DISCONNECT_POLL", "0.5"))
+
+T = TypeVar("T")
+
+vlm_client = VLMClient()
+answer_cache = AnswerCache()
+in_flight_queries = SingleFlight()
+job_queue = JobQueue()
+admission = AdmissionController()
+ws_sessions = SessionStore()
+image_normalizer = ImageNormalizer()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -21,7 +41,9 @@ async def lifespan(app: FastAPI):
     Application lifespan handler for startup/shutdown behavior.
 
     This context manager runs at application startup to initialize the database
-    schema and ensure an admin user exists before serving requests.
+    schema, ensure an admin user exists, open the pooled VLM client and the
+    answer cache and start the job workers before serving requests. The job
+    workers and the VLM client are stopped on shutdown.
 
     Args:
         app: The FastAPI application instance.
@@ -33,7 +55,12 @@ async def lifespan(app: FastAPI):
     pw = os.getenv("PW")
     admin_user = AdminUser(id=1, username="vqa-user", hashed_password=get_password_hash(pw))
     create_admin_if_not_exists(admin_user)
+    vlm_client.open()
+    answer_cache.open()
+    await job_queue.open(run_job)
     yield
+    await job_queue.aclose()
+    await vlm_client.aclose()
     
 
 app = FastAPI(lifespan=lifespan)
@@ -58,6 +85,256 @@ if (os.path.exists(tmp_chart_dir)==False):
     os.makedirs(os.path.join(os.getcwd(),"charts/"))
 
 
+async def read_chart_upload(chart_photo: UploadFile) -> tuple[bytes, str]:
+    """
+    Read an uploaded chart image, derive its file extension and normalize it.
+
+    Args:
+        chart_photo: Uploaded image file containing the chart.
+
+    Returns:
+        The normalized image bytes and their extension. Images that are not
+        rewritten keep the extension taken from the content type (e.g.
+        "image/png" -> "png"), defaulting to "png".
+
+    Raises:
+        HTTPException: If the upload is empty or not a decodable image (400).
+    """
+    img_bytes = await chart_photo.read()
+    if not img_bytes:
+        raise HTTPException(status_code=400, detail="Empty upload")
+
+    extension = "png"
+    if chart_photo.content_type and "/" in chart_photo.content_type:
+        extension = chart_photo.content_type.split("/")[-1].lower()
+    try:
+        return await image_normalizer.normalize(img_bytes, extension)
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def cache_bypass_requested(x_cache_bypass: str | None, cache_control: str | None) -> bool:
+    """
+    Check whether the client asked to skip the answer cache.
+
+    Args:
+        x_cache_bypass: Value of the `X-Cache-Bypass` header.
+        cache_control: Value of the `Cache-Control` header.
+
+    Returns:
+        True if `X-Cache-Bypass` is set to a truthy value or `Cache-Control`
+        contains "no-cache"; otherwise False.
+    """
+    if x_cache_bypass and x_cache_bypass.lower() in ("1", "true", "yes"):
+        return True
+    return bool(cache_control and "no-cache" in cache_control.lower())
+
+def parse_answer_options(answer_type: str, answer_options: list[str] | None) -> list[str] | None:
+    """
+    Validate the allowed answers of a query.
+
+    Args:
+        answer_type: "free", "short", "binary" or "options".
+        answer_options: Allowed answers as sent by the client, one form field each.
+
+    Returns:
+        The stripped, non-empty options for answer_type "options"; otherwise None.
+
+    Raises:
+        HTTPException: If answer_type is "options" but no options are given (400).
+    """
+    if answer_type != "options":
+        return None
+    answer_options = [option.strip() for option in answer_options or [] if option.strip()]
+    if not answer_options:
+        raise HTTPException(status_code=400, detail="answer_options are required for answer_type 'options'")
+    return answer_options
+
+def overloaded_error(e: Overloaded) -> HTTPException:
+    """
+    Map a rejected admission to a 503 response with a Retry-After header.
+
+    Args:
+        e: The admission rejection.
+
+    Returns:
+        An HTTPException to raise.
+    """
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+async def cancel_on_disconnect(request: Request, call: Awaitable[T]) -> T:
+    """
+    Await a call on behalf of a client and cancel it once the client disconnects.
+
+    FastAPI keeps running a handler after its client went away, so the connection
+    is checked every `CLIENT_DISCONNECT_POLL` seconds. Cancelling a VLM request
+    closes its upstream connection, which cancels the generation at the VLM service.
+
+    Args:
+        request: Incoming request of the client.
+        call: The call answering the client.
+
+    Returns:
+        The result of the call.
+
+    Raises:
+        HTTPException: If the client disconnected first (499).
+    """
+    task = asyncio.ensure_future(call)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=CLIENT_DISCONNECT_POLL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info("Client disconnected, cancelling its query")
+                raise HTTPException(status_code=499, detail="Client closed the request")
+    finally:
+        task.cancel()
+
+async def answer_query(img_bytes: bytes, extension: str, query: str, max_new_tokens: int | None, bypass_cache: bool = False, bounded: bool = True, answer_type: str = "free", answer_options: list[str] | None = None) -> tuple[str, bool]:
+    """
+    Answer a chart query from the answer cache or the VLM service.
+
+    The cache key is derived from the image bytes, the normalized query, the token
+    budget and the model identity reported by the VLM service. Answers of the VLM
+    service are stored in the cache, also when the lookup was bypassed. Identical
+    queries that arrive while one is still being generated wait for that answer
+    instead of starting another inference. Requests that do reach the VLM
+    service have to pass admission control first.
+
+    Args:
+        img_bytes: Raw bytes of the chart image.
+        extension: Image file extension hint (e.g., "png", "jpg").
+        query: Natural-language prompt/question to ask the model about the chart.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service, None for the budget the VLM service picks for the answer type.
+        bypass_cache: Skip the cache lookup and always ask the VLM service.
+        bounded: Apply the admission queue limit; False waits for a slot instead.
+        answer_type: "free" for a generated answer, "binary" or "options" for a fixed answer.
+        answer_options: Allowed answers for answer_type "options".
+
+    Returns:
+        The answer text and whether it was served from the cache.
+
+    Raises:
+        HTTPException: If the VLM service is overloaded (503), the upstream
+            request fails or the VLM service returns a non-200 response.
+    """
+    model = await vlm_client.model_identity()
+    key = make_cache_key(img_bytes, query, max_new_tokens, model or "", answer_type, answer_options)
+    if model and not bypass_cache:
+        text = await answer_cache.get(key)
+        if text is not None:
+            return text, True
+
+    async def generate() -> str:
+        response= ""
+        try:
+            async with admission.slot(bounded):
+                response = await vlm_client.generate(img_bytes, query, extension, max_new_tokens, answer_type, answer_options)
+        except Overloaded as e:
+            raise overloaded_error(e)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"VLM service request failed: {e}")
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=500, detail=f"VLM error {response.status_code}: {response.text}")
+
+        result = response.json()
+        await store_answer(img_bytes, query, max_new_tokens, result.get("model"), result["text"], answer_type, answer_options)
+        return result["text"]
+
+    return await in_flight_queries.do(key, generate), False
+
+async def store_answer(img_bytes: bytes, query: str, max_new_tokens: int | None, model: str | None, text: str, answer_type: str = "free", answer_options: list[str] | None = None):
+    """
+    Store an answer in the cache under the identity of the model that produced it.
+
+    Args:
+        img_bytes: Raw bytes of the chart image.
+        query: Natural-language question about the chart.
+        max_new_tokens: Maximum number of tokens generated for the answer, None for the default budget.
+        model: Model name reported with the answer, if any.
+        text: Answer of the VLM service.
+        answer_type: "free", "binary" or "options".
+        answer_options: Allowed answers for answer_type "options".
+    """
+    vlm_client.note_model(model)
+    if model and text:
+        await answer_cache.put(make_cache_key(img_bytes, query, max_new_tokens, model, answer_type, answer_options), text)
+
+async def stream_upstream(img_bytes: bytes, extension: str, query: str, max_new_tokens: int | None) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Stream an answer from the VLM service while holding an admission slot.
+
+    The slot is taken on the first iteration and held until the stream is
+    finished or closed. The final answer is stored in the answer cache.
+
+    Args:
+        img_bytes: Raw bytes of the chart image.
+        extension: Image file extension hint (e.g., "png", "jpg").
+        query: Natural-language prompt/question to ask the model about the chart.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service, None for its default budget.
+
+    Yields:
+        Event name ("message", "done" or "error") and its JSON data.
+
+    Raises:
+        Overloaded: If the VLM service is overloaded.
+        VLMResponseError: If the VLM service returns a non-200 response.
+        httpx.HTTPError: If the upstream request fails.
+    """
+    async with admission.slot():
+        events = vlm_client.stream(img_bytes, query, extension, max_new_tokens)
+        try:
+            async for event, data in events:
+                if event == "done":
+                    await store_answer(img_bytes, query, max_new_tokens, data.get("model"), data.get("text", ""))
+                yield event, data
+        finally:
+            await events.aclose()
+
+async def run_job(img_bytes: bytes, extension: str, query: str, max_new_tokens: int | None, answer_type: str = "free", answer_options: list[str] | None = None) -> str:
+    """
+    Answer a queued job through the same cache and coalescing path as `/vlm/query`.
+
+    Args:
+        img_bytes: Raw bytes of the chart image.
+        extension: Image file extension hint (e.g., "png", "jpg").
+        query: Natural-language prompt/question to ask the model about the chart.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service, None for the budget of the answer type.
+        answer_type: "free", "short", "binary" or "options".
+        answer_options: Allowed answers for answer_type "options".
+
+    Returns:
+        The answer text.
+    """
+    # the job queue is bounded itself, so jobs wait for a VLM slot instead of being rejected
+    text, _ = await answer_query(img_bytes, extension, query, max_new_tokens, bounded=False, answer_type=answer_type, answer_options=answer_options)
+    return text
+
+def job_status(job: VLMJob) -> JobStatus:
+    """
+    Convert a job record into its API representation.
+
+    Args:
+        job: The persisted job.
+
+    Returns:
+        A JobStatus without the stored image.
+    """
+    return JobStatus(
+        job_id=job.id,
+        status=job.status,
+        text=job.result,
+        error=job.error,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+    )
+
 @app.post("/auth/token", response_model=Token)
 def login(form: OAuth2PasswordRequestForm = Depends()):
     """
@@ -92,56 +369,389 @@ def login(form: OAuth2PasswordRequestForm = Depends()):
 @app.post("/vlm/query")
 async def query_vlm( 
     current_user: Annotated[User, Depends(get_current_user)],
+    request: Request,
+    response: Response,
     query: str = Form(...), # ellipsis "..." signals a required field
     chart_photo: UploadFile = File(...),
-    max_new_tokens: int = Form(128),
+    max_new_tokens: int | None = Form(None),
+    answer_type: Literal["free", "short", "binary", "options"] = Form("free"),
+    answer_options: list[str] | None = Form(None),
+    x_cache_bypass: Annotated[str | None, Header()] = None,
+    cache_control: Annotated[str | None, Header()] = None,
 ):
     """
     Submit a chart image and query to the VLM service and return the response.
 
     This endpoint requires authentication. It accepts a multipart/form-data
     payload containing a text query and an uploaded chart image. The image is
-    read into memory, base64-encoded, and forwarded to an upstream VLM service.
-    The generated text response is returned.
+    read into memory and forwarded to an upstream VLM service, unless the same
+    question about the same image was answered before and is still cached.
+    The generated text response is returned and the `X-Cache` response header
+    tells whether it was a cache HIT or MISS. Yes/no and multiple-choice questions
+    can set `answer_type` to have the VLM service pick one of the allowed answers
+    in a single scoring pass instead of generating one. If the client disconnects
+    before the answer is ready, the generation at the VLM service is cancelled
+    unless other clients wait for the same answer.
 
     Args:
         current_user: The authenticated user derived from the request context.
+        request: Incoming request, watched for a client disconnect.
+        response: Outgoing response, used to set the `X-Cache` header.
         query: Natural-language prompt/question to ask the model about the chart.
         chart_photo: Uploaded image file containing the chart.
-        max_new_tokens: Maximum number of tokens to generate at the VLM service.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service; if omitted, the VLM service picks the budget of the answer type.
+        answer_type: "free" for a generated description, "short" for a generated word
+            or phrase, "binary" for "Yes"/"No" or "options" for one of `answer_options`.
+        answer_options: Allowed answers for answer_type "options", one form field each.
+        x_cache_bypass: `X-Cache-Bypass` header; a truthy value skips the cache lookup.
+        cache_control: `Cache-Control` header; "no-cache" skips the cache lookup.
 
     Returns:
         The generated text response from the VLM service.
 
     Raises:
-        HTTPException: If the upload is empty, the upstream request fails, or the
-            VLM service returns a non-200 response.
+        HTTPException: If the upload is empty or answer options are missing (400), the VLM service is overloaded
+            (503, with Retry-After), the upstream request fails, or the VLM
+            service returns a non-200 response.
     """
-    # 1) Read bytes from UploadFile
-    img_bytes = await chart_photo.read()
-    if not img_bytes:
-        raise HTTPException(status_code=400, detail="Empty upload")
+    # 1) Read bytes and extension from UploadFile
+    img_bytes, extension = await read_chart_upload(chart_photo)
+    answer_options = parse_answer_options(answer_type, answer_options)
 
-    # 2) Determine extension/mimetype 
-    # chart_photo.content_type e.g. "image/png"
-    extension = "png"
-    if chart_photo.content_type and "/" in chart_photo.content_type:
-        extension = chart_photo.content_type.split("/")[-1].lower()
+    # 2) Answer from the cache or forward the raw bytes to the VLM service
+    bypass_cache = cache_bypass_requested(x_cache_bypass, cache_control)
+    text, cached = await cancel_on_disconnect(request, answer_query(img_bytes, extension, query, max_new_tokens, bypass_cache, answer_type=answer_type, answer_options=answer_options))
+    response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    return text
 
-    # 3) Base64 encode (no data: prefix, just raw base64 string)
-    image_b64 = base64.b64encode(img_bytes).decode("utf-8")
-    payload = {"query": query, "image_b64": image_b64, "extension": extension, "max_new_tokens": max_new_tokens,}
-    response= ""
+@app.post("/vlm/query/stream")
+async def query_vlm_stream(
+    current_user: Annotated[User, Depends(get_current_user)],
+    query: str = Form(...),
+    chart_photo: UploadFile = File(...),
+    max_new_tokens: int | None = Form(None),
+    x_cache_bypass: Annotated[str | None, Header()] = None,
+    cache_control: Annotated[str | None, Header()] = None,
+):
+    """
+    Submit a chart image and query to the VLM service and stream the response.
+
+    Takes the same multipart/form-data payload as `/vlm/query`. The answer is
+    relayed as server-sent events: one `data: {"text": ...}` event per sentence as
+    soon as the VLM service produced it, then a `done` event with the full answer.
+    A client can start text-to-speech at the first sentence instead of waiting
+    for the whole answer. A cached answer is sent as a single chunk.
+
+    Args:
+        current_user: The authenticated user derived from the request context.
+        query: Natural-language prompt/question to ask the model about the chart.
+        chart_photo: Uploaded image file containing the chart.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service; if omitted, the VLM service picks its default budget.
+        x_cache_bypass: `X-Cache-Bypass` header; a truthy value skips the cache lookup.
+        cache_control: `Cache-Control` header; "no-cache" skips the cache lookup.
+
+    Returns:
+        A `text/event-stream` response with the answer chunks.
+
+    Raises:
+        HTTPException: If the upload is empty, the VLM service is overloaded
+            (503), the upstream request fails, or the VLM service returns a
+            non-200 response before streaming starts.
+    """
+    img_bytes, extension = await read_chart_upload(chart_photo)
+
+    model = await vlm_client.model_identity()
+    if model and not cache_bypass_requested(x_cache_bypass, cache_control):
+        text = await answer_cache.get(make_cache_key(img_bytes, query, max_new_tokens, model))
+        if text is not None:
+            async def replay() -> AsyncIterator[str]:
+                yield f"data: {json.dumps({'text': text})}\n\n"
+                yield f"event: done\ndata: {json.dumps({'text': text, 'model': model})}\n\n"
+            headers = {"Cache-Control": "no-cache", "X-Cache": "HIT"}
+            return StreamingResponse(replay(), media_type="text/event-stream", headers=headers)
+
+    events = stream_upstream(img_bytes, extension, query, max_new_tokens)
+    # wait for the first event so admission and upstream failures still map to an HTTP error status
     try:
-        async with httpx.AsyncClient(timeout=300) as client:
-            response = await client.post(VLM_URL, json=payload)
+        first = await anext(events)
+    except Overloaded as e:
+        raise overloaded_error(e)
+    except VLMResponseError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except StopAsyncIteration:
+        raise HTTPException(status_code=500, detail="VLM service closed the stream without an answer")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"VLM service request failed: {e}")
 
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail=f"VLM error {response.status_code}: {response.text}")
+    async def relay() -> AsyncIterator[str]:
+        event, data = first
+        try:
+            while True:
+                prefix = "" if event == "message" else f"event: {event}\n"
+                yield f"{prefix}data: {json.dumps(data)}\n\n"
+                event, data = await anext(events)
+        except StopAsyncIteration:
+            return
+        except Exception as e:
+            logger.error(f"VLM stream failed: {e}")
+            yield f"event: error\ndata: {json.dumps({'detail': f'VLM service request failed: {e}'})}\n\n"
+        finally:
+            await events.aclose()
+
+    headers = {"Cache-Control": "no-cache", "X-Cache": "MISS"}
+    return StreamingResponse(relay(), media_type="text/event-stream", headers=headers)
+
+@app.post("/vlm/jobs", response_model=JobStatus, status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    current_user: Annotated[User, Depends(get_current_user)],
+    query: str = Form(...),
+    chart_photo: UploadFile = File(...),
+    max_new_tokens: int | None = Form(None),
+    answer_type: Literal["free", "short", "binary", "options"] = Form("free"),
+    answer_options: list[str] | None = Form(None),
+):
+    """
+    Submit a chart image and query as an asynchronous job.
+
+    Takes the same multipart/form-data payload as `/vlm/query` but returns
+    right away with a job id instead of holding the connection open during
+    inference. The job is persisted, so it survives a gateway restart. Poll
+    `GET /vlm/jobs/{job_id}` for the answer.
+
+    Args:
+        current_user: The authenticated user derived from the request context.
+        query: Natural-language prompt/question to ask the model about the chart.
+        chart_photo: Uploaded image file containing the chart.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service; if omitted, the VLM service picks the budget of the answer type.
+        answer_type: "free", "short", "binary" or "options", as for `/vlm/query`.
+        answer_options: Allowed answers for answer_type "options", one form field each.
+
+    Returns:
+        A JobStatus of the queued job.
+
+    Raises:
+        HTTPException: If the upload is empty or answer options are missing (400) or the job queue is full (503).
+    """
+    img_bytes, extension = await read_chart_upload(chart_photo)
+    answer_options = parse_answer_options(answer_type, answer_options)
+    try:
+        job = await job_queue.submit(img_bytes, extension, query, max_new_tokens, answer_type, answer_options)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    return job_status(job)
+
+@app.get("/vlm/jobs/{job_id}", response_model=JobStatus)
+async def get_job_status(
+    current_user: Annotated[User, Depends(get_current_user)],
+    job_id: str,
+    wait: float = 0,
+):
+    """
+    Get the status and, once done, the answer of an asynchronous job.
+
+    With `wait` > 0 the request is held open (long-poll) until the job finishes
+    or `wait` seconds have passed, whichever comes first.
+
+    Args:
+        current_user: The authenticated user derived from the request context.
+        job_id: Id returned by `POST /vlm/jobs`.
+        wait: Seconds to wait for an unfinished job (capped by JOBS_MAX_WAIT).
 
-    return response.json()["text"]
+    Returns:
+        A JobStatus of the job.
+
+    Raises:
+        HTTPException: If the job does not exist or has expired (404).
+    """
+    job = await job_queue.wait(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job_status(job)
+
+async def authenticate_websocket(websocket: WebSocket) -> tuple[User, str | None]:
+    """
+    Authenticate a WebSocket connection from its first message.
+
+    The first message must be `{"type": "auth", "token": ..., "resume": ...}`.
+    The token may instead be sent in the `Authorization` header of the upgrade
+    request; `resume` optionally names a session to resume.
+
+    Args:
+        websocket: The accepted connection.
+
+    Returns:
+        The authenticated user and the id of the session to resume, if any.
+
+    Raises:
+        HTTPException: If the token is missing or invalid (401).
+        asyncio.TimeoutError: If the client did not authenticate in time.
+    """
+    message = await asyncio.wait_for(websocket.receive_json(), timeout=WS_AUTH_TIMEOUT)
+    if not isinstance(message, dict) or message.get("type") != "auth":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Expected an auth message")
+    token = message.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    if not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing token")
+    return decode_access_token(token), message.get("resume")
+
+async def stream_ws_query(session: WSSession, query_id: str, img_bytes: bytes, extension: str, query: str, max_new_tokens: int | None, bypass_cache: bool):
+    """
+    Answer a query sent on a WebSocket session and stream the answer back.
+
+    Sends `chunk` messages per sentence and a final `done` message with the full
+    answer, or an `error` message with an HTTP-like status code.
+
+    Args:
+        session: Session the query was sent on.
+        query_id: Id the client gave the query, repeated in every answer message.
+        img_bytes: Raw bytes of the chart image.
+        extension: Image file extension hint (e.g., "png", "jpg").
+        query: Natural-language prompt/question to ask the model about the chart.
+        max_new_tokens: Maximum number of tokens to generate at the VLM service, None for its default budget.
+        bypass_cache: Skip the cache lookup and always ask the VLM service.
+    """
+    try:
+        model = await vlm_client.model_identity()
+        if model and not bypass_cache:
+            text = await answer_cache.get(make_cache_key(img_bytes, query, max_new_tokens, model))
+            if text is not None:
+                await session.send({"type": "done", "id": query_id, "text": text, "cached": True})
+                return
+
+        async with aclosing(stream_upstream(img_bytes, extension, query, max_new_tokens)) as events:
+            async for event, data in events:
+                if event == "message":
+                    await session.send({"type": "chunk", "id": query_id, "text": data.get("text", "")})
+                elif event == "done":
+                    await session.send({"type": "done", "id": query_id, "text": data.get("text", ""), "cached": False})
+                elif event == "error":
+                    await session.send({"type": "error", "id": query_id, "status": 500, "detail": data.get("detail", "")})
+    except Overloaded as e:
+        await session.send({"type": "error", "id": query_id, "status": 503, "detail": str(e), "retry_after": e.retry_after})
+    except Exception as e:
+        logger.error(f"WebSocket query {query_id} failed: {e}")
+        await session.send({"type": "error", "id": query_id, "status": 500, "detail": f"VLM service request failed: {e}"})
+
+@app.websocket("/vlm/ws")
+async def vlm_session(websocket: WebSocket):
+    """
+    Persistent session channel for asking several questions over one connection.
+
+    The client authenticates once with an `auth` message and receives a `ready`
+    message with its session id. After that:
+
+    - a binary message sets the chart image of the session, normalized like
+      uploads and acknowledged with an `image` message,
+    - `{"type": "query", "id": ..., "query": ..., "max_new_tokens": null,
+      "no_cache": false}` asks about the current image and
+      is answered with `chunk` messages and a final `done` or `error` message
+      carrying the same id,
+    - the server sends `{"type": "ping"}` after `WS_HEARTBEAT_INTERVAL` seconds
+      of silence and closes connections that stay silent for another interval;
+      clients answer with `{"type": "pong"}` and may send `ping` themselves.
+
+    If the connection drops, queries keep running and their messages are
+    buffered. A client that reconnects and sends the session id as `resume` in
+    its `auth` message within `WS_RESUME_SECONDS` gets the buffered messages
+    and keeps its current image.
+
+    Args:
+        websocket: The WebSocket connection.
+    """
+    await websocket.accept()
+    try:
+        user, resume = await authenticate_websocket(websocket)
+    except (HTTPException, asyncio.TimeoutError, ValueError) as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(getattr(e, "detail", "Authentication failed")))
+        return
+    except WebSocketDisconnect:
+        return
+
+    session, resumed = ws_sessions.open(user.username, resume)
+    await websocket.send_json({"type": "ready", "session": session.id, "resumed": resumed, "heartbeat": WS_HEARTBEAT_INTERVAL})
+    await session.attach(websocket)
+    pinged = False
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), timeout=WS_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                if pinged:
+                    await websocket.close(code=status.WS_1001_GOING_AWAY, reason="Heartbeat timeout")
+                    return
+                pinged = True
+                await session.send({"type": "ping"}, buffer=False)
+                continue
+            pinged = False
+            if message["type"] == "websocket.disconnect":
+                return
+
+            if message.get("bytes") is not None:
+                try:
+                    session.image, session.extension = await image_normalizer.normalize(message["bytes"], "png")
+                except InvalidImage as e:
+                    await session.send({"type": "error", "status": 400, "detail": str(e)})
+                    continue
+                await session.send({"type": "image", "size": len(session.image)})
+                continue
+            try:
+                frame = json.loads(message.get("text") or "")
+                kind = frame["type"]
+            except (ValueError, TypeError, KeyError):
+                await session.send({"type": "error", "status": 400, "detail": "Invalid message"})
+                continue
+
+            if kind == "ping":
+                await session.send({"type": "pong"}, buffer=False)
+            elif kind == "query":
+                query_id = str(frame.get("id") or uuid.uuid4().hex)
+                query = frame.get("query")
+                max_new_tokens = frame.get("max_new_tokens")
+                if session.image is None:
+                    await session.send({"type": "error", "id": query_id, "status": 400, "detail": "Send a chart image first"})
+                elif not isinstance(query, str) or not query or not isinstance(max_new_tokens, int | None):
+                    await session.send({"type": "error", "id": query_id, "status": 400, "detail": "Invalid query"})
+                else:
+                    ws_sessions.queries += 1
+                    session.start(stream_ws_query(session, query_id, session.image, session.extension, query, max_new_tokens, bool(frame.get("no_cache"))))
+            elif kind != "pong":
+                await session.send({"type": "error", "status": 400, "detail": f"Unknown message type {kind}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        session.detach(websocket)
+
+@app.get("/metrics")
+def metrics(current_user: Annotated[User, Depends(get_current_user)]):
+    """
+    Runtime statistics of the gateway.
+
+    Args:
+        current_user: The authenticated user derived from the request context.
+
+    Returns:
+        A JSON object with the connection pool statistics of the shared VLM
+        client under "pool", the routing state of the VLM replicas under
+        "replicas", the answer cache counters under "cache", the
+        coalescing counters of identical in-flight queries under "coalescing",
+        the job queue counters under "jobs", the queue depth and wait times
+        of the admission control under "admission", the bytes and pixels saved
+        by image normalization under "images" and the WebSocket session
+        counters under "websocket".
+    """
+    return {
+        "pool": vlm_client.pool_stats(),
+        "replicas": vlm_client.replica_stats(),
+        "cache": answer_cache.stats(),
+        "coalescing": in_flight_queries.stats(),
+        "jobs": job_queue.stats(),
+        "admission": admission.stats(),
+        "images": image_normalizer.stats(),
+        "websocket": ws_sessions.stats(),
+    }
 
 @app.get("/health", status_code=200)
 def health():
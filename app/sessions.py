@@ -0,0 +1,180 @@
+import os, logging, asyncio, time, uuid
+from collections import deque
+from fastapi import WebSocket
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+# seconds between heartbeats; a client silent for two intervals is disconnected
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "15"))
+# seconds a client has to authenticate after connecting
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+# seconds a disconnected session is kept so the client can resume it
+WS_RESUME_SECONDS = float(os.getenv("WS_RESUME_SECONDS", "120"))
+# messages buffered for a disconnected session, the oldest are dropped beyond it
+WS_RESUME_BUFFER = int(os.getenv("WS_RESUME_BUFFER", "256"))
+
+logger = logging.getLogger("mylogger")
+
+class WSSession():
+    """
+    State of a WebSocket session that outlives a single connection.
+
+    The session remembers the last chart image and keeps running the queries
+    started on it. While no connection is attached, outgoing messages are
+    buffered and replayed once the client resumes the session.
+
+    Attributes:
+        id: Session id the client presents to resume the session.
+        username: User the session was authenticated for.
+        image: Bytes of the last chart image sent on the session.
+        extension: Image file extension hint of `image`.
+        tasks: Queries of the session that are still running.
+    """
+    def __init__(self, username: str):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.image: bytes | None = None
+        self.extension = "png"
+        self.tasks: set[asyncio.Task] = set()
+        self.websocket: WebSocket | None = None
+        self.buffer: deque[dict] = deque(maxlen=WS_RESUME_BUFFER)
+        self.detached_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def attach(self, websocket: WebSocket):
+        """
+        Bind the session to a connection and replay the messages buffered while detached.
+
+        Args:
+            websocket: The accepted connection.
+        """
+        async with self.lock:
+            previous, self.websocket = self.websocket, websocket
+            if previous is not None:
+                # the client reconnected before the old connection was noticed as dead
+                try:
+                    await previous.close(code=1001, reason="Session resumed on another connection")
+                except Exception:
+                    pass
+            while self.buffer:
+                await websocket.send_json(self.buffer[0])
+                self.buffer.popleft()
+
+    def detach(self, websocket: WebSocket):
+        """
+        Unbind the session from a closed connection.
+
+        Args:
+            websocket: The closed connection; a newer connection stays attached.
+        """
+        if self.websocket is websocket:
+            self.websocket = None
+            self.detached_at = time.monotonic()
+
+    async def send(self, message: dict, buffer: bool = True):
+        """
+        Send a message to the client, or buffer it while no connection is attached.
+
+        Args:
+            message: JSON-serializable message.
+            buffer: Keep the message for a resumed connection if it cannot be
+                sent; heartbeats are not worth replaying.
+        """
+        async with self.lock:
+            if self.websocket is not None:
+                try:
+                    await self.websocket.send_json(message)
+                    return
+                except Exception as e:
+                    logger.info(f"WebSocket session {self.id[:8]} lost its connection: {e}")
+                    self.detach(self.websocket)
+            if buffer:
+                self.buffer.append(message)
+
+    def start(self, coro) -> asyncio.Task:
+        """
+        Run a query of the session in the background.
+
+        Args:
+            coro: Coroutine answering the query.
+
+        Returns:
+            asyncio.Task: The running query.
+        """
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def expired(self, now: float) -> bool:
+        """
+        Whether the session was detached for longer than the resume window.
+        """
+        return self.websocket is None and now - self.detached_at > WS_RESUME_SECONDS
+
+    def close(self):
+        """
+        Cancel the queries still running on the session.
+        """
+        for task in self.tasks:
+            task.cancel()
+
+class SessionStore():
+    """
+    Registry of WebSocket sessions, so a reconnecting client can resume its session.
+    """
+    def __init__(self):
+        self.sessions: dict[str, WSSession] = {}
+        self.connects = 0
+        self.resumes = 0
+        self.queries = 0
+
+    def open(self, username: str, resume: str | None = None) -> tuple[WSSession, bool]:
+        """
+        Resume a session of the user or create a new one.
+
+        Args:
+            username: Authenticated user.
+            resume: Id of the session to resume, if any.
+
+        Returns:
+            tuple[WSSession, bool]: The session and whether an existing one was resumed.
+        """
+        self.purge()
+        self.connects += 1
+        session = self.sessions.get(resume) if resume else None
+        if session is not None and session.username == username:
+            self.resumes += 1
+            return session, True
+        session = WSSession(username)
+        self.sessions[session.id] = session
+        return session, False
+
+    def purge(self):
+        """
+        Drop sessions that were not resumed in time.
+        """
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if session.expired(now):
+                session.close()
+                del self.sessions[session_id]
+
+    def stats(self) -> dict:
+        """
+        WebSocket session counters.
+
+        Returns:
+            dict: Connected and detached sessions, running queries and counters of
+                connections, resumed sessions and queries.
+        """
+        connected = sum(1 for s in self.sessions.values() if s.websocket is not None)
+        return {
+            "connected": connected,
+            "detached": len(self.sessions) - connected,
+            "queries_running": sum(len(s.tasks) for s in self.sessions.values()),
+            "connects": self.connects,
+            "resumes": self.resumes,
+            "queries": self.queries,
+        }
@@ -0,0 +1,88 @@
+import asyncio, logging
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger("mylogger")
+
+class SingleFlight():
+    """
+    Coalesce identical concurrent calls into one.
+
+    The first caller for a key becomes the leader and starts the call as a task.
+    Callers with the same key that arrive while the task is pending attach to it
+    and receive its result or exception instead of starting their own call.
+    """
+    def __init__(self):
+        self.pending: dict[str, asyncio.Task] = {}
+        self.waiters: dict[asyncio.Task, int] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.cancelled = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run `fn` once per key among concurrent callers.
+
+        The shared task is shielded, so a follower or the leader going away does
+        not cancel the call for the others. Once every caller went away (e.g. all
+        clients disconnected), the call is cancelled, since nobody waits for it.
+
+        Args:
+            key: Identity of the call, equal keys are coalesced.
+            fn: Coroutine function performing the call.
+
+        Returns:
+            Any: Result of the shared call.
+
+        Raises:
+            Exception: Whatever the shared call raised.
+        """
+        task = self.pending.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self.pending[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.followers += 1
+            logger.info(f"Coalesced request onto in-flight call {key[:12]}")
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[task] == 1 and not task.done():
+                self.cancelled += 1
+                logger.info(f"Cancelled in-flight call {key[:12]}, every caller went away")
+                # forget it right away, a caller arriving before it is done starts a new call
+                if self.pending.get(key) is task:
+                    del self.pending[key]
+                task.cancel()
+            raise
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+
+    def stats(self) -> dict:
+        """
+        Coalescing counters.
+
+        Returns:
+            dict: Number of in-flight calls, leader calls, coalesced followers and
+                calls cancelled because every caller went away.
+        """
+        return {
+            "in_flight": len(self.pending),
+            "leaders": self.leaders,
+            "coalesced": self.followers,
+            "cancelled": self.cancelled,
+        }
+
+    def _finish(self, key: str, task: asyncio.Task):
+        """
+        Forget a finished call so the next caller starts a new one.
+        """
+        if self.pending.get(key) is task:
+            del self.pending[key]
+        # mark the exception as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,488 @@
+import os, logging, httpx, base64, json, time, asyncio, random, socket
+from typing import AsyncIterator
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+VLM_URL = os.getenv("VLM_URL", "http://vlm:5001/vlm/generate")
+# comma-separated generate URLs of all VLM replicas; defaults to VLM_URL
+VLM_URLS = [url.strip() for url in os.getenv("VLM_URLS", VLM_URL).split(",") if url.strip()]
+# "dns" routes to every address the VLM_URLS hosts resolve to (e.g. `docker compose up --scale vlm=3`)
+VLM_DISCOVERY = os.getenv("VLM_DISCOVERY", "static").lower()
+# "binary" posts raw image bytes to `{VLM_URL}/raw`, "json" keeps the base64 JSON body
+VLM_TRANSPORT = os.getenv("VLM_TRANSPORT", "binary").lower()
+VLM_MAX_CONNECTIONS = int(os.getenv("VLM_MAX_CONNECTIONS", "32"))
+VLM_MAX_KEEPALIVE = int(os.getenv("VLM_MAX_KEEPALIVE", "16"))
+VLM_KEEPALIVE_EXPIRY = float(os.getenv("VLM_KEEPALIVE_EXPIRY", "60"))
+# uvicorn only speaks HTTP/1.1, so HTTP/2 only pays off if a TLS proxy sits in front of the VLM service
+VLM_HTTP2 = os.getenv("VLM_HTTP2", "false").lower() == "true"
+VLM_CONNECT_TIMEOUT = float(os.getenv("VLM_CONNECT_TIMEOUT", "5"))
+VLM_READ_TIMEOUT = float(os.getenv("VLM_READ_TIMEOUT", "300"))
+VLM_WRITE_TIMEOUT = float(os.getenv("VLM_WRITE_TIMEOUT", "30"))
+VLM_POOL_TIMEOUT = float(os.getenv("VLM_POOL_TIMEOUT", "10"))
+# total seconds the VLM service may spend on a request, sent as X-Request-Timeout; unlike the
+# read timeout it also bounds streams that keep producing events, 0 leaves it to the service
+VLM_REQUEST_TIMEOUT = float(os.getenv("VLM_REQUEST_TIMEOUT", "900"))
+# seconds before the model identity reported by the VLM service is looked up again
+VLM_MODEL_REFRESH = float(os.getenv("VLM_MODEL_REFRESH", "60"))
+# seconds between active health checks (and DNS lookups) of the replicas
+VLM_HEALTH_INTERVAL = float(os.getenv("VLM_HEALTH_INTERVAL", "10"))
+# consecutive failed requests after which a replica is ejected
+VLM_EJECT_AFTER = int(os.getenv("VLM_EJECT_AFTER", "2"))
+# ejection time after VLM_EJECT_AFTER failures, doubled for every further failure up to VLM_EJECT_MAX
+VLM_EJECT_SECONDS = float(os.getenv("VLM_EJECT_SECONDS", "10"))
+VLM_EJECT_MAX = float(os.getenv("VLM_EJECT_MAX", "300"))
+
+logger = logging.getLogger("mylogger")
+
+class VLMResponseError(Exception):
+    """
+    Raised when the VLM service answers a streaming request with a non-200 status.
+
+    Attributes:
+        status_code: HTTP status code returned by the VLM service.
+        text: Response body returned by the VLM service.
+    """
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"VLM error {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+
+class Replica():
+    """
+    One instance of the VLM service and its routing state.
+
+    Attributes:
+        url: Generate endpoint of the replica (e.g. "http://vlm:5001/vlm/generate").
+        in_flight: Requests currently forwarded to the replica.
+        healthy: Result of the last active health check.
+        failures: Consecutive failed requests.
+        ejected_until: Monotonic time until which the replica receives no traffic.
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.in_flight = 0
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests_total = 0
+        self.errors_total = 0
+
+    def endpoint(self, path: str) -> str:
+        """
+        URL of another endpoint of the same replica.
+
+        Args:
+            path: Absolute path, e.g. "/ready".
+
+        Returns:
+            str: URL of `path` on the replica.
+        """
+        return str(httpx.URL(self.url).join(path))
+
+    def available(self, now: float) -> bool:
+        """
+        Whether the replica may receive traffic.
+        """
+        return self.healthy and now >= self.ejected_until
+
+    def succeeded(self):
+        """
+        Record a successful request and re-admit the replica.
+        """
+        if not self.healthy or self.ejected_until:
+            logger.info(f"VLM replica {self.url} is back in rotation")
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def checked(self, healthy: bool):
+        """
+        Record the result of an active health check.
+
+        A passed check only undoes a failed one. An ejection after failed requests
+        lasts until it expires or a request succeeds, since a replica may answer
+        its health check and still fail every generation.
+        """
+        if healthy and not self.healthy:
+            logger.info(f"VLM replica {self.url} passed its health check again")
+        elif not healthy and self.healthy:
+            logger.warning(f"VLM replica {self.url} failed its health check")
+        self.healthy = healthy
+
+    def failed(self):
+        """
+        Record a failed request and eject the replica once it failed too often in a row.
+        """
+        self.failures += 1
+        if self.failures >= VLM_EJECT_AFTER:
+            backoff = min(VLM_EJECT_SECONDS * 2 ** (self.failures - VLM_EJECT_AFTER), VLM_EJECT_MAX)
+            self.ejected_until = time.monotonic() + backoff
+            logger.warning(f"Ejected VLM replica {self.url} for {backoff:.0f}s after {self.failures} failures")
+
+    def stats(self) -> dict:
+        """
+        Routing state and counters of the replica.
+        """
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "ejected_for": round(max(self.ejected_until - time.monotonic(), 0.0), 1),
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+        }
+
+class VLMClient():
+    """
+    Long-lived, pooled HTTP client for the upstream VLM replicas.
+
+    The client is created once in the gateway lifespan and shared by all requests,
+    so connections to the VLM service are kept alive and reused instead of being
+    opened for every query. Each request goes to the available replica with the
+    fewest requests in flight. Replicas failing requests are ejected for a growing
+    backoff, and a background task checks `/ready` of every replica and keeps a
+    replica that fails it out of rotation until it answers again, so a replica
+    that is still loading its model gets no requests.
+    """
+    def __init__(self):
+        self.client: httpx.AsyncClient | None = None
+        self.replicas: dict[str, Replica] = {url: Replica(url) for url in VLM_URLS}
+        self.health_task: asyncio.Task | None = None
+        self.requests_total = 0
+        self.requests_in_flight = 0
+        self.errors_total = 0
+        self.model: str | None = None
+        self.model_checked_at = 0.0
+
+    def open(self):
+        """
+        Create the shared httpx client with the configured pool limits and timeouts
+        and start the replica health checks.
+        """
+        limits = httpx.Limits(
+            max_connections=VLM_MAX_CONNECTIONS,
+            max_keepalive_connections=VLM_MAX_KEEPALIVE,
+            keepalive_expiry=VLM_KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(
+            connect=VLM_CONNECT_TIMEOUT,
+            read=VLM_READ_TIMEOUT,
+            write=VLM_WRITE_TIMEOUT,
+            pool=VLM_POOL_TIMEOUT,
+        )
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout, http2=VLM_HTTP2)
+        self.health_task = asyncio.create_task(self._check_replicas())
+        logger.info(
+            f"VLM client pool opened (max_connections={VLM_MAX_CONNECTIONS}, "
+            f"max_keepalive={VLM_MAX_KEEPALIVE}, http2={VLM_HTTP2}, replicas={list(self.replicas)})"
+        )
+
+    async def aclose(self):
+        """
+        Stop the health checks and close the shared httpx client and all pooled connections.
+        """
+        if self.health_task is not None:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def pick(self, exclude: set[str] = frozenset()) -> Replica:
+        """
+        Choose the replica for the next request.
+
+        Args:
+            exclude: URLs of replicas that already failed this request.
+
+        Returns:
+            Replica: The available replica with the fewest requests in flight, ties
+                broken at random. If no replica is available the least loaded one
+                is tried anyway rather than failing the request outright.
+        """
+        now = time.monotonic()
+        candidates = [r for r in self.replicas.values() if r.url not in exclude] or list(self.replicas.values())
+        candidates = [r for r in candidates if r.available(now)] or candidates
+        fewest = min(r.in_flight for r in candidates)
+        return random.choice([r for r in candidates if r.in_flight == fewest])
+
+    async def model_identity(self) -> str | None:
+        """
+        Identity of the model served by the VLM service.
+
+        The identity is looked up at `/vlm/model` and reused for `VLM_MODEL_REFRESH`
+        seconds. If the lookup fails the last known identity is returned.
+
+        Returns:
+            str | None: Model name, or None if the VLM service never reported one.
+        """
+        if self.client is None:
+            raise RuntimeError("VLM client is not open")
+        if self.model is not None and time.monotonic() - self.model_checked_at < VLM_MODEL_REFRESH:
+            return self.model
+        try:
+            response = await self.client.get(self.pick().endpoint("/vlm/model"))
+            response.raise_for_status()
+            self.note_model(response.json()["model"])
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.warning(f"Could not look up the VLM model identity: {e}")
+        return self.model
+
+    def note_model(self, model: str | None):
+        """
+        Remember the model identity reported alongside an answer.
+
+        Args:
+            model: Model name reported by the VLM service.
+        """
+        if model:
+            self.model = model
+            self.model_checked_at = time.monotonic()
+
+    async def generate(self, img_bytes: bytes, query: str, extension: str, max_new_tokens: int | None, answer_type: str = "free", answer_options: list[str] | None = None) -> httpx.Response:
+        """
+        Forward a generation request to the least loaded VLM replica over the shared pool.
+
+        With the binary transport the image bytes are sent unchanged as the request
+        body and the parameters as query parameters. The json transport sends the
+        base64-encoded image in a JSON body to the original `/vlm/generate` endpoint.
+        A request that could not connect never reached the model, so it is retried
+        on the next replica. Server errors count against the replica like transport
+        errors, but are returned to the caller rather than retried. The answer type
+        is only sent for fixed answers and the token budget only if the caller set
+        one, the VLM service picks the budget of the answer type otherwise. The total
+        deadline `VLM_REQUEST_TIMEOUT` is sent along as `X-Request-Timeout`, so the
+        VLM service stops generating when the request runs too long; cancelling the
+        call closes the connection, which cancels the generation as well.
+
+        Args:
+            img_bytes: Raw bytes of the uploaded chart image.
+            query: Natural-language prompt/question to ask the model about the chart.
+            extension: Image file extension hint (e.g., "png", "jpg").
+            max_new_tokens: Maximum number of tokens to generate at the VLM service, None for the budget of the answer type.
+            answer_type: "free", "binary" or "options".
+            answer_options: Allowed answers for answer_type "options".
+
+        Returns:
+            httpx.Response: Raw response of the VLM service.
+
+        Raises:
+            RuntimeError: If the client has not been opened.
+            httpx.HTTPError: If the upstream request fails.
+        """
+        if self.client is None:
+            raise RuntimeError("VLM client is not open")
+        fields = {}
+        if max_new_tokens is not None:
+            fields["max_new_tokens"] = max_new_tokens
+        if answer_type != "free":
+            fields.update(answer_type=answer_type, answer_options=answer_options or [])
+        timeout = self._request_timeout()
+        tried = set()
+        while True:
+            replica = self.pick(exclude=tried)
+            tried.add(replica.url)
+            self._start(replica)
+            try:
+                if VLM_TRANSPORT == "json":
+                    image_b64 = base64.b64encode(img_bytes).decode("utf-8")
+                    payload = {"query": query, "image_b64": image_b64, "extension": extension, **fields}
+                    response = await self.client.post(replica.url, json=payload, headers=timeout)
+                else:
+                    params = {"query": query, "extension": extension, **fields}
+                    response = await self.client.post(
+                        f"{replica.url}/raw",
+                        params=params,
+                        content=img_bytes,
+                        headers={"Content-Type": "application/octet-stream", **timeout},
+                    )
+                if response.status_code >= 500:
+                    self._fail(replica)
+                else:
+                    replica.succeeded()
+                return response
+            except httpx.HTTPError as e:
+                self._fail(replica)
+                if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) and len(tried) < len(self.replicas):
+                    logger.warning(f"VLM replica {replica.url} unreachable, retrying on another replica: {e}")
+                    continue
+                raise
+            finally:
+                self._finish(replica)
+
+    async def stream(self, img_bytes: bytes, query: str, extension: str, max_new_tokens: int | None) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Stream a generation from the least loaded VLM replica as parsed server-sent events.
+
+        Like `generate`, the total deadline is sent along as `X-Request-Timeout`, so
+        the VLM service stops generating when the stream runs too long.
+
+        Args:
+            img_bytes: Raw bytes of the uploaded chart image.
+            query: Natural-language prompt/question to ask the model about the chart.
+            extension: Image file extension hint (e.g., "png", "jpg").
+            max_new_tokens: Maximum number of tokens to generate at the VLM service, None for its default budget.
+
+        Yields:
+            tuple[str, dict]: Event name ("message", "done" or "error") and its JSON data.
+
+        Raises:
+            RuntimeError: If the client has not been opened.
+            VLMResponseError: If the VLM service returns a non-200 response.
+            httpx.HTTPError: If the upstream request fails.
+        """
+        if self.client is None:
+            raise RuntimeError("VLM client is not open")
+        replica = self.pick()
+        self._start(replica)
+        try:
+            params = {"query": query, "extension": extension}
+            if max_new_tokens is not None:
+                params["max_new_tokens"] = max_new_tokens
+            async with self.client.stream(
+                "POST",
+                f"{replica.url}/stream",
+                params=params,
+                content=img_bytes,
+                headers={"Content-Type": "application/octet-stream", **self._request_timeout()},
+            ) as response:
+                if response.status_code >= 500:
+                    self._fail(replica)
+                else:
+                    replica.succeeded()
+                if response.status_code != 200:
+                    await response.aread()
+                    raise VLMResponseError(response.status_code, response.text)
+                event, data = "message", []
+                async for line in response.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:"):
+                        data.append(line[len("data:"):].strip())
+                    elif not line and data:
+                        yield event, json.loads("\n".join(data))
+                        event, data = "message", []
+        except httpx.HTTPError:
+            self._fail(replica)
+            raise
+        finally:
+            self._finish(replica)
+
+    def pool_stats(self) -> dict:
+        """
+        Snapshot of the connection pool, used to size the pool limits.
+
+        Returns:
+            dict: Configured limits, request counters and the number of open,
+                idle and active connections.
+        """
+        connections = []
+        if self.client is not None:
+            # httpx does not expose its pool publicly, so read it from the transport
+            pool = getattr(self.client._transport, "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            "max_connections": VLM_MAX_CONNECTIONS,
+            "max_keepalive_connections": VLM_MAX_KEEPALIVE,
+            "keepalive_expiry": VLM_KEEPALIVE_EXPIRY,
+            "http2": VLM_HTTP2,
+            "connections_open": len(connections),
+            "connections_idle": idle,
+            "connections_active": len(connections) - idle,
+            "requests_in_flight": self.requests_in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+        }
+
+    def replica_stats(self) -> list[dict]:
+        """
+        Routing state of every replica.
+
+        Returns:
+            list[dict]: Health, ejection state, in-flight requests and counters per replica.
+        """
+        return [replica.stats() for replica in self.replicas.values()]
+
+    def _start(self, replica: Replica):
+        """
+        Count a request forwarded to a replica.
+        """
+        self.requests_total += 1
+        self.requests_in_flight += 1
+        replica.requests_total += 1
+        replica.in_flight += 1
+
+    def _finish(self, replica: Replica):
+        """
+        Count a finished request.
+        """
+        self.requests_in_flight -= 1
+        replica.in_flight -= 1
+
+    def _request_timeout(self) -> dict:
+        """
+        Header with the total deadline of a request, empty if the VLM service picks it.
+        """
+        return {"X-Request-Timeout": str(VLM_REQUEST_TIMEOUT)} if VLM_REQUEST_TIMEOUT > 0 else {}
+
+    def _fail(self, replica: Replica):
+        """
+        Count a failed request against its replica.
+        """
+        self.errors_total += 1
+        replica.errors_total += 1
+        replica.failed()
+
+    async def check_replicas(self):
+        """
+        Refresh the replica list and check `/ready` of every replica once.
+        """
+        if VLM_DISCOVERY == "dns":
+            await self._discover()
+        replicas = list(self.replicas.values())
+        results = await asyncio.gather(*(self._probe(replica) for replica in replicas))
+        for replica, healthy in zip(replicas, results):
+            replica.checked(healthy)
+
+    async def _check_replicas(self):
+        """
+        Check the replicas every `VLM_HEALTH_INTERVAL` seconds.
+        """
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(VLM_HEALTH_INTERVAL)
+
+    async def _probe(self, replica: Replica) -> bool:
+        """
+        Check `/ready` of a replica.
+        """
+        try:
+            response = await self.client.get(replica.endpoint("/ready"), timeout=VLM_CONNECT_TIMEOUT)
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def _discover(self):
+        """
+        Resolve the hosts of `VLM_URLS` and route to every address found.
+
+        Replicas that are still resolved keep their routing state and vanished ones
+        are dropped. If a lookup fails the current replicas are kept.
+        """
+        loop = asyncio.get_running_loop()
+        urls = []
+        for base in VLM_URLS:
+            url = httpx.URL(base)
+            try:
+                infos = await loop.getaddrinfo(url.host, url.port, type=socket.SOCK_STREAM)
+            except socket.gaierror as e:
+                logger.warning(f"Could not resolve VLM replicas of {url.host}: {e}")
+                return
+            urls += [str(url.copy_with(host=address)) for address in sorted({info[4][0] for info in infos})]
+        if urls and set(urls) != set(self.replicas):
+            self.replicas = {url: self.replicas.get(url) or Replica(url) for url in urls}
+            logger.info(f"VLM replicas: {urls}")
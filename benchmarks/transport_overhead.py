@@ -0,0 +1,83 @@
+"""
+Per-request transport overhead between gateway and VLM service, JSON/base64 vs raw bytes.
+
+Both endpoint shapes of `vlm/main.py` (`/vlm/generate` and `/vlm/generate/raw`) are
+mounted on an in-process FastAPI app that only decodes the image payload, so the
+numbers contain the encode, serialization, HTTP parsing and decode cost of each
+transport and nothing of the model.
+
+Usage:
+    python benchmarks/transport_overhead.py [--sizes-kb 64 256 1024 4096 8192] [--repeats 20]
+"""
+import argparse, asyncio, base64, os, statistics, time
+import httpx
+from fastapi import FastAPI, Body, Query
+from pydantic import BaseModel
+
+class VLMRequest(BaseModel):
+    query: str
+    image_b64: str
+    extension: str = "png"
+    max_new_tokens: int | None = None
+
+app = FastAPI()
+
+@app.post("/vlm/generate")
+def generate(req: VLMRequest):
+    raw = base64.b64decode(req.image_b64)
+    return {"text": str(len(raw))}
+
+@app.post("/vlm/generate/raw")
+def generate_raw(
+    image: bytes = Body(..., media_type="application/octet-stream"),
+    query: str = Query(...),
+    extension: str = Query("png"),
+    max_new_tokens: int | None = Query(None),
+):
+    return {"text": str(len(image))}
+
+async def send_json(client: httpx.AsyncClient, img_bytes: bytes) -> int:
+    image_b64 = base64.b64encode(img_bytes).decode("utf-8")
+    payload = {"query": "What is the trend?", "image_b64": image_b64, "extension": "png", "max_new_tokens": 128}
+    request = client.build_request("POST", "/vlm/generate", json=payload)
+    await client.send(request)
+    return len(request.content)
+
+async def send_raw(client: httpx.AsyncClient, img_bytes: bytes) -> int:
+    params = {"query": "What is the trend?", "extension": "png", "max_new_tokens": 128}
+    request = client.build_request(
+        "POST", "/vlm/generate/raw", params=params, content=img_bytes,
+        headers={"Content-Type": "application/octet-stream"},
+    )
+    await client.send(request)
+    return len(request.content)
+
+async def measure(send, client: httpx.AsyncClient, img_bytes: bytes, repeats: int) -> tuple[float, int]:
+    await send(client, img_bytes)  # warmup
+    timings = []
+    wire_bytes = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        wire_bytes = await send(client, img_bytes)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), wire_bytes
+
+async def main(sizes_kb: list[int], repeats: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        print(f"{'payload':>10} | {'json ms':>9} | {'raw ms':>9} | {'json wire':>11} | {'raw wire':>11} | speedup")
+        for size_kb in sizes_kb:
+            img_bytes = os.urandom(size_kb * 1024)
+            json_ms, json_wire = await measure(send_json, client, img_bytes, repeats)
+            raw_ms, raw_wire = await measure(send_raw, client, img_bytes, repeats)
+            print(
+                f"{size_kb:>7} KB | {json_ms:>9.2f} | {raw_ms:>9.2f} | "
+                f"{json_wire / 1024:>8.0f} KB | {raw_wire / 1024:>8.0f} KB | {json_ms / raw_ms:>6.1f}x"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-kb", type=int, nargs="+", default=[64, 256, 1024, 4096, 8192])
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes_kb, args.repeats))
@@ -0,0 +1,81 @@
+"""
+Throughput versus latency of the VLM micro-batching scheduler.
+
+Loads the model in-process and replays the same burst of concurrent requests
+through `MicroBatcher` for every combination of batching window and maximum batch
+size. A maximum batch size of 1 is the unbatched baseline, one `model.generate`
+call per request.
+
+Usage:
+    python benchmarks/vlm_batching.py --model OpenGVLab/InternVL3_5-8B-HF \
+        [--windows-ms 0 20 50] [--batch-sizes 1 2 4 8] [--requests 16] [--concurrency 8]
+"""
+import argparse, os, statistics, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vlm.app.model import VisualLanguageModelForCharts
+from vlm.app.batching import MicroBatcher
+
+QUERIES = [
+    "What is the trend of the chart?",
+    "Which bar is the highest?",
+    "Is the last value larger than the first one?",
+    "How many bars are there?",
+]
+
+def make_chart(index: int) -> Image.Image:
+    img = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(img)
+    for bar in range(6):
+        height = 80 + ((bar * 37 + index * 53) % 400)
+        draw.rectangle([80 + bar * 110, 540 - height, 160 + bar * 110, 540], fill=(40 + bar * 30, 90, 200))
+    draw.line([60, 540, 760, 540], fill="black", width=3)
+    return img
+
+def run_burst(batcher: MicroBatcher, charts: list[Image.Image], max_new_tokens: int, concurrency: int) -> tuple[float, list[float]]:
+    def one(index: int) -> float:
+        start = time.perf_counter()
+        batcher.submit(QUERIES[index % len(QUERIES)], "", charts[index], max_new_tokens)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(one, range(len(charts))))
+    return time.perf_counter() - start, latencies
+
+def main(args: argparse.Namespace):
+    vlm = VisualLanguageModelForCharts()
+    vlm.load_model(args.model, args.force_cpu)
+    charts = [make_chart(i) for i in range(args.requests)]
+
+    # warmup
+    vlm.run_vlm(QUERIES[0], "", charts[0], max_new_tokens=args.max_new_tokens)
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, max_new_tokens={args.max_new_tokens}")
+    print(f"{'window':>8} | {'batch':>5} | {'req/s':>7} | {'p50 s':>7} | {'p95 s':>7} | {'avg batch':>9}")
+    for batch_size in args.batch_sizes:
+        # without batching the window does not matter
+        for window_ms in (args.windows_ms if batch_size > 1 else [0]):
+            batcher = MicroBatcher(vlm.run_vlm_batch, window=window_ms / 1000, max_batch_size=batch_size)
+            batcher.start()
+            elapsed, latencies = run_burst(batcher, charts, args.max_new_tokens, args.concurrency)
+            batcher.stop()
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            print(
+                f"{window_ms:>5.0f} ms | {batch_size:>5} | {len(latencies) / elapsed:>7.3f} | "
+                f"{statistics.median(latencies):>7.2f} | {p95:>7.2f} | {batcher.stats()['batch_size_avg']:>9.2f}"
+            )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "OpenGVLab/InternVL3_5-8B-HF"))
+    parser.add_argument("--force-cpu", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--windows-ms", type=float, nargs="+", default=[0, 20, 50])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    main(parser.parse_args())
@@ -0,0 +1,98 @@
+"""
+Per-token decode latency of the compiled decode path versus eager decoding.
+
+Loads the model in-process, compiles a `CompiledDecoder` (static KV cache and
+`torch.compile`d decode step) and decodes the same chart prompts both ways with a
+fixed number of new tokens. The per-token latency is the time of N tokens minus the
+time of one token (the prefill), divided by N - 1, so the eager prefill both paths
+share does not count. The compile time is reported separately; with --cache-dir a
+second run loads the compiled kernels instead of compiling them again.
+
+Usage:
+    python benchmarks/vlm_compile.py --model OpenGVLab/InternVL3_5-8B-HF \
+        [--new-tokens 32] [--repeats 3] [--cache-dir /models/torch_compile] [--precision bf16]
+"""
+import argparse, os, statistics, sys, time
+from PIL import Image, ImageDraw
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vlm.app.model import VisualLanguageModelForCharts
+from vlm.app.compiled import CompiledDecoder
+
+QUERIES = [
+    "What is the trend of the chart?",
+    "Which bar is the highest?",
+    "Is the last value larger than the first one?",
+]
+
+def make_chart(index: int) -> Image.Image:
+    img = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(img)
+    for bar in range(6):
+        height = 80 + ((bar * 37 + index * 53) % 400)
+        draw.rectangle([80 + bar * 110, 540 - height, 160 + bar * 110, 540], fill=(40 + bar * 30, 90, 200))
+    draw.line([60, 540, 760, 540], fill="black", width=3)
+    return img
+
+@torch.inference_mode()
+def eager(vlm: VisualLanguageModelForCharts, prompt: tuple[str, Image.Image], new_tokens: int) -> tuple[float, list[int]]:
+    # generation extends the prefix cache of its inputs, so every run embeds the prompt again
+    inputs = vlm.embed_inputs(prompt[0], "", prompt[1])
+    start = time.perf_counter()
+    ids = vlm.model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False)[0].tolist()
+    return time.perf_counter() - start, ids
+
+def compiled(decoder: CompiledDecoder, prompt: tuple[str, Image.Image], new_tokens: int) -> tuple[float, list[int]]:
+    inputs = decoder.vlm.embed_inputs(prompt[0], "", prompt[1])
+    start = time.perf_counter()
+    ids = decoder.generate(inputs, new_tokens)
+    return time.perf_counter() - start, ids
+
+def per_token_ms(run, prompts: list[tuple[str, Image.Image]], new_tokens: int, repeats: int) -> tuple[float, list[list[int]]]:
+    latencies = []
+    answers = []
+    for prompt in prompts:
+        for _ in range(repeats):
+            first, _ = run(prompt, 1)
+            full, ids = run(prompt, new_tokens)
+            latencies.append(1000 * (full - first) / (new_tokens - 1))
+        answers.append(ids)
+    return statistics.median(latencies), answers
+
+def main(args: argparse.Namespace):
+    vlm = VisualLanguageModelForCharts()
+    vlm.load_model(args.model, args.force_cpu, precision=args.precision)
+    prompts = [(query, make_chart(i)) for i, query in enumerate(QUERIES)]
+    prompt_tokens = max(vlm.embed_inputs(query, "", chart)["inputs_embeds"].shape[1] for query, chart in prompts)
+
+    # without end tokens every answer runs to the full number of tokens, as with min_new_tokens
+    decoder = CompiledDecoder(vlm, prompt_tokens + args.new_tokens, args.cache_dir)
+    decoder.warmup()
+
+    # warmup
+    eager(vlm, prompts[0], 2)
+    compiled(decoder, prompts[0], 2)
+
+    eager_ms, eager_answers = per_token_ms(lambda p, n: eager(vlm, p, n), prompts, args.new_tokens, args.repeats)
+    compiled_ms, compiled_answers = per_token_ms(lambda p, n: compiled(decoder, p, n), prompts, args.new_tokens, args.repeats)
+    # min_new_tokens suppresses the end token eagerly, so answers are compared up to it
+    cut = lambda ids: ids[:next((i for i, t in enumerate(ids) if t in vlm.eos_ids), len(ids))]
+    same = sum(cut(a) == cut(b) for a, b in zip(eager_answers, compiled_answers))
+
+    print(f"{len(prompts)} prompts of up to {prompt_tokens} tokens, {args.new_tokens} new tokens, precision={vlm.precision}")
+    print(f"compile (warmup): {decoder.warmup_seconds:.1f} s, cache: {args.cache_dir or 'default'}")
+    print(f"{'path':>8} | {'ms/token':>8} | {'tokens/s':>8}")
+    for name, ms in (("eager", eager_ms), ("compiled", compiled_ms)):
+        print(f"{name:>8} | {ms:>8.2f} | {1000 / ms:>8.2f}")
+    print(f"speedup: {eager_ms / compiled_ms:.2f}x, identical answers: {same}/{len(prompts)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "OpenGVLab/InternVL3_5-8B-HF"))
+    parser.add_argument("--force-cpu", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--precision", default=os.getenv("PRECISION") or None)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cache-dir", default=os.getenv("COMPILE_CACHE_DIR") or None)
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+"""
+Memory, latency and answer agreement of the bf16 and int8 precisions against fp32.
+
+Loads the model once per precision and answers the same chart prompts with greedy
+decoding, both as free answers and as a choice between fixed answers. fp32 is the
+baseline: for the other precisions the agreement is the share of answers identical
+to the fp32 ones, so it shows how much quantization changes what the model says.
+A precision the device does not support natively is loaded in its fallback and
+reported under that name.
+
+Usage:
+    python benchmarks/vlm_precision.py --model OpenGVLab/InternVL3_5-8B-HF \
+        [--precisions fp32 bf16 int8] [--new-tokens 32] [--repeats 3] [--output vlm/scores/precision.csv]
+"""
+import argparse, csv, os, statistics, sys, time
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vlm.app.model import VisualLanguageModelForCharts
+
+QUERIES = [
+    "What is the trend of the chart?",
+    "Which bar is the highest?",
+    "Is the last value larger than the first one?",
+    "How many bars are there?",
+]
+CHOICES = ["Yes", "No"]
+
+def make_chart(index: int) -> Image.Image:
+    img = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(img)
+    for bar in range(6):
+        height = 80 + ((bar * 37 + index * 53) % 400)
+        draw.rectangle([80 + bar * 110, 540 - height, 160 + bar * 110, 540], fill=(40 + bar * 30, 90, 200))
+    draw.line([60, 540, 760, 540], fill="black", width=3)
+    return img
+
+def measure(vlm: VisualLanguageModelForCharts, prompts: list[tuple[str, Image.Image]], new_tokens: int, repeats: int) -> tuple[list[float], list[str], list[str]]:
+    latencies = []
+    answers = []
+    choices = []
+    for query, chart in prompts:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            answer = vlm.run_vlm(query, "", chart, new_tokens)
+            latencies.append(time.perf_counter() - start)
+        answers.append(answer)
+        choices.append(vlm.choose_answer(query, "", chart, CHOICES))
+    return latencies, answers, choices
+
+def main(args: argparse.Namespace):
+    prompts = [(query, make_chart(i)) for i, query in enumerate(QUERIES)]
+    rows = []
+    baseline = None
+    for precision in args.precisions:
+        vlm = VisualLanguageModelForCharts()
+        start = time.perf_counter()
+        vlm.load_model(args.model, args.force_cpu, precision=precision)
+        load_s = time.perf_counter() - start
+
+        # warmup
+        vlm.run_vlm(QUERIES[0], "", prompts[0][1], 2)
+
+        latencies, answers, choices = measure(vlm, prompts, args.new_tokens, args.repeats)
+        if baseline is None:
+            baseline = (answers, choices)
+        rows.append({
+            "precision": vlm.precision,
+            "requested": precision,
+            "model_mb": round(vlm.model_bytes() / 2**20, 2),
+            "load_s": round(load_s, 2),
+            "latency_mean_s": round(statistics.mean(latencies), 4),
+            "latency_p50_s": round(statistics.median(latencies), 4),
+            "same_answers": f"{sum(a == b for a, b in zip(answers, baseline[0]))}/{len(prompts)}",
+            "same_choices": f"{sum(a == b for a, b in zip(choices, baseline[1]))}/{len(prompts)}",
+        })
+        del vlm
+
+    print(f"{len(prompts)} prompts x {args.repeats}, {args.new_tokens} new tokens, baseline {args.precisions[0]}, model {args.model}")
+    print(f"{'precision':>9} | {'MB':>8} | {'load s':>6} | {'mean s':>7} | {'p50 s':>7} | {'answers':>7} | {'choices':>7}")
+    for row in rows:
+        print(f"{row['precision']:>9} | {row['model_mb']:>8.2f} | {row['load_s']:>6.2f} | {row['latency_mean_s']:>7.4f} | "
+              f"{row['latency_p50_s']:>7.4f} | {row['same_answers']:>7} | {row['same_choices']:>7}")
+
+    if args.output:
+        # same layout as the evaluation csvs in vlm/scores
+        with open(args.output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]), delimiter=";")
+            writer.writeheader()
+            writer.writerows(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "OpenGVLab/InternVL3_5-8B-HF"))
+    parser.add_argument("--force-cpu", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16", "int8"])
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    main(parser.parse_args())
@@ -0,0 +1,10 @@
+import os, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the gateway imports its modules flat from app/, the VLM service is imported as `vlm.app`
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, ROOT)
+
+# db.py creates its engine at import, keep the job tests off the gateway database
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/gateway.db")
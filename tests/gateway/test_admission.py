@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+import admission
+from admission import AdmissionController, Overloaded
+
+async def hold(controller: AdmissionController, name: str, order: list[str], release: asyncio.Event, bounded: bool = True):
+    async with controller.slot(bounded):
+        order.append(name)
+        await release.wait()
+
+def test_slots_are_handed_over_in_arrival_order():
+    async def main():
+        controller = AdmissionController(max_concurrency=2, max_queue=8)
+        order, release = [], asyncio.Event()
+        tasks = []
+        for name in "abcde":
+            tasks.append(asyncio.create_task(hold(controller, name, order, release)))
+            await asyncio.sleep(0)
+        running = (list(order), controller.stats()["in_flight"], controller.stats()["queue_depth"])
+        release.set()
+        await asyncio.gather(*tasks)
+        return running, order, controller.stats()
+
+    running, order, stats = asyncio.run(main())
+    assert running == (["a", "b"], 2, 3)
+    assert order == list("abcde")
+    assert (stats["in_flight"], stats["queue_depth"], stats["admitted"]) == (0, 0, 5)
+
+def test_full_queue_rejects_with_retry_after():
+    async def main():
+        controller = AdmissionController(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(controller, name, [], release)) for name in "ab"]
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as error:
+            async with controller.slot():
+                pass
+        # callers bounding themselves still queue
+        unbounded = asyncio.create_task(hold(controller, "c", [], release, bounded=False))
+        await asyncio.sleep(0)
+        depth = controller.stats()["queue_depth"]
+        release.set()
+        await asyncio.gather(*tasks, unbounded)
+        return error.value, depth, controller.stats()
+
+    error, depth, stats = asyncio.run(main())
+    assert error.retry_after >= 1
+    assert depth == 2
+    assert (stats["rejected"], stats["admitted"]) == (1, 3)
+
+def test_waiting_times_out(monkeypatch):
+    monkeypatch.setattr(admission, "VLM_QUEUE_TIMEOUT", 0.05)
+
+    async def main():
+        controller = AdmissionController(max_concurrency=1, max_queue=4)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "a", [], release))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            async with controller.slot():
+                pass
+        release.set()
+        await holder
+        return controller.stats()
+
+    stats = asyncio.run(main())
+    assert (stats["timed_out"], stats["queue_depth"], stats["in_flight"]) == (1, 0, 0)
+
+def test_slot_handed_to_a_cancelled_waiter_is_not_lost():
+    async def main():
+        controller = AdmissionController(max_concurrency=1, max_queue=4)
+        order, release, peak = [], asyncio.Event(), []
+
+        async def use(name):
+            async with controller.slot():
+                order.append(name)
+                peak.append(controller.stats()["in_flight"])
+                await release.wait()
+
+        await controller._acquire(True)
+        b = asyncio.create_task(use("b"))
+        c = asyncio.create_task(use("c"))
+        await asyncio.sleep(0)
+        # the slot goes to b, which goes away before it could take it
+        controller._release()
+        b.cancel()
+        release.set()
+        await asyncio.gather(b, c, return_exceptions=True)
+        return order, peak, controller.stats()
+
+    order, peak, stats = asyncio.run(main())
+    assert order[-1] == "c"
+    assert max(peak) == 1
+    assert (stats["in_flight"], stats["queue_depth"]) == (0, 0)
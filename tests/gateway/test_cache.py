@@ -0,0 +1,67 @@
+import asyncio, json, os, time
+from cache import AnswerCache, make_cache_key, normalize_query
+
+def test_trivially_different_queries_share_a_key():
+    assert normalize_query("  What is the TREND?? ") == "what is the trend"
+    assert make_cache_key(b"png", "What is the trend?", None, "tiny") == make_cache_key(b"png", "what is  the trend", None, "tiny")
+
+def test_key_covers_image_budget_model_and_answer_type():
+    key = make_cache_key(b"png", "Is it rising?", None, "tiny")
+    assert key != make_cache_key(b"jpg", "Is it rising?", None, "tiny")
+    assert key != make_cache_key(b"png", "Is it rising?", 64, "tiny")
+    assert key != make_cache_key(b"png", "Is it rising?", None, "tiny-int8")
+    assert key != make_cache_key(b"png", "Is it rising?", None, "tiny", "binary")
+    assert make_cache_key(b"png", "Pick one", None, "tiny", "options", ["A", "B"]) != make_cache_key(b"png", "Pick one", None, "tiny", "options", ["A", "C"])
+
+def test_memory_tier_evicts_least_recently_used():
+    async def main():
+        cache = AnswerCache(max_entries=2, ttl=60, cache_dir="")
+        await cache.put("a", "Yes")
+        await cache.put("b", "No")
+        await cache.get("a")
+        await cache.put("c", "Maybe")
+        return cache, [await cache.get(key) for key in "abc"]
+
+    cache, answers = asyncio.run(main())
+    assert answers == ["Yes", None, "Maybe"]
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"], stats["hits"], stats["misses"]) == (2, 1, 3, 1)
+
+def test_expired_answers_are_misses():
+    async def main():
+        cache = AnswerCache(max_entries=8, ttl=0.05, cache_dir="")
+        await cache.put("a", "Yes")
+        fresh = await cache.get("a")
+        await asyncio.sleep(0.06)
+        return cache, fresh, await cache.get("a")
+
+    cache, fresh, expired = asyncio.run(main())
+    assert (fresh, expired) == ("Yes", None)
+    assert cache.stats()["entries"] == 0
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    async def main():
+        first = AnswerCache(max_entries=8, ttl=60, cache_dir=str(tmp_path))
+        first.open()
+        await first.put("a", "Yes")
+        second = AnswerCache(max_entries=8, ttl=60, cache_dir=str(tmp_path))
+        second.open()
+        return second, await second.get("a"), await second.get("a")
+
+    cache, from_disk, from_memory = asyncio.run(main())
+    assert from_disk == from_memory == "Yes"
+    assert (cache.stats()["hits"], cache.stats()["disk_hits"]) == (2, 1)
+    assert os.listdir(tmp_path) == ["a.json"]
+
+def test_expired_disk_answers_are_removed(tmp_path):
+    (tmp_path / "old.json").write_text(json.dumps({"created": time.time() - 120, "text": "Yes"}))
+    (tmp_path / "stale.json").write_text(json.dumps({"created": time.time() - 120, "text": "No"}))
+    os.utime(tmp_path / "old.json", (time.time() - 120, time.time() - 120))
+
+    async def main():
+        cache = AnswerCache(max_entries=8, ttl=60, cache_dir=str(tmp_path))
+        cache.open()
+        return await cache.get("stale")
+
+    assert asyncio.run(main()) is None
+    assert os.listdir(tmp_path) == []
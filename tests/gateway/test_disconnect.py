@@ -0,0 +1,55 @@
+import asyncio
+import httpx
+import pytest
+from fastapi import HTTPException
+import main
+from upstream import Replica, VLMClient
+
+class FakeRequest:
+    def __init__(self, disconnect_after: int):
+        self.checks = 0
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self) -> bool:
+        self.checks += 1
+        return self.checks > self.disconnect_after
+
+def test_disconnect_cancels_the_upstream_request(monkeypatch):
+    monkeypatch.setattr(main, "CLIENT_DISCONNECT_POLL", 0.01)
+    upstream = {"started": asyncio.Event(), "cancelled": False}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        upstream["started"].set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            upstream["cancelled"] = True
+            raise
+        return httpx.Response(200, json={"text": "Yes"})
+
+    async def run():
+        client = VLMClient()
+        url = "http://vlm:5001/vlm/generate"
+        client.replicas = {url: Replica(url)}
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with pytest.raises(HTTPException) as error:
+            await main.cancel_on_disconnect(FakeRequest(disconnect_after=3), client.generate(b"png", "Is it rising?", "png", None))
+        # the cancelled call finishes on the next turn of the loop
+        await asyncio.sleep(0)
+        return error.value, client
+
+    error, client = asyncio.run(run())
+    assert error.status_code == 499
+    assert upstream["started"].is_set() and upstream["cancelled"]
+    assert client.requests_in_flight == 0
+
+def test_connected_client_gets_the_result(monkeypatch):
+    monkeypatch.setattr(main, "CLIENT_DISCONNECT_POLL", 0.01)
+
+    async def answer():
+        await asyncio.sleep(0.05)
+        return "It rises."
+
+    request = FakeRequest(disconnect_after=1000)
+    assert asyncio.run(main.cancel_on_disconnect(request, answer())) == "It rises."
+    assert request.checks > 0
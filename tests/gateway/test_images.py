@@ -0,0 +1,58 @@
+import asyncio
+from io import BytesIO
+import pytest
+from PIL import Image
+from images import ImageNormalizer, InvalidImage
+
+def encode(image: Image.Image, image_format: str = "PNG", **kwargs) -> bytes:
+    out = BytesIO()
+    image.save(out, format=image_format, **kwargs)
+    return out.getvalue()
+
+def test_small_upright_images_are_forwarded_unchanged():
+    normalizer = ImageNormalizer(max_side=64)
+    data = encode(Image.new("RGB", (64, 32), "white"))
+    out, extension = asyncio.run(normalizer.normalize(data, "png"))
+    assert out is data and extension == "png"
+    assert (normalizer.images, normalizer.rewritten) == (1, 0)
+
+def test_large_images_are_downscaled_and_reencoded():
+    normalizer = ImageNormalizer(max_side=64, image_format="png")
+    data = encode(Image.new("RGB", (256, 128), "white"))
+    out, extension = asyncio.run(normalizer.normalize(data, "jpg"))
+    assert extension == "png"
+    assert Image.open(BytesIO(out)).size == (64, 32)
+    stats = normalizer.stats()
+    assert (stats["rewritten"], stats["pixels_in"], stats["pixels_out"]) == (1, 256 * 128, 64 * 32)
+
+def test_exif_orientation_is_applied():
+    normalizer = ImageNormalizer(max_side=1024, image_format="png")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees clockwise
+    data = encode(Image.new("RGB", (80, 40), "white"), "JPEG", exif=exif)
+    out, _ = asyncio.run(normalizer.normalize(data, "jpg"))
+    assert Image.open(BytesIO(out)).size == (40, 80)
+
+def test_disabled_normalizer_does_not_decode():
+    out, extension = asyncio.run(ImageNormalizer(enabled=False).normalize(b"not an image", "png"))
+    assert (out, extension) == (b"not an image", "png")
+
+def test_undecodable_images_are_rejected():
+    with pytest.raises(InvalidImage):
+        asyncio.run(ImageNormalizer().normalize(b"not an image", "png"))
+
+@pytest.mark.parametrize("mode", ["RGBA", "LA", "P"])
+def test_transparent_backgrounds_become_white(mode):
+    normalizer = ImageNormalizer(max_side=1024, image_format="png")
+    image = Image.new("RGBA", (40, 20), (0, 0, 0, 0))
+    image.paste((30, 60, 90, 255), (0, 0, 10, 20))
+    if mode == "P":
+        image = image.convert("RGB").quantize(colors=4)
+        data = encode(image, transparency=image.getpixel((39, 19)))
+    else:
+        data = encode(image.convert(mode))
+    out, _ = asyncio.run(normalizer.normalize(data, "png"))
+    flattened = Image.open(BytesIO(out))
+    assert flattened.mode == "RGB"
+    assert flattened.getpixel((39, 19)) == (255, 255, 255)
+    assert flattened.getpixel((0, 0)) != (255, 255, 255)
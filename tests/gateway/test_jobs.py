@@ -0,0 +1,126 @@
+import asyncio, time
+import pytest
+import db
+import jobs
+from jobs import JobQueue, JobQueueFull
+
+@pytest.fixture(scope="module", autouse=True)
+def tables():
+    db.create_db_and_tables()
+
+def run_queue(runner, scenario):
+    async def main():
+        queue = JobQueue()
+        await queue.open(runner)
+        try:
+            return await scenario(queue)
+        finally:
+            await queue.aclose()
+    return asyncio.run(main())
+
+def test_job_runs_from_queued_to_done():
+    async def runner(image, extension, query, max_new_tokens, answer_type, answer_options):
+        return f"{query} ({extension}, {max_new_tokens} tokens, {len(image)} bytes)"
+
+    async def scenario(queue):
+        job = await queue.submit(b"png", "png", "What is the trend?", 32)
+        assert job.status == "queued"
+        return await queue.wait(job.id, 5), queue.stats()
+
+    job, stats = run_queue(runner, scenario)
+    assert job.status == "done"
+    assert job.result == "What is the trend? (png, 32 tokens, 3 bytes)"
+    assert job.image is None and job.finished_at is not None
+    assert (stats["completed"], stats["failed"]) == (1, 0)
+
+def test_job_keeps_its_answer_type_and_options():
+    async def runner(image, extension, query, max_new_tokens, answer_type, answer_options):
+        return f"{answer_type} {answer_options} {max_new_tokens}"
+
+    async def scenario(queue):
+        job = await queue.submit(b"png", "png", "Which series rises?", None, "options", ["A", "A,B"])
+        stored = db.get_job(job.id)
+        return stored, await queue.wait(job.id, 5)
+
+    stored, job = run_queue(runner, scenario)
+    assert (stored.max_new_tokens, stored.answer_type, stored.answer_options) == (None, "options", ["A", "A,B"])
+    assert job.result == "options ['A', 'A,B'] None"
+
+def test_failed_job_keeps_the_error():
+    class Unavailable(Exception):
+        detail = "VLM service unavailable"
+
+    async def runner(image, extension, query, max_new_tokens, answer_type, answer_options):
+        raise Unavailable()
+
+    async def scenario(queue):
+        job = await queue.submit(b"png", "png", "What is the trend?", 32)
+        return await queue.wait(job.id, 5), queue.stats()
+
+    job, stats = run_queue(runner, scenario)
+    assert (job.status, job.error, job.result) == ("failed", "VLM service unavailable", None)
+    assert stats["failed"] == 1
+
+def test_wait_returns_the_current_state_without_timeout():
+    gate = asyncio.Event()
+
+    async def runner(image, extension, query, max_new_tokens, answer_type, answer_options):
+        await gate.wait()
+        return "It rises."
+
+    async def scenario(queue):
+        job = await queue.submit(b"png", "png", "What is the trend?", 32)
+        first = await queue.wait(job.id, 0)
+        gate.set()
+        return first, await queue.wait(job.id, 5), await queue.wait("missing", 5)
+
+    first, done, missing = run_queue(runner, scenario)
+    assert first.status in ("queued", "running")
+    assert done.status == "done"
+    assert missing is None
+
+def test_wait_wakes_up_for_a_job_finishing_while_its_status_is_read(monkeypatch):
+    gate = asyncio.Event()
+    loop = None
+    read_job = jobs.get_job
+
+    def get_job_finishing_meanwhile(job_id):
+        # the job finishes after its status was read as running, before the waiter acts on it
+        job = read_job(job_id)
+        if job is not None and job.status == "running":
+            loop.call_soon_threadsafe(gate.set)
+            while read_job(job_id).status == "running":
+                time.sleep(0.01)
+        return job
+
+    async def runner(image, extension, query, max_new_tokens, answer_type, answer_options):
+        await gate.wait()
+        return "It rises."
+
+    async def scenario(queue):
+        nonlocal loop
+        loop = asyncio.get_running_loop()
+        job = await queue.submit(b"png", "png", "What is the trend?", 32)
+        while read_job(job.id).status != "running":
+            await asyncio.sleep(0.01)
+        monkeypatch.setattr(jobs, "get_job", get_job_finishing_meanwhile)
+        start = time.monotonic()
+        job = await queue.wait(job.id, 3)
+        return job, time.monotonic() - start, dict(queue.finished)
+
+    job, seconds, waiting = run_queue(runner, scenario)
+    assert job.status == "done"
+    assert seconds < 1
+    assert waiting == {}
+
+def test_submit_refuses_jobs_beyond_the_limit(monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_MAX_PENDING", 0)
+
+    async def runner(image, extension, query, max_new_tokens, answer_type, answer_options):
+        return "It rises."
+
+    async def scenario(queue):
+        with pytest.raises(JobQueueFull):
+            await queue.submit(b"png", "png", "What is the trend?", 32)
+
+    run_queue(runner, scenario)
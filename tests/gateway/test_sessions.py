@@ -0,0 +1,76 @@
+import asyncio
+import sessions
+from sessions import SessionStore
+
+class FakeWebSocket():
+    def __init__(self, broken: bool = False):
+        self.sent = []
+        self.broken = broken
+        self.closed = None
+
+    async def send_json(self, message):
+        if self.broken:
+            raise RuntimeError("connection closed")
+        self.sent.append(message)
+
+    async def close(self, code=1000, reason=""):
+        self.closed = code
+
+def test_messages_while_detached_are_replayed_on_resume():
+    async def main():
+        store = SessionStore()
+        session, resumed = store.open("alice")
+        assert not resumed
+        first = FakeWebSocket(broken=True)
+        await session.attach(first)
+        await session.send({"n": 1})
+        await session.send({"type": "ping"}, buffer=False)
+        await session.send({"n": 2})
+        assert session.websocket is None
+
+        again, resumed = store.open("alice", session.id)
+        assert again is session and resumed
+        second = FakeWebSocket()
+        await session.attach(second)
+        assert second.sent == [{"n": 1}, {"n": 2}]
+        await session.send({"n": 3})
+        assert second.sent[-1] == {"n": 3}
+        assert (store.stats()["connects"], store.stats()["resumes"]) == (2, 1)
+    asyncio.run(main())
+
+def test_newer_connection_replaces_the_old_one():
+    async def main():
+        session, _ = SessionStore().open("alice")
+        old, new = FakeWebSocket(), FakeWebSocket()
+        await session.attach(old)
+        await session.attach(new)
+        assert old.closed == 1001 and session.websocket is new
+        session.detach(old)
+        assert session.websocket is new
+    asyncio.run(main())
+
+def test_sessions_of_other_users_are_not_resumed():
+    store = SessionStore()
+    session, _ = store.open("alice")
+    other, resumed = store.open("bob", session.id)
+    assert other is not session and not resumed
+
+def test_expired_sessions_are_purged_and_their_queries_cancelled(monkeypatch):
+    async def main():
+        store = SessionStore()
+        session, _ = store.open("alice")
+        websocket = FakeWebSocket()
+        await session.attach(websocket)
+        task = session.start(asyncio.sleep(60))
+        assert store.stats()["queries_running"] == 1
+
+        monkeypatch.setattr(sessions, "WS_RESUME_SECONDS", 0)
+        store.purge()
+        assert session.id in store.sessions
+        session.detach(websocket)
+        session.detached_at -= 1
+        store.purge()
+        assert session.id not in store.sessions
+        await asyncio.sleep(0)
+        assert task.cancelled()
+    asyncio.run(main())
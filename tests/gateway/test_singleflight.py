@@ -0,0 +1,121 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_result():
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "It rises."
+
+    async def main():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", answer) for _ in range(5)))
+        return flight, results
+
+    flight, results = asyncio.run(main())
+    assert results == ["It rises."] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 4, "cancelled": 0}
+
+def test_different_keys_and_later_calls_run_again():
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        flight = SingleFlight()
+        first = await asyncio.gather(flight.do("a", answer), flight.do("b", answer))
+        return first, await flight.do("a", answer)
+
+    first, again = asyncio.run(main())
+    assert sorted(first) == [1, 2]
+    assert again == 3
+
+def test_followers_receive_the_exception():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("VLM service unavailable")
+
+    async def main():
+        flight = SingleFlight()
+        return await asyncio.gather(*(flight.do("key", fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [str(result) for result in results] == ["VLM service unavailable"] * 3
+
+def test_leader_going_away_keeps_the_call_for_followers():
+    async def answer():
+        await asyncio.sleep(0.05)
+        return "It rises."
+
+    async def main():
+        flight = SingleFlight()
+        leader = asyncio.create_task(flight.do("key", answer))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", answer))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return flight, await follower
+
+    flight, result = asyncio.run(main())
+    assert result == "It rises."
+    assert flight.stats()["cancelled"] == 0
+
+def test_call_is_cancelled_once_every_caller_went_away():
+    started, cancelled = asyncio.Event(), []
+
+    async def answer():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        flight = SingleFlight()
+        callers = [asyncio.create_task(flight.do("key", answer)) for _ in range(2)]
+        await started.wait()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        return flight
+
+    flight = asyncio.run(main())
+    assert cancelled == [1]
+    assert flight.stats()["cancelled"] == 1 and flight.stats()["in_flight"] == 0
+
+def test_new_caller_right_after_full_cancellation_starts_a_new_call():
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            # e.g. telling the VLM service to stop takes a moment
+            await asyncio.sleep(0.01)
+            raise
+        return "It rises."
+
+    async def main():
+        flight = SingleFlight()
+        caller = asyncio.create_task(flight.do("key", answer))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        return flight, await flight.do("key", answer)
+
+    flight, result = asyncio.run(main())
+    assert result == "It rises."
+    assert len(calls) == 2
+    assert flight.stats()["in_flight"] == 0
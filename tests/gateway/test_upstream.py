@@ -0,0 +1,251 @@
+import asyncio, base64, json, time
+import httpx
+import pytest
+import upstream
+from upstream import Replica, VLMClient, VLMResponseError, VLM_EJECT_AFTER, VLM_REQUEST_TIMEOUT
+
+def open_client(handler, urls=("http://vlm:5001/vlm/generate",)) -> VLMClient:
+    client = VLMClient()
+    client.replicas = {url: Replica(url) for url in urls}
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+async def serve_http(connections: list):
+    """
+    Local HTTP/1.1 server answering every request with a JSON answer, recording one entry per connection.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connections.append(0)
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            length = next((int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:")), 0)
+            await reader.readexactly(length)
+            connections[-1] += 1
+            body = json.dumps({"text": "Yes", "model": "tiny"}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+def test_requests_reuse_the_pooled_connection():
+    connections = []
+
+    async def main():
+        server = await serve_http(connections)
+        url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/vlm/generate"
+        client = VLMClient()
+        client.replicas = {url: Replica(url)}
+        client.open()
+        # let the first health check finish, it uses the same pool
+        await asyncio.sleep(0.2)
+        responses = [await client.generate(b"png", "Is it rising?", "png", None) for _ in range(5)]
+        stats = client.pool_stats()
+        await client.aclose()
+        server.close()
+        return client, responses, stats
+
+    client, responses, stats = asyncio.run(main())
+    assert [response.json()["text"] for response in responses] == ["Yes"] * 5
+    # the probe and all five generations went over one kept-alive connection
+    assert connections == [6]
+    assert (stats["connections_open"], stats["requests_total"]) == (1, 5)
+    assert client.client is None and client.health_task is None
+
+def test_requests_need_an_open_client():
+    async def main():
+        with pytest.raises(RuntimeError, match="not open"):
+            await VLMClient().generate(b"png", "Is it rising?", "png", None)
+
+    asyncio.run(main())
+
+def test_binary_transport_posts_the_raw_image(monkeypatch):
+    monkeypatch.setattr(upstream, "VLM_TRANSPORT", "binary")
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"text": "Yes"})
+
+    asyncio.run(open_client(handler).generate(b"\x89PNG raw", "Is it rising?", "png", 16))
+    request = requests[0]
+    assert request.url.path == "/vlm/generate/raw"
+    assert request.headers["Content-Type"] == "application/octet-stream"
+    assert request.content == b"\x89PNG raw"
+    assert dict(request.url.params) == {"query": "Is it rising?", "extension": "png", "max_new_tokens": "16"}
+
+def test_json_transport_posts_the_base64_image(monkeypatch):
+    monkeypatch.setattr(upstream, "VLM_TRANSPORT", "json")
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"text": "Yes"})
+
+    asyncio.run(open_client(handler).generate(b"\x89PNG raw", "Is it rising?", "png", 16))
+    request = requests[0]
+    assert request.url.path == "/vlm/generate"
+    payload = json.loads(request.content)
+    assert base64.b64decode(payload.pop("image_b64")) == b"\x89PNG raw"
+    assert payload == {"query": "Is it rising?", "extension": "png", "max_new_tokens": 16}
+
+def test_generate_forwards_the_token_budget_only_when_set():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"text": "Yes", "model": "tiny"})
+
+    async def main():
+        client = open_client(handler)
+        await client.generate(b"png", "Is it rising?", "png", None, "binary")
+        await client.generate(b"png", "Describe it", "png", 64)
+
+    asyncio.run(main())
+    assert "max_new_tokens" not in requests[0].url.params
+    assert requests[0].url.params["answer_type"] == "binary"
+    assert requests[1].url.params["max_new_tokens"] == "64"
+    assert "answer_type" not in requests[1].url.params
+
+def test_stream_forwards_the_token_budget_only_when_set():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        body = f"data: {json.dumps({'text': 'It rises.'})}\n\nevent: done\ndata: {json.dumps({'text': 'It rises.'})}\n\n"
+        return httpx.Response(200, text=body, headers={"Content-Type": "text/event-stream"})
+
+    async def main():
+        client = open_client(handler)
+        return [event async for event in client.stream(b"png", "Describe it", "png", None)]
+
+    events = asyncio.run(main())
+    assert events == [("message", {"text": "It rises."}), ("done", {"text": "It rises."})]
+    assert requests[0].url.path.endswith("/stream")
+    assert "max_new_tokens" not in requests[0].url.params
+
+def test_server_errors_eject_the_replica():
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "bad":
+            return httpx.Response(500, text="CUDA out of memory")
+        return httpx.Response(200, json={"text": "Yes"})
+
+    async def main():
+        client = open_client(handler, ["http://bad:5001/vlm/generate", "http://good:5001/vlm/generate"])
+        bad = client.replicas["http://bad:5001/vlm/generate"]
+        # requests are spread over both replicas until the bad one is ejected
+        for _ in range(50):
+            if bad.failures >= VLM_EJECT_AFTER:
+                break
+            await client.generate(b"png", "Is it rising?", "png", None)
+        # an ejected replica gets no traffic while another one is available
+        statuses = [(await client.generate(b"png", "Is it rising?", "png", None)).status_code for _ in range(5)]
+        return client, bad, statuses
+
+    client, bad, statuses = asyncio.run(main())
+    assert not bad.available(time.monotonic())
+    assert statuses == [200] * 5
+    assert bad.errors_total == client.errors_total == VLM_EJECT_AFTER
+
+def test_client_errors_keep_the_replica():
+    async def main():
+        client = open_client(lambda request: httpx.Response(400, text="Invalid image"))
+        for _ in range(VLM_EJECT_AFTER + 1):
+            response = await client.generate(b"png", "Is it rising?", "png", None)
+            assert response.status_code == 400
+        return next(iter(client.replicas.values()))
+
+    replica = asyncio.run(main())
+    assert (replica.failures, replica.errors_total) == (0, 0)
+    assert replica.available(time.monotonic())
+
+def test_stream_server_error_counts_against_the_replica():
+    async def main():
+        client = open_client(lambda request: httpx.Response(503, text="Model is loading"))
+        with pytest.raises(VLMResponseError) as error:
+            async for _ in client.stream(b"png", "Describe it", "png", None):
+                pass
+        return client, error.value
+
+    client, error = asyncio.run(main())
+    assert error.status_code == 503
+    assert next(iter(client.replicas.values())).failures == 1
+
+def test_healthy_probe_keeps_an_ejected_replica_out():
+    def handler(request: httpx.Request) -> httpx.Response:
+        # ready, but every generation fails
+        if request.url.path == "/ready":
+            return httpx.Response(200, json={"ready": True})
+        return httpx.Response(500, text="CUDA out of memory")
+
+    async def main():
+        client = open_client(handler)
+        replica = next(iter(client.replicas.values()))
+        for _ in range(VLM_EJECT_AFTER):
+            await client.generate(b"png", "Is it rising?", "png", None)
+        ejected_until = replica.ejected_until
+        await client.check_replicas()
+        return replica, ejected_until
+
+    replica, ejected_until = asyncio.run(main())
+    assert replica.healthy and replica.ejected_until == ejected_until
+    assert replica.failures == VLM_EJECT_AFTER
+    assert not replica.available(time.monotonic())
+
+def test_probe_takes_a_replica_out_until_it_is_ready_again():
+    ready = {"value": False}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200 if ready["value"] else 503, json={"ready": ready["value"]})
+
+    async def main():
+        client = open_client(handler)
+        replica = next(iter(client.replicas.values()))
+        await client.check_replicas()
+        available = [replica.available(time.monotonic())]
+        ready["value"] = True
+        await client.check_replicas()
+        available.append(replica.available(time.monotonic()))
+        return available
+
+    assert asyncio.run(main()) == [False, True]
+
+def test_unreachable_replica_is_retried_on_the_next_one():
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "down":
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(200, json={"text": "Yes"})
+
+    async def main():
+        client = open_client(handler, ["http://down:5001/vlm/generate", "http://up:5001/vlm/generate"])
+        responses = [await client.generate(b"png", "Is it rising?", "png", None) for _ in range(4)]
+        return client, responses
+
+    client, responses = asyncio.run(main())
+    assert [r.status_code for r in responses] == [200] * 4
+    assert client.requests_in_flight == 0
+
+@pytest.mark.parametrize("deadline", [VLM_REQUEST_TIMEOUT, 0])
+def test_requests_carry_the_total_deadline(monkeypatch, deadline):
+    monkeypatch.setattr(upstream, "VLM_REQUEST_TIMEOUT", deadline)
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path.endswith("/stream"):
+            return httpx.Response(200, text="event: done\ndata: {}\n\n", headers={"Content-Type": "text/event-stream"})
+        return httpx.Response(200, json={"text": "Yes"})
+
+    async def main():
+        client = open_client(handler)
+        await client.generate(b"png", "Is it rising?", "png", None)
+        return [event async for event in client.stream(b"png", "Describe it", "png", None)]
+
+    asyncio.run(main())
+    if deadline:
+        assert [float(request.headers["X-Request-Timeout"]) for request in requests] == [deadline] * 2
+    else:
+        assert not any("X-Request-Timeout" in request.headers for request in requests)
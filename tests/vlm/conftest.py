@@ -0,0 +1,80 @@
+import pytest
+from PIL import Image
+
+try:
+    import torch, transformers
+except Exception as e:
+    # a partly installed torch fails with other errors than ImportError, skip the vlm tests either way
+    pytest.skip(f"torch and transformers are not usable: {e!r}", allow_module_level=True)
+
+SPECIALS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<img>", "</img>", "<IMG_CONTEXT>", "<video>"]
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{% if message['content'] is string %}{{ message['content'] }}{% else %}"
+    "{% for content in message['content'] %}{% if content['type'] == 'image' %}<IMG_CONTEXT>\n{% elif content['type'] == 'text' %}{{ content['text'] }}{% endif %}{% endfor %}{% endif %}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+def build_tiny_model(path, hidden_size: int = 64, seed: int = 0):
+    """
+    Save a randomly initialized InternVL model of a few hundred KB with its processor.
+
+    Args:
+        path (Path): Directory the model and processor are saved to.
+        hidden_size (int): Hidden size of the language model, a smaller one makes a draft model.
+        seed (int): Seed of the random weights.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import PreTrainedTokenizerFast, InternVLConfig, InternVLForConditionalGeneration, InternVLProcessor, GotOcr2ImageProcessorFast
+    from transformers.models.internvl.video_processing_internvl import InternVLVideoProcessor
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    text = ["You are an assistant that describes images for blind users. Yes No The chart shows a rising trend of 0.93 percent. A B C D. What is the label of the y axis?"] * 50
+    tokenizer.train_from_iterator(text, trainers.BpeTrainer(vocab_size=400, special_tokens=SPECIALS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token="<|im_end|>", pad_token="<|endoftext|>", model_input_names=["input_ids", "attention_mask"],
+        extra_special_tokens={"start_image_token": "<img>", "end_image_token": "</img>", "context_image_token": "<IMG_CONTEXT>", "video_token": "<video>"},
+    )
+    processor = InternVLProcessor(
+        image_processor=GotOcr2ImageProcessorFast(size={"height": 28, "width": 28}, crop_to_patches=True, max_patches=4, min_patches=1),
+        tokenizer=tokenizer,
+        video_processor=InternVLVideoProcessor(size={"height": 28, "width": 28}),
+        image_seq_length=1,
+        chat_template=CHAT_TEMPLATE,
+    )
+    config = InternVLConfig(
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_attention_heads=2, num_hidden_layers=2, image_size=[28, 28], patch_size=[14, 14]),
+        text_config=dict(model_type="qwen2", hidden_size=hidden_size, intermediate_size=2 * hidden_size, num_attention_heads=4, num_key_value_heads=2,
+                         num_hidden_layers=2, vocab_size=len(tokenizer), max_position_embeddings=4096, tie_word_embeddings=False),
+        image_token_id=tokenizer.convert_tokens_to_ids("<IMG_CONTEXT>"),
+        downsample_ratio=0.5,
+    )
+    config.text_config.eos_token_id = tokenizer.eos_token_id
+    config.text_config.pad_token_id = tokenizer.pad_token_id
+    torch.manual_seed(seed)
+    model = InternVLForConditionalGeneration(config)
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.save_pretrained(path)
+    processor.save_pretrained(path)
+    return path
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    return str(build_tiny_model(tmp_path_factory.mktemp("tiny_model")))
+
+@pytest.fixture(scope="session")
+def draft_model_path(tmp_path_factory):
+    return str(build_tiny_model(tmp_path_factory.mktemp("draft_model"), hidden_size=48, seed=1))
+
+@pytest.fixture(scope="session")
+def tiny_vlm(tiny_model_path):
+    from vlm.app.model import VisualLanguageModelForCharts
+    model = VisualLanguageModelForCharts()
+    model.load_model(tiny_model_path, True)
+    return model
+
+@pytest.fixture
+def charts():
+    return [Image.new("RGB", (60 + i * 350, 40 + i * 190), (i * 40, 100, 200)) for i in range(3)]
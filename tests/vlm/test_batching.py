@@ -0,0 +1,108 @@
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from vlm.app.batching import MicroBatcher
+from vlm.app.cancellation import Cancellations, Cancelled
+
+QUESTIONS = ["What is the trend?", "Which bar is highest in the whole chart?", "How many?"]
+
+class RecordingModel():
+    """
+    Batch runner answering with the prompt and recording the batches it ran.
+    """
+    def __init__(self, fail_on: str | None = None):
+        self.batches = []
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+
+    def run_batch(self, prompts, dynamic_prompt, charts, max_new_tokens, answer_kinds, cancels):
+        with self.lock:
+            self.batches.append((list(prompts), dynamic_prompt))
+        if self.fail_on in prompts:
+            raise ValueError(f"cannot answer {self.fail_on}")
+        return [f"{dynamic_prompt}{prompt}" for prompt in prompts]
+
+def submit_all(batcher, requests):
+    with ThreadPoolExecutor(len(requests)) as pool:
+        futures = [pool.submit(batcher.submit, prompt, dynamic_prompt, None, 8) for prompt, dynamic_prompt in requests]
+        return [future.exception() or future.result() for future in futures]
+
+def test_concurrent_requests_share_batches_by_dynamic_prompt():
+    model = RecordingModel()
+    batcher = MicroBatcher(model.run_batch, window=0.2, max_batch_size=4)
+    batcher.start()
+    try:
+        answers = submit_all(batcher, [("a", ""), ("b", " cot"), ("c", ""), ("d", " cot"), ("e", "")])
+    finally:
+        batcher.stop()
+    assert answers == ["a", " cotb", "c", " cotd", "e"]
+    assert sorted((sorted(prompts), dynamic) for prompts, dynamic in model.batches) == [(["a", "c", "e"], ""), (["b", "d"], " cot")]
+    assert batcher.stats()["batch_size_max"] == 3
+
+def test_failing_batch_is_retried_one_by_one():
+    model = RecordingModel(fail_on="bad")
+    batcher = MicroBatcher(model.run_batch, window=0.2, max_batch_size=4)
+    batcher.start()
+    try:
+        answers = submit_all(batcher, [("a", ""), ("bad", ""), ("c", "")])
+    finally:
+        batcher.stop()
+    assert answers[0] == "a" and answers[2] == "c"
+    assert isinstance(answers[1], ValueError)
+
+def test_requests_cancelled_while_queued_are_dropped():
+    model = RecordingModel()
+    batcher = MicroBatcher(model.run_batch, window=0.01, max_batch_size=4)
+    cancel = Cancellations().token()
+    cancel.cancel("disconnect")
+    batcher.start()
+    try:
+        with pytest.raises(Cancelled):
+            batcher.submit("a", "", None, 8, cancel=cancel)
+        assert batcher.submit("b", "", None, 8) == "b"
+    finally:
+        batcher.stop()
+    assert model.batches == [(["b"], "")]
+    assert batcher.stats()["cancelled"] == 1
+
+def test_stop_fails_requests_left_behind():
+    model = RecordingModel()
+    batcher = MicroBatcher(model.run_batch, window=5, max_batch_size=4)
+    batcher.start()
+    results = {}
+
+    def submit(prompt, dynamic_prompt):
+        try:
+            results[prompt] = batcher.submit(prompt, dynamic_prompt, None, 8)
+        except Exception as e:
+            results[prompt] = e
+
+    threads = [threading.Thread(target=submit, args=("a", ""), daemon=True)]
+    threads[0].start()
+    # collected first, the batch then waits out its window
+    time.sleep(0.2)
+    # deferred to the next batch, which never runs
+    threads.append(threading.Thread(target=submit, args=("b", " cot"), daemon=True))
+    threads[1].start()
+    while not batcher.deferred:
+        time.sleep(0.01)
+    batcher.stop()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert results["a"] == "a"
+    assert isinstance(results.get("b"), RuntimeError)
+    with pytest.raises(RuntimeError, match="stopped"):
+        batcher.submit("c", "", None, 8)
+
+def test_batched_answers_match_single_answers(tiny_vlm, charts):
+    expected = [tiny_vlm.run_vlm(question, "", chart, 20) for question, chart in zip(QUESTIONS, charts)]
+    batcher = MicroBatcher(tiny_vlm.run_vlm_batch, window=0.2, max_batch_size=4)
+    batcher.start()
+    try:
+        with ThreadPoolExecutor(len(QUESTIONS)) as pool:
+            answers = list(pool.map(lambda args: batcher.submit(args[0], "", args[1], 20), zip(QUESTIONS, charts)))
+    finally:
+        batcher.stop()
+    assert answers == expected
+    assert batcher.stats()["batch_size_max"] > 1
@@ -0,0 +1,52 @@
+import pytest
+from transformers import AutoTokenizer
+from vlm.app.budgets import AnswerBudgets, DEFAULT_TOKEN_BUDGETS
+
+def test_free_descriptions_span_lines():
+    budgets = AnswerBudgets()
+    text = "The chart shows a rising trend.\n\nThe largest bar is B.\n"
+    assert budgets.end("free", text) is None
+    assert budgets.trim("free", text) == text
+    assert "".join(budgets.trim_stream("free", text.split(" "))) == "".join(text.split(" "))
+
+@pytest.mark.parametrize("kind", ["binary", "options", "short", "unanswerable"])
+def test_short_answers_end_at_sentence_or_line_end(kind):
+    budgets = AnswerBudgets()
+    assert budgets.end(kind, "Yes") is None
+    assert budgets.trim(kind, "\nYes. It rises.") == "\nYes."
+    assert budgets.trim(kind, "0.93\nmore") == "0.93"
+    assert list(budgets.trim_stream(kind, ["Ye", "s\nNo", "pe"])) == ["Ye", "s"]
+
+def test_max_new_tokens_falls_back_to_the_budget_of_the_kind():
+    budgets = AnswerBudgets({"binary": 4})
+    assert budgets.max_new_tokens("binary") == 4
+    assert budgets.max_new_tokens("free") == DEFAULT_TOKEN_BUDGETS["free"]
+    assert budgets.max_new_tokens("free", 12) == 12
+
+def test_unknown_kind_is_rejected():
+    with pytest.raises(ValueError):
+        AnswerBudgets({"essay": 512})
+
+def test_record_counts_stopped_and_exhausted_answers():
+    budgets = AnswerBudgets()
+    budgets.record("short", 3, 24, True)
+    budgets.record("short", 24, 24, False)
+    stats = budgets.stats()["short"]
+    assert (stats["answers"], stats["generated_max"], stats["stopped"], stats["exhausted"]) == (2, 24, 1, 1)
+    assert stats["generated_avg"] == 13.5
+
+ANSWERS = ["\n\nYes. It rises", "0.93\nmore", "The trend rises!\n", "  \n Yes\nNo", "Yes    \nNo", "A,B", "No... B? C. D"]
+
+@pytest.mark.parametrize("step", [1, 3])
+@pytest.mark.parametrize("kind", ["short", "free"])
+def test_answer_end_decoding_new_tokens_matches_decoding_all(tiny_model_path, kind, step):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    budgets = AnswerBudgets()
+    for answer in ANSWERS:
+        ids = tokenizer.encode(answer, add_special_tokens=False)
+        end = budgets.answer_end(tokenizer, kind)
+        for n in range(step, len(ids) + step, step):
+            expected = budgets.end(kind, tokenizer.decode(ids[:n], skip_special_tokens=True)) is not None
+            assert end(ids[:n]) == expected, (answer, n)
+            if expected:
+                break
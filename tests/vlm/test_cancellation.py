@@ -0,0 +1,43 @@
+import time
+import pytest
+from vlm.app.cancellation import Cancellations, CancelToken, Cancelled
+
+def test_token_times_out_after_its_deadline():
+    token = Cancellations().token(timeout=0.05)
+    assert not token.cancelled
+    time.sleep(0.06)
+    assert token.cancelled and token.reason == "timeout"
+
+def test_first_reason_is_kept():
+    token = Cancellations().token()
+    token.cancel("disconnect")
+    token.cancel("timeout")
+    assert token.reason == "disconnect"
+
+def test_cancellation_is_recorded_once():
+    cancellations = Cancellations()
+    token = cancellations.token()
+    token.cancel("disconnect")
+    token.start()
+    assert isinstance(token.stopped(3, 24), Cancelled)
+    token.stopped(5, 24)
+    stats = cancellations.stats()["disconnect"]
+    assert (stats["requests"], stats["generated"], stats["saved_tokens"], stats["queued"]) == (1, 3, 21, 0)
+
+def test_unbound_token_is_recorded_by_the_model_it_is_bound_to():
+    default, named = Cancellations(), Cancellations()
+    token = CancelToken(timeout=30)
+    token.cancel("disconnect")
+    named.bind(token)
+    token.stopped(0, 8)
+    assert named.stats()["disconnect"]["requests"] == 1
+    assert default.stats()["disconnect"]["requests"] == 0
+
+def test_cancelled_request_stops_generation(tiny_vlm, charts):
+    token = tiny_vlm.cancellations.bind(CancelToken(timeout=30))
+    token.cancel("timeout")
+    before = tiny_vlm.cancellations.stats()["timeout"]["requests"]
+    with pytest.raises(Cancelled) as error:
+        tiny_vlm.run_vlm("What is the trend?", "", charts[0], 30, cancel=token)
+    assert error.value.reason == "timeout"
+    assert tiny_vlm.cancellations.stats()["timeout"]["requests"] == before + 1
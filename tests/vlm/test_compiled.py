@@ -0,0 +1,26 @@
+import pytest
+from vlm.app.model import VisualLanguageModelForCharts
+
+@pytest.fixture(scope="module")
+def compiled_vlm(tiny_model_path, tmp_path_factory):
+    model = VisualLanguageModelForCharts()
+    model.load_model(tiny_model_path, True, compile=True, compile_max_tokens=256, compile_cache_dir=str(tmp_path_factory.mktemp("compile_cache")))
+    return model
+
+@pytest.mark.parametrize("answer_kind", ["free", "short"])
+def test_answers_match_greedy_generate(tiny_vlm, compiled_vlm, charts, answer_kind):
+    for chart in charts:
+        for dynamic_prompt in ["", " cot"]:
+            expected = tiny_vlm.run_vlm("What is the trend?", dynamic_prompt, chart, 30, answer_kind)
+            assert compiled_vlm.run_vlm("What is the trend?", dynamic_prompt, chart, 30, answer_kind) == expected
+
+def test_stream_matches_greedy_stream(tiny_vlm, compiled_vlm, charts):
+    expected = list(tiny_vlm.stream_vlm("Which bar is highest?", "", charts[1], 30))
+    assert list(compiled_vlm.stream_vlm("Which bar is highest?", "", charts[1], 30)) == expected
+
+def test_prompts_beyond_the_static_cache_decode_eagerly(tiny_vlm, compiled_vlm, charts):
+    before = compiled_vlm.compiled.stats()
+    expected = tiny_vlm.run_vlm("What is the trend?", "", charts[2], 1000)
+    assert compiled_vlm.run_vlm("What is the trend?", "", charts[2], 1000) == expected
+    after = compiled_vlm.compiled.stats()
+    assert (after["sequences"], after["fallbacks"]) == (before["sequences"], before["fallbacks"] + 1)
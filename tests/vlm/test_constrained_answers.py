@@ -0,0 +1,36 @@
+import torch
+from vlm.app.prompt_utils import UNANSWERABLE_ANSWER, answer_kind, build_answer_options
+
+@torch.inference_mode()
+def score(vlm, question, chart, candidate):
+    # one candidate at a time, without the batched and padded scoring of `choose_answer`
+    inputs = vlm.embed_inputs(question, "", chart)
+    answer_prefix = vlm.model.get_input_embeddings()(torch.tensor([vlm.answer_prefix_ids], device=vlm.device))
+    inputs["inputs_embeds"] = torch.cat([inputs["inputs_embeds"], answer_prefix], dim=1)
+    cache, logits = vlm.prefill(inputs)
+    ids = vlm.processor.tokenizer.encode(candidate, add_special_tokens=False) + [min(vlm.eos_ids)]
+    total = float(logits.log_softmax(-1)[ids[0]])
+    if len(ids) > 1:
+        log_probs = vlm.model(input_ids=torch.tensor([ids[:-1]], device=vlm.device), past_key_values=cache, use_cache=True).logits[0].log_softmax(-1)
+        total += float(log_probs[torch.arange(len(ids) - 1), ids[1:]].sum())
+    return total
+
+def test_binary_and_option_questions_get_fixed_answers():
+    assert build_answer_options({"qa_pair_type": "closed-ended finite answer set binary visual"}) == ["Yes", "No", UNANSWERABLE_ANSWER]
+    entry = {"qa_pair_type": "closed-ended finite answer set non-binary visual", "answer_options": "[{'A': '1'}, {'B': '2'}, {'C': None}]"}
+    assert build_answer_options(entry) == ["A", "B", "A,B", UNANSWERABLE_ANSWER]
+    assert answer_kind(entry) == "options"
+    assert build_answer_options({"qa_pair_type": "closed-ended infinite answer set visual"}) is None
+    assert build_answer_options({}) is None
+
+def test_unanswerable_questions_are_left_to_generation():
+    entry = {"qa_pair_type": "unanswerable"}
+    assert build_answer_options(entry) is None
+    assert answer_kind(entry) == "unanswerable"
+
+def test_choose_answer_picks_the_most_likely_candidate(tiny_vlm, charts):
+    candidates = ["Yes", "No", "A", "A,B", UNANSWERABLE_ANSWER]
+    for question, chart in zip(["Is it rising?", "Which options apply?", "What is shown?"], charts):
+        scores = [score(tiny_vlm, question, chart, candidate) for candidate in candidates]
+        expected = candidates[max(range(len(candidates)), key=scores.__getitem__)]
+        assert tiny_vlm.choose_answer(question, "", chart, candidates) == expected
@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from vlm.app.cancellation import Cancelled
+from vlm.app.engine import ContinuousBatchingEngine
+
+QUESTIONS = ["What is the trend?", "Which bar is highest in the whole chart?", "How many?", "Is it rising?"]
+
+@pytest.fixture(params=[256, 8], ids=["whole_prefill", "chunked_prefill"])
+def engine(request, tiny_vlm):
+    engine = ContinuousBatchingEngine(tiny_vlm, max_batch_size=3, prefill_chunk=request.param)
+    engine.start()
+    yield engine
+    engine.stop()
+
+def test_concurrent_answers_match_single_answers(tiny_vlm, engine, charts):
+    requests = [(question, charts[i % len(charts)], budget, kind) for i, (question, budget, kind) in enumerate(zip(QUESTIONS, [30, 5, 17, 30], ["free", "free", "short", "short"]))]
+    expected = [tiny_vlm.run_vlm(question, "", chart, budget, kind) for question, chart, budget, kind in requests]
+    with ThreadPoolExecutor(len(requests)) as pool:
+        answers = list(pool.map(lambda r: engine.generate(r[0], "", r[1], r[2], r[3]), requests))
+    assert answers == expected
+    stats = engine.stats()
+    assert stats["finished"] == len(requests) and stats["decode_batch_avg"] > 1
+
+def test_stream_matches_single_stream(tiny_vlm, engine, charts):
+    expected = list(tiny_vlm.stream_vlm(QUESTIONS[1], "", charts[2], 30))
+    assert list(engine.stream(QUESTIONS[1], "", charts[2], 30)) == expected
+
+def test_cancelled_sequence_is_dropped(tiny_vlm, engine, charts):
+    cancel = tiny_vlm.cancellations.token()
+    cancel.cancel("disconnect")
+    with pytest.raises(Cancelled):
+        engine.generate(QUESTIONS[0], "", charts[0], 30, cancel=cancel)
+    assert engine.stats()["cancelled"] == 1
+    # the engine keeps serving
+    assert engine.generate(QUESTIONS[0], "", charts[0], 5) == tiny_vlm.run_vlm(QUESTIONS[0], "", charts[0], 5)
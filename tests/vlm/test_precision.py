@@ -0,0 +1,39 @@
+import pytest
+import torch
+from vlm.app.model import VisualLanguageModelForCharts
+
+@pytest.fixture(scope="module")
+def int8_vlm(tiny_model_path):
+    model = VisualLanguageModelForCharts()
+    model.load_model(tiny_model_path, True, precision="int8")
+    return model
+
+def test_int8_quantizes_the_language_model_only(int8_vlm):
+    quantized = torch.ao.nn.quantized.dynamic.Linear
+    assert int8_vlm.precision == "int8"
+    assert all(not isinstance(module, torch.nn.Linear) for module in int8_vlm.model.language_model.modules())
+    assert isinstance(int8_vlm.model.get_output_embeddings(), quantized)
+    assert any(isinstance(module, torch.nn.Linear) for module in int8_vlm.model.vision_tower.modules())
+
+def test_int8_holds_less_memory_than_fp32(tiny_vlm, int8_vlm):
+    assert int8_vlm.model_bytes() < tiny_vlm.model_bytes()
+
+def test_int8_still_answers(int8_vlm, charts):
+    assert isinstance(int8_vlm.run_vlm("What is the trend?", "", charts[0], 10), str)
+    assert all(isinstance(chunk, str) for chunk in int8_vlm.stream_vlm("What is the trend?", "", charts[1], 10))
+    assert int8_vlm.choose_answer("Is it rising?", "", charts[2], ["Yes", "No"]) in ("Yes", "No")
+
+def test_int8_shares_vision_features_with_fp32(tiny_vlm, int8_vlm):
+    # the vision tower stays in fp32, so its cached features are valid for both
+    assert int8_vlm.vision_settings == tiny_vlm.vision_settings
+
+def test_bf16_loads_in_bf16_or_falls_back(tiny_model_path, charts):
+    model = VisualLanguageModelForCharts()
+    model.load_model(tiny_model_path, True, precision="bf16")
+    dtype = {"bf16": torch.bfloat16, "fp32": torch.float32}[model.precision]
+    assert model.model.dtype == dtype
+    assert isinstance(model.run_vlm("What is the trend?", "", charts[0], 10), str)
+
+def test_unknown_precision_is_rejected(tiny_model_path):
+    with pytest.raises(ValueError, match="Unknown precision"):
+        VisualLanguageModelForCharts().load_model(tiny_model_path, True, precision="int4")
@@ -0,0 +1,34 @@
+import torch
+from vlm.app.model import VisualLanguageModelForCharts
+from vlm.app.prefix_cache import PrefixCache
+
+def kv(value: float):
+    return ((torch.full((1, 2, 3, 4), value), torch.full((1, 2, 3, 4), value)),)
+
+def test_least_recently_used_prefix_is_evicted():
+    cache = PrefixCache(max_entries=2)
+    cache.put((1, 2), kv(1))
+    cache.put((1, 3), kv(2))
+    assert cache.get((1, 2)) is not None
+    cache.put((1, 4), kv(3))
+    assert cache.get((1, 3)) is None
+    assert torch.equal(cache.get((1, 2))[0][0], kv(1)[0][0])
+    stats = cache.stats()
+    assert (stats["entries"], stats["lookups"], stats["hits"], stats["saved_prefill_tokens"], stats["computed_prefix_tokens"]) == (2, 3, 2, 4, 6)
+
+def test_disabled_cache_stores_nothing():
+    cache = PrefixCache(max_entries=0)
+    cache.put((1, 2), kv(1))
+    assert cache.get((1, 2)) is None
+
+def test_cached_prefixes_give_the_same_answers(tiny_model_path, charts):
+    uncached = VisualLanguageModelForCharts()
+    uncached.load_model(tiny_model_path, True, prefix_cache_size=0)
+    cached = VisualLanguageModelForCharts()
+    cached.load_model(tiny_model_path, True, prefix_cache_size=2)
+
+    for chart in charts:
+        for dynamic_prompt in ["", " cot", " Think step by step."]:
+            assert cached.run_vlm("What is the trend?", dynamic_prompt, chart, 12) == uncached.run_vlm("What is the trend?", dynamic_prompt, chart, 12)
+    stats = cached.prefix_cache.stats()
+    assert stats["entries"] == 2 and stats["hits"] > 0
@@ -0,0 +1,103 @@
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from vlm.app.registry import ModelRegistry, ServedModel
+
+class FakeModel():
+    def __init__(self, size: int):
+        self.size = size
+
+    def model_bytes(self) -> int:
+        return self.size
+
+class Loader():
+    """
+    Loads fake models of 100 bytes, counting loads per name.
+    """
+    def __init__(self, seconds: float = 0.0):
+        self.seconds = seconds
+        self.loads = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name: str) -> ServedModel:
+        with self.lock:
+            self.loads.append(name)
+        time.sleep(self.seconds)
+        return ServedModel(name, FakeModel(100), "none")
+
+def registry_with_default(loader: Loader, budget_bytes: int) -> ModelRegistry:
+    registry = ModelRegistry(loader, "default", budget_bytes)
+    registry.add(ServedModel("default", FakeModel(100), "none"), pinned=True)
+    return registry
+
+def use(registry: ModelRegistry, name: str | None = None) -> str:
+    with registry.use(name) as served:
+        return served.name
+
+def test_concurrent_requests_share_one_load():
+    loader = Loader(seconds=0.05)
+    registry = registry_with_default(loader, 1000)
+    with ThreadPoolExecutor(6) as pool:
+        names = list(pool.map(lambda _: use(registry, "other"), range(6)))
+    assert names == ["other"] * 6
+    assert loader.loads == ["other"]
+    assert registry.stats()["loads"] == 1
+
+def test_least_recently_used_models_are_evicted_beyond_the_budget():
+    loader = Loader()
+    registry = registry_with_default(loader, 300)
+    for name in ["a", "b", "a", "c"]:
+        use(registry, name)
+    resident = [model["model"] for model in registry.resident()]
+    assert sorted(resident) == ["a", "c", "default"]
+    assert registry.stats()["evictions"] == 1
+    assert use(registry) == "default"
+
+def test_zero_budget_keeps_only_the_pinned_and_the_latest_model():
+    loader = Loader()
+    registry = registry_with_default(loader, 0)
+    use(registry, "a")
+    use(registry, "b")
+    assert sorted(model["model"] for model in registry.resident()) == ["b", "default"]
+
+def test_models_in_use_are_not_evicted():
+    loader = Loader()
+    registry = registry_with_default(loader, 0)
+    with registry.use("a"):
+        use(registry, "b")
+        assert sorted(model["model"] for model in registry.resident()) == ["a", "b", "default"]
+    use(registry, "c")
+    assert "a" not in [model["model"] for model in registry.resident()]
+
+def test_failed_load_is_raised_and_can_be_retried():
+    attempts = []
+
+    def load(name):
+        attempts.append(name)
+        if len(attempts) == 1:
+            raise OSError("model not found")
+        return ServedModel(name, FakeModel(100), "none")
+
+    registry = ModelRegistry(load, "default", 1000)
+    with pytest.raises(OSError):
+        use(registry, "a")
+    assert use(registry, "a") == "a"
+
+def test_replaced_default_is_retired_after_its_requests():
+    loader = Loader()
+    registry = registry_with_default(loader, 1000)
+    new = ServedModel("new", FakeModel(100), "none")
+    retired = threading.Event()
+    with registry.use() as old:
+        replaced = registry.replace_default(new)
+        assert replaced == [old]
+        # new requests go to the new default while the old one still answers
+        assert use(registry) == "new"
+        thread = threading.Thread(target=lambda: (registry.retire(old, poll=0.01), retired.set()))
+        thread.start()
+        time.sleep(0.05)
+        assert not retired.is_set()
+    thread.join(1)
+    assert retired.is_set()
+    assert registry.stats()["default"] == "new"
+    assert [model["model"] for model in registry.resident()] == ["new"]
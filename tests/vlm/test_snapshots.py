@@ -0,0 +1,34 @@
+import json, os
+import torch
+from vlm.app import snapshots
+from vlm.app.model import VisualLanguageModelForCharts
+from vlm.app.snapshots import ModelSnapshots, SNAPSHOT_INFO, model_dirname
+
+def test_model_dirname_flattens_paths():
+    assert model_dirname("OpenGVLab/InternVL3-1B-hf") == "OpenGVLab--InternVL3-1B-hf"
+    assert model_dirname("/models/tiny model/") == "models--tiny--model"
+
+def test_incomplete_or_outdated_snapshots_are_not_found(tmp_path, monkeypatch):
+    store = ModelSnapshots(str(tmp_path))
+    path = store.path("org/model", torch.float32)
+    assert path.endswith(os.path.join("org--model", "float32"))
+    os.makedirs(path)
+    assert store.find("org/model", torch.float32) is None
+    with open(os.path.join(path, SNAPSHOT_INFO), "w") as f:
+        json.dump({"transformers": "0.0.1"}, f)
+    assert store.find("org/model", torch.float32) is None
+    monkeypatch.setattr(snapshots.transformers, "__version__", "0.0.1")
+    assert store.find("org/model", torch.float32) == path
+
+def test_model_loads_the_same_from_its_snapshot(tiny_vlm, tiny_model_path, tmp_path, charts):
+    first = VisualLanguageModelForCharts()
+    first.load_model(tiny_model_path, True, snapshot_dir=str(tmp_path))
+    assert "write_snapshot" in first.startup.stats()["phases"]
+
+    second = VisualLanguageModelForCharts()
+    second.load_model(tiny_model_path, True, snapshot_dir=str(tmp_path))
+    assert "weights_snapshot" in second.startup.stats()["phases"]
+    assert [name for name in os.listdir(tmp_path / model_dirname(tiny_model_path))] == ["float32"]
+
+    expected = tiny_vlm.run_vlm("What is the trend?", "", charts[0], 20)
+    assert second.run_vlm("What is the trend?", "", charts[0], 20) == expected
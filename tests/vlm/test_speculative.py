@@ -0,0 +1,56 @@
+import pytest
+import torch
+from vlm.app.model import VisualLanguageModelForCharts
+
+QUESTIONS = ["What is the trend?", "Which bar is highest in the whole chart?", "How many?"]
+
+class RecordingStreamer():
+    def __init__(self):
+        self.puts = []
+        self.ended = False
+
+    def put(self, value):
+        self.puts.append(value.reshape(-1).tolist())
+
+    def end(self):
+        self.ended = True
+
+@pytest.fixture(scope="module", params=["self", "draft"])
+def speculative_vlm(request, tiny_model_path, draft_model_path):
+    # the model drafting for itself accepts every proposal, the small random draft hardly any
+    model = VisualLanguageModelForCharts()
+    model.load_model(tiny_model_path, True, draft_model_path=tiny_model_path if request.param == "self" else draft_model_path, draft_tokens=4)
+    return model
+
+@pytest.mark.parametrize("max_new_tokens", [1, 2, 7, 30])
+def test_answers_match_greedy_generate(tiny_vlm, speculative_vlm, charts, max_new_tokens):
+    for question, chart in zip(QUESTIONS, charts):
+        for dynamic_prompt in ["", " cot"]:
+            expected = tiny_vlm.run_vlm(question, dynamic_prompt, chart, max_new_tokens)
+            assert speculative_vlm.run_vlm(question, dynamic_prompt, chart, max_new_tokens) == expected
+
+def test_streamer_receives_every_generated_token(speculative_vlm, charts):
+    inputs = speculative_vlm.embed_inputs(QUESTIONS[1], "", charts[2])
+    draft_inputs = speculative_vlm.draft.embed_inputs(QUESTIONS[1], "", charts[2])
+    streamer = RecordingStreamer()
+
+    ids = speculative_vlm.speculative.generate(inputs, draft_inputs, 30, streamer)
+
+    # the first put is the empty prompt, like with `model.generate`
+    assert streamer.puts[0] == []
+    assert [t for put in streamer.puts[1:] for t in put] == ids
+    assert streamer.ended
+
+def test_stream_matches_answer(tiny_vlm, speculative_vlm, charts):
+    expected = list(tiny_vlm.stream_vlm(QUESTIONS[1], "", charts[2], 30))
+    assert list(speculative_vlm.stream_vlm(QUESTIONS[1], "", charts[2], 30)) == expected
+
+def test_stats_count_generated_tokens(tiny_model_path, charts):
+    model = VisualLanguageModelForCharts()
+    model.load_model(tiny_model_path, True, draft_model_path=tiny_model_path, draft_tokens=4)
+    inputs = model.embed_inputs(QUESTIONS[0], "", charts[0])
+    ids = model.speculative.generate(inputs, model.draft.embed_inputs(QUESTIONS[0], "", charts[0]), 12)
+
+    stats = model.speculative.stats()
+    assert stats["generated"] == len(ids)
+    assert stats["accepted"] == stats["proposed"]
@@ -0,0 +1,15 @@
+import pytest
+
+QUESTIONS = ["What is the trend?", "Which bar is highest in the whole chart?"]
+
+def test_pieces_are_regrouped_into_sentences(tiny_vlm):
+    pieces = ["The tre", "nd rises. The la", "rgest bar", " is B!\n", "\nIt ends", " here"]
+    assert list(tiny_vlm.to_sentences(pieces)) == ["The trend rises.", "The largest bar is B!", "It ends here"]
+    assert list(tiny_vlm.to_sentences(["", "  \n"])) == []
+
+@pytest.mark.parametrize("max_new_tokens", [1, 9, 30])
+def test_streamed_sentences_make_up_the_answer(tiny_vlm, charts, max_new_tokens):
+    for question, chart in zip(QUESTIONS, charts):
+        sentences = list(tiny_vlm.stream_vlm(question, "", chart, max_new_tokens))
+        expected = tiny_vlm.run_vlm(question, "", chart, max_new_tokens)
+        assert " ".join(sentences).split() == expected.split()
@@ -0,0 +1,36 @@
+import os
+from vlm.app.swap import SwapStatus
+
+def test_swap_moves_through_its_states():
+    swap = SwapStatus()
+    assert swap.stats() == {"state": "idle"}
+    assert swap.begin("tiny", "int8", "base")
+    swap.update("starting_workers")
+    swap.update("draining", phases={"weights": 1.5})
+    running = swap.stats()
+    swap.update("done")
+    done = swap.stats()
+    assert (running["state"], running["model"], running["precision"], running["previous"]) == ("draining", "tiny", "int8", "base")
+    assert running["phases"] == {"weights": 1.5}
+    assert done["state"] == "done" and done["seconds"] >= 0
+
+def test_only_one_swap_runs_at_a_time():
+    swap = SwapStatus()
+    assert swap.begin("tiny", None, "base")
+    assert not swap.begin("other", None, "base")
+    swap.update("failed", error="OSError('model not found')")
+    assert swap.stats()["error"] == "OSError('model not found')"
+    # a failed swap can be retried
+    assert swap.begin("other", None, "base")
+
+def test_status_is_shared_with_forked_processes():
+    swap = SwapStatus()
+    pid = os.fork()
+    if pid == 0:
+        ok = swap.begin("tiny", None, "base")
+        swap.update("starting_workers")
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert swap.stats()["state"] == "starting_workers"
+    assert not swap.begin("other", None, "base")
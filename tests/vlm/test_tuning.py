@@ -0,0 +1,30 @@
+import json
+import pytest
+from vlm.app.tuning import best_settings, load_tuning, save_tuning
+
+RESULTS = [
+    {"WORKERS": 1, "THREADS_PER_WORKER": 8, "INTEROP_THREADS": 1, "THREADPOOL_SIZE": 4, "CPU_AFFINITY": "none", "p50_ms": 900, "p95_ms": 1500, "requests_per_second": 1.1},
+    {"WORKERS": 4, "THREADS_PER_WORKER": 2, "INTEROP_THREADS": 1, "THREADPOOL_SIZE": 4, "CPU_AFFINITY": "cores", "p50_ms": 1400, "p95_ms": 1700, "requests_per_second": 2.9},
+    {"WORKERS": 2, "THREADS_PER_WORKER": 4, "INTEROP_THREADS": 1, "THREADPOOL_SIZE": 4, "CPU_AFFINITY": "cores", "p50_ms": 1000, "p95_ms": 1200, "requests_per_second": 2.0},
+    {"WORKERS": 8, "THREADS_PER_WORKER": 1, "INTEROP_THREADS": 1, "THREADPOOL_SIZE": 4, "CPU_AFFINITY": "cores", "error": "out of memory"},
+]
+
+def test_best_settings_per_objective():
+    best = best_settings(RESULTS)
+    assert (best["p50"]["WORKERS"], best["p95"]["WORKERS"], best["throughput"]["WORKERS"]) == (1, 2, 4)
+    assert set(best["p95"]) == {"WORKERS", "THREADS_PER_WORKER", "INTEROP_THREADS", "THREADPOOL_SIZE", "CPU_AFFINITY"}
+    assert best_settings(RESULTS[3:]) == {}
+
+def test_saved_tuning_is_loaded_by_objective(tmp_path):
+    path = tmp_path / "tuning" / "tuning.json"
+    save_tuning(str(path), RESULTS, model="tiny", cpus=8)
+    assert json.loads(path.read_text())["results"] == RESULTS
+    assert load_tuning(str(path), "throughput", "tiny")["WORKERS"] == 4
+    # a file measured for another model is still used
+    assert load_tuning(str(path), "p95", "other")["WORKERS"] == 2
+
+def test_missing_file_and_unknown_objective(tmp_path):
+    assert load_tuning(None) == {}
+    assert load_tuning(str(tmp_path / "missing.json")) == {}
+    with pytest.raises(ValueError):
+        load_tuning(None, "p99")
@@ -0,0 +1,97 @@
+import os, threading, time
+import torch
+from PIL import Image
+from vlm.app import vision_cache
+from vlm.app.vision_cache import VisionCache
+
+CPU = torch.device("cpu")
+
+def features(value: float) -> torch.Tensor:
+    # 1 KB of features
+    return torch.full((1, 4, 64), value)
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = VisionCache(0, str(tmp_path))
+    cache.put("a", features(1))
+    assert cache.get("a", CPU) is None
+    assert cache.disk_dir is None and os.listdir(tmp_path) == []
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = VisionCache(2 * features(0).nbytes)
+    cache.put("a", features(1))
+    cache.put("b", features(2))
+    assert cache.get("a", CPU) is not None
+    cache.put("c", features(3))
+    assert cache.get("b", CPU) is None
+    assert torch.equal(cache.get("a", CPU), features(1))
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["lookups"], stats["memory_hits"]) == (2, 2 * features(0).nbytes, 3, 2)
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    VisionCache(2**20, str(tmp_path), 2**20).put("a", features(1))
+
+    cache = VisionCache(2**20, str(tmp_path), 2**20)
+    assert cache.stats()["disk_entries"] == 1
+    assert torch.equal(cache.get("a", CPU), features(1))
+    # promoted to memory
+    cache.get("a", CPU)
+    stats = cache.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+
+def test_disk_tier_evicts_least_recently_used_files(tmp_path):
+    size = VisionCache(2**20, str(tmp_path / "probe"), 2**20)
+    size.put("z", features(0))
+    file_bytes = size.stats()["disk_bytes"]
+
+    cache = VisionCache(2**20, str(tmp_path / "cache"), 2 * file_bytes)
+    for key in "abc":
+        cache.put(key, features(1))
+    assert sorted(os.listdir(tmp_path / "cache")) == ["b.pt", "c.pt"]
+    assert cache.stats()["disk_bytes"] == 2 * file_bytes
+
+def test_concurrent_misses_write_an_image_once(tmp_path, monkeypatch):
+    save = torch.save
+    writes = []
+
+    def slow_save(obj, path):
+        writes.append(path)
+        time.sleep(0.05)
+        save(obj, path)
+
+    monkeypatch.setattr(vision_cache.torch, "save", slow_save)
+    cache = VisionCache(2**20, str(tmp_path), 2**20)
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def miss():
+        barrier.wait()
+        try:
+            cache.put("a", features(1))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=miss) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(writes) == 1
+    assert os.listdir(tmp_path) == ["a.pt"]
+    stats = cache.stats()
+    assert (stats["disk_entries"], stats["disk_bytes"]) == (1, os.path.getsize(tmp_path / "a.pt"))
+    assert cache.writing == set()
+
+def test_entries_do_not_keep_the_autograd_graph():
+    cache = VisionCache(2**20)
+    weight = torch.ones(64, requires_grad=True)
+    cache.put("a", features(1) * weight)
+    cached = cache.get("a", CPU)
+    assert not cached.requires_grad and cached.grad_fn is None
+
+def test_streamed_answers_cache_features_without_grad(tiny_vlm):
+    chart = Image.new("RGB", (96, 64), (12, 34, 56))
+    list(tiny_vlm.stream_vlm("What is the trend?", "", chart, 4))
+    assert tiny_vlm.vision_cache.entries
+    assert not any(f.requires_grad for f in tiny_vlm.vision_cache.entries.values())
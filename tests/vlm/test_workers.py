@@ -0,0 +1,22 @@
+import os
+from unittest import mock
+import pytest
+from vlm.app.workers import worker_cpus
+
+def test_no_affinity_leaves_placement_to_the_kernel():
+    assert worker_cpus(3, 2, "none") is None
+
+def test_workers_get_consecutive_blocks_of_cpus():
+    with mock.patch.object(os, "sched_getaffinity", return_value={0, 1, 2, 3, 4, 5, 6, 7}):
+        assert [worker_cpus(i, 2, "cores") for i in range(4)] == [[0, 1], [2, 3], [4, 5], [6, 7]]
+        # more threads than cpus wrap around
+        assert worker_cpus(4, 2, "cores") == [0, 1]
+        assert worker_cpus(1, 3, "cores") == [3, 4, 5]
+
+def test_only_allowed_cpus_are_used():
+    with mock.patch.object(os, "sched_getaffinity", return_value={2, 3, 6, 7}):
+        assert [worker_cpus(i, 2, "cores") for i in range(2)] == [[2, 3], [6, 7]]
+
+def test_unknown_affinity_is_rejected():
+    with pytest.raises(ValueError):
+        worker_cpus(0, 2, "numa")
@@ -0,0 +1,214 @@
+import queue, threading, time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable
+from PIL import Image
+from .cancellation import CancelToken, Cancelled
+
+BatchRunner = Callable[[list[str], str, list[Image.Image], list[int], list[str], list[CancelToken | None]], list[str | Cancelled]]
+
+class BatchRequest():
+    """
+    A single generation request waiting to be batched.
+    """
+    def __init__(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int, answer_kind: str = "free", cancel: CancelToken | None = None):
+        self.prompt = prompt
+        self.dynamic_prompt = dynamic_prompt
+        self.chart = chart
+        self.max_new_tokens = max_new_tokens
+        self.answer_kind = answer_kind
+        self.cancel = cancel
+        self.future: Future = Future()
+        self.enqueued_at = time.monotonic()
+
+class MicroBatcher():
+    """
+    Dynamic micro-batching scheduler in front of the model.
+
+    Requests are queued and a single worker thread takes them in batches: after the
+    first request of a batch arrived, the worker collects further requests for up to
+    `window` seconds or until `max_batch_size` requests are collected, then runs them
+    in one `model.generate` call and hands each caller its own answer. Requests
+    cancelled while queued are dropped before their batch runs.
+    """
+    def __init__(self, run_batch: BatchRunner, window: float = 0.02, max_batch_size: int = 4):
+        """
+        Args:
+            run_batch (BatchRunner): Function answering a batch, e.g. `VisualLanguageModelForCharts.run_vlm_batch`.
+            window (float): Seconds to wait for more requests after the first one of a batch.
+            max_batch_size (int): Maximum number of requests per batch.
+        """
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.queue: queue.Queue[BatchRequest | None] = queue.Queue()
+        self.deferred: deque[BatchRequest] = deque()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.batches = 0
+        self.requests = 0
+        self.cancelled = 0
+        self.max_batch = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self.thread = threading.Thread(target=self._work, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the worker thread after the batch it is running and fail the requests still queued.
+        """
+        with self.lock:
+            self.stopped = True
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        # requests queued or deferred behind the stop would never be answered
+        error = RuntimeError("Micro-batcher stopped")
+        while True:
+            try:
+                request = self.deferred.popleft() if self.deferred else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.future.set_exception(error)
+
+    def submit(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int, answer_kind: str = "free", cancel: CancelToken | None = None) -> str:
+        """
+        Queue a request and block until its batch has been answered.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            answer_kind (str): Kind of answer, deciding where the answer is complete.
+            cancel (CancelToken | None): Cancel flag of the request.
+
+        Returns:
+            str: Response of the model.
+
+        Raises:
+            Cancelled: If the request was cancelled before its answer was complete.
+            RuntimeError: If the batcher was stopped before the request was answered.
+            Exception: Any error raised by the model for this request.
+        """
+        request = BatchRequest(prompt, dynamic_prompt, chart, max_new_tokens, answer_kind, cancel)
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("Micro-batcher stopped")
+            self.queue.put(request)
+        return request.future.result()
+
+    def stats(self) -> dict:
+        """
+        Batching counters.
+
+        Returns:
+            dict: Settings, number of batches and requests, requests cancelled while queued,
+                average and largest batch size, average queue wait and average batch run time.
+        """
+        return {
+            "window": self.window,
+            "max_batch_size": self.max_batch_size,
+            "queued": self.queue.qsize() + len(self.deferred),
+            "batches": self.batches,
+            "requests": self.requests,
+            "cancelled": self.cancelled,
+            "batch_size_avg": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "batch_size_max": self.max_batch,
+            "wait_time_avg": round(self.wait_seconds / self.requests, 4) if self.requests else 0.0,
+            "batch_time_avg": round(self.run_seconds / self.batches, 4) if self.batches else 0.0,
+        }
+
+    def _work(self):
+        """
+        Worker loop collecting and running batches.
+        """
+        while True:
+            first = self.deferred.popleft() if self.deferred else self.queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            if batch is None:
+                return
+            self._run(batch)
+
+    def _collect(self, first: BatchRequest) -> list[BatchRequest] | None:
+        """
+        Collect requests sharing the dynamic prompt of `first` until the window closes.
+
+        Requests with another dynamic prompt are deferred to a later batch. Returns
+        None if the batcher was stopped while collecting.
+        """
+        batch = [first]
+        # a request that already waited for the previous batch does not wait again
+        deadline = first.enqueued_at + self.window
+        pending = len(self.deferred)
+        while len(batch) < self.max_batch_size:
+            if pending:
+                request, pending = self.deferred.popleft(), pending - 1
+            else:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if request is None:
+                self._run(batch)
+                return None
+            if request.dynamic_prompt == first.dynamic_prompt:
+                batch.append(request)
+            else:
+                self.deferred.append(request)
+        return batch
+
+    def _run(self, batch: list[BatchRequest]):
+        """
+        Answer a batch and resolve the futures of its requests.
+
+        If the batch fails as a whole, its requests are retried one by one so a
+        single bad request does not fail the others.
+        """
+        for request in batch:
+            if request.cancel is not None and request.cancel.cancelled:
+                self.cancelled += 1
+                request.future.set_exception(request.cancel.stopped(0, request.max_new_tokens))
+        batch = [request for request in batch if not request.future.done()]
+        if not batch:
+            return
+        start = time.monotonic()
+        self.batches += 1
+        self.requests += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.wait_seconds += sum(start - r.enqueued_at for r in batch)
+        try:
+            answers = self.run_batch([r.prompt for r in batch], batch[0].dynamic_prompt, [r.chart for r in batch], [r.max_new_tokens for r in batch], [r.answer_kind for r in batch], [r.cancel for r in batch])
+            for request, answer in zip(batch, answers):
+                _resolve(request, answer)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+            else:
+                for request in batch:
+                    try:
+                        _resolve(request, self.run_batch([request.prompt], request.dynamic_prompt, [request.chart], [request.max_new_tokens], [request.answer_kind], [request.cancel])[0])
+                    except Exception as single_error:
+                        request.future.set_exception(single_error)
+        finally:
+            self.run_seconds += time.monotonic() - start
+
+def _resolve(request: BatchRequest, answer: str | Cancelled):
+    """
+    Hand a request its answer, or its error if it was cancelled while generating.
+    """
+    if isinstance(answer, Cancelled):
+        request.future.set_exception(answer)
+    else:
+        request.future.set_result(answer)
@@ -0,0 +1,236 @@
+import re, threading
+from typing import Iterable, Iterator, Sequence
+import torch
+from transformers import PreTrainedTokenizerBase, StoppingCriteria
+
+# a sentence ends at ".", "!" or "?" followed by whitespace (so "0.93" is not split) or at a newline
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# kinds of answers, see `prompt_utils.answer_kind`
+ANSWER_KINDS = ("binary", "options", "short", "unanswerable", "free")
+
+# maximum new tokens per kind of answer, "free" covers live descriptions for the Hololens app
+DEFAULT_TOKEN_BUDGETS = {
+    "binary": 8,
+    "options": 16,
+    "short": 24,
+    "unanswerable": 32,
+    "free": 128,
+}
+
+class AnswerBudgets():
+    """
+    Token budgets and stop criteria per kind of answer.
+
+    Short answers (yes/no, option keywords, a number or phrase, the unanswerable
+    sentence) are complete at their first sentence end or line break, generation
+    stops there instead of running to the token budget. Free descriptions may span
+    several lines and paragraphs, they end at the end token or the budget. The
+    tokens actually generated are counted per kind next to the budget, so the
+    budgets can be tuned.
+    """
+    def __init__(self, budgets: dict[str, int] | None = None):
+        """
+        Args:
+            budgets (dict[str, int] | None): Token budgets overriding `DEFAULT_TOKEN_BUDGETS`, by kind.
+
+        Raises:
+            ValueError: If a budget is given for an unknown kind of answer.
+        """
+        unknown = set(budgets or {}) - set(ANSWER_KINDS)
+        if unknown:
+            raise ValueError(f"Unknown answer kinds {sorted(unknown)}, expected some of {ANSWER_KINDS}")
+        self.budgets = {**DEFAULT_TOKEN_BUDGETS, **(budgets or {})}
+        self.lock = threading.Lock()
+        self.counters = {kind: {"answers": 0, "generated": 0, "generated_max": 0, "stopped": 0, "exhausted": 0} for kind in ANSWER_KINDS}
+
+    def max_new_tokens(self, kind: str, max_new_tokens: int | None = None) -> int:
+        """
+        Token budget of an answer.
+
+        Args:
+            kind (str): Kind of answer.
+            max_new_tokens (int | None): Budget requested by the caller, None for the budget of the kind.
+
+        Returns:
+            int: Maximum number of tokens to generate.
+        """
+        return max_new_tokens or self.budgets[kind]
+
+    def end(self, kind: str, text: str) -> int | None:
+        """
+        Find where a complete answer ends in the text generated so far.
+
+        Args:
+            kind (str): Kind of answer.
+            text (str): Decoded answer so far.
+
+        Returns:
+            int | None: Length of the complete answer, or None while it is not complete
+                (always for free descriptions).
+        """
+        if kind == "free":
+            return None
+        # line breaks before the answer starts do not end it
+        match = SENTENCE_END.search(text, len(text) - len(text.lstrip()))
+        return match.start() if match else None
+
+    def trim(self, kind: str, text: str) -> str:
+        """
+        Cut a decoded answer at its end, dropping the tokens generated past it.
+
+        Args:
+            kind (str): Kind of answer.
+            text (str): Decoded answer.
+
+        Returns:
+            str: The complete answer.
+        """
+        end = self.end(kind, text)
+        return text if end is None else text[:end]
+
+    def trim_stream(self, kind: str, texts: Iterable[str]) -> Iterator[str]:
+        """
+        Cut incrementally decoded text at the end of the answer.
+
+        Args:
+            kind (str): Kind of answer.
+            texts (Iterable[str]): Pieces of decoded text in generation order.
+
+        Yields:
+            str: Pieces of the answer up to its end.
+        """
+        text = ""
+        for piece in texts:
+            end = self.end(kind, text + piece)
+            if end is not None:
+                if end > len(text):
+                    yield piece[:end - len(text)]
+                return
+            text += piece
+            yield piece
+
+    def answer_end(self, tokenizer: PreTrainedTokenizerBase, kind: str) -> "AnswerEnd":
+        """
+        Incremental check for the end of the answer of a single sequence.
+
+        Args:
+            tokenizer (PreTrainedTokenizerBase): Tokenizer decoding the generated tokens.
+            kind (str): Kind of answer.
+
+        Returns:
+            AnswerEnd: Check called with the generated token ids after every step.
+        """
+        return AnswerEnd(self, tokenizer, kind)
+
+    def stopping_criteria(self, tokenizer: PreTrainedTokenizerBase, kinds: list[str]) -> StoppingCriteria:
+        """
+        Stop criteria for `model.generate` ending every row at the end of its answer.
+
+        Args:
+            tokenizer (PreTrainedTokenizerBase): Tokenizer decoding the generated tokens.
+            kinds (list[str]): Kind of answer of every row of the batch.
+
+        Returns:
+            StoppingCriteria: Criteria for the `stopping_criteria` argument of `model.generate`.
+        """
+        return _StopAtAnswerEnd(self, tokenizer, kinds)
+
+    def record(self, kind: str, generated: int, budget: int, stopped: bool):
+        """
+        Count and log the tokens generated for an answer.
+
+        Args:
+            kind (str): Kind of answer.
+            generated (int): Tokens generated, without the end token.
+            budget (int): Token budget of the answer.
+            stopped (bool): Generation stopped at the end of the answer before the end token or budget.
+        """
+        print(f"Answer tokens ({kind}): {generated}/{budget}{' (stopped at answer end)' if stopped else ''}")
+        with self.lock:
+            counters = self.counters[kind]
+            counters["answers"] += 1
+            counters["generated"] += generated
+            counters["generated_max"] = max(counters["generated_max"], generated)
+            counters["stopped"] += stopped
+            counters["exhausted"] += generated >= budget and not stopped
+
+    def stats(self) -> dict:
+        """
+        Answer length counters.
+
+        Returns:
+            dict: Per kind of answer its token budget, answers, average and largest number
+                of generated tokens, answers stopped at their end and answers cut off by the budget.
+        """
+        with self.lock:
+            return {
+                kind: {
+                    "budget": self.budgets[kind],
+                    "answers": counters["answers"],
+                    "generated_avg": round(counters["generated"] / counters["answers"], 2) if counters["answers"] else 0.0,
+                    "generated_max": counters["generated_max"],
+                    "stopped": counters["stopped"],
+                    "exhausted": counters["exhausted"],
+                }
+                for kind, counters in self.counters.items()
+            }
+
+class AnswerEnd():
+    """
+    Check whether the answer of a sequence is complete, decoding only the new tokens.
+
+    Decoding all generated tokens at every step costs time quadratic in the length
+    of the answer. Instead the tokens generated since the last check are decoded
+    together with a few tokens before them, enough to see a sentence end split over
+    tokens, so every check costs about the same.
+    """
+    # tokens before the new ones decoded with them
+    CONTEXT = 3
+
+    def __init__(self, budgets: AnswerBudgets, tokenizer: PreTrainedTokenizerBase, kind: str):
+        """
+        Args:
+            budgets (AnswerBudgets): Budgets deciding where an answer ends.
+            tokenizer (PreTrainedTokenizerBase): Tokenizer decoding the generated tokens.
+            kind (str): Kind of answer.
+        """
+        self.budgets = budgets
+        self.tokenizer = tokenizer
+        self.kind = kind
+        self.checked = 0
+        # first token with text, line breaks before it do not end the answer
+        self.start: int | None = None
+        self.ended = False
+
+    def __call__(self, ids: Sequence[int] | torch.Tensor) -> bool:
+        """
+        Args:
+            ids (Sequence[int] | torch.Tensor): All token ids generated for the sequence so far.
+
+        Returns:
+            bool: Whether the answer is complete.
+        """
+        if self.ended or self.kind == "free":
+            return self.ended
+        new, self.checked = self.checked, len(ids)
+        if self.start is None:
+            self.start = next((i for i in range(new, len(ids)) if self.tokenizer.decode(ids[i:i + 1], skip_special_tokens=True).strip()), None)
+            if self.start is None:
+                return False
+        first = max(self.start, new - self.CONTEXT)
+        text = self.tokenizer.decode(ids[first:], skip_special_tokens=True)
+        # an end within the context was found by an earlier check already
+        self.ended = (self.budgets.end(self.kind, text) if first == self.start else SENTENCE_END.search(text)) is not None
+        return self.ended
+
+class _StopAtAnswerEnd(StoppingCriteria):
+    """
+    Stop criteria marking every row done once its decoded answer is complete.
+    """
+    def __init__(self, budgets: AnswerBudgets, tokenizer: PreTrainedTokenizerBase, kinds: list[str]):
+        self.ends = [budgets.answer_end(tokenizer, kind) for kind in kinds]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        # generating from embeddings, input_ids holds the new tokens only
+        return torch.tensor([end(row) for end, row in zip(self.ends, input_ids)], device=input_ids.device)
@@ -0,0 +1,183 @@
+import threading, time
+import torch
+from transformers import StoppingCriteria
+
+# why a request was cancelled
+CANCEL_REASONS = ("disconnect", "timeout")
+
+class Cancelled(Exception):
+    """
+    Raised for a request that was cancelled before its answer was complete.
+
+    Attributes:
+        reason (str): "disconnect" or "timeout".
+    """
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled ({reason})")
+        self.reason = reason
+
+class CancelToken():
+    """
+    Cancel flag of a single request.
+
+    The flag is set when the client disconnects, or on the first check after the
+    deadline of the request passed. Generation checks it between decode steps and
+    stops early, and a request still waiting for the model is dropped. A token
+    created before the answering model is known is bound to the counters of that
+    model once it is (see `Cancellations.bind`).
+    """
+    def __init__(self, cancellations: "Cancellations | None" = None, timeout: float | None = None):
+        """
+        Args:
+            cancellations (Cancellations | None): Counters the cancellation is recorded in, None until it is bound.
+            timeout (float | None): Seconds until the request times out, None for no deadline.
+        """
+        self.cancellations = cancellations
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: str | None = None
+        self.started_at: float | None = None
+        self.recorded = False
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "timeout"
+        return self.reason is not None
+
+    def cancel(self, reason: str = "disconnect"):
+        """
+        Cancel the request, keeping the first reason given.
+
+        Args:
+            reason (str): "disconnect" or "timeout".
+        """
+        if self.reason is None:
+            self.reason = reason
+
+    def start(self):
+        """
+        Mark the moment the model starts working on the request.
+        """
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+    def stopped(self, generated: int, budget: int) -> Cancelled:
+        """
+        Record that generation stopped for the cancellation.
+
+        Args:
+            generated (int): Tokens generated before generation stopped.
+            budget (int): Token budget of the answer.
+
+        Returns:
+            Cancelled: The error to raise or hand to the caller.
+        """
+        if not self.recorded and self.cancellations is not None:
+            self.recorded = True
+            seconds = time.monotonic() - self.started_at if self.started_at is not None else None
+            self.cancellations.record(self.reason or "disconnect", generated, budget, seconds)
+        return Cancelled(self.reason or "disconnect")
+
+class Cancellations():
+    """
+    Factory of cancel tokens and counters of cancelled requests.
+
+    For every cancelled request the tokens it generated and the tokens left in its
+    budget are counted. The CPU time a cancelled request would have wasted is
+    estimated from those left tokens and the time per token that cancelled
+    requests took until they were stopped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {reason: {"requests": 0, "queued": 0, "generated": 0, "saved_tokens": 0, "seconds": 0.0} for reason in CANCEL_REASONS}
+
+    def token(self, timeout: float | None = None) -> CancelToken:
+        """
+        Create the cancel token of a new request.
+
+        Args:
+            timeout (float | None): Seconds until the request times out, None for no deadline.
+
+        Returns:
+            CancelToken: Token to pass along with the request.
+        """
+        return CancelToken(self, timeout)
+
+    def bind(self, token: CancelToken) -> CancelToken:
+        """
+        Record the cancellation of a request in these counters, once the model answering it is known.
+
+        Args:
+            token (CancelToken): Token created before the request reached its model.
+
+        Returns:
+            CancelToken: The token.
+        """
+        token.cancellations = self
+        return token
+
+    def stopping_criteria(self, tokens: list[CancelToken | None]) -> StoppingCriteria:
+        """
+        Stop criteria for `model.generate` ending every row once its request is cancelled.
+
+        Args:
+            tokens (list[CancelToken | None]): Cancel token of every row of the batch, None for rows that cannot be cancelled.
+
+        Returns:
+            StoppingCriteria: Criteria for the `stopping_criteria` argument of `model.generate`.
+        """
+        return _StopWhenCancelled(tokens)
+
+    def record(self, reason: str, generated: int, budget: int, seconds: float | None):
+        """
+        Count and log a cancelled request.
+
+        Args:
+            reason (str): "disconnect" or "timeout".
+            generated (int): Tokens generated before generation stopped.
+            budget (int): Token budget of the answer.
+            seconds (float | None): Time the model spent on the request, None if it was cancelled while waiting.
+        """
+        print(f"Cancelled request ({reason}) after {generated}/{budget} tokens")
+        with self.lock:
+            counters = self.counters[reason]
+            counters["requests"] += 1
+            counters["queued"] += seconds is None
+            counters["generated"] += generated
+            counters["saved_tokens"] += max(budget - generated, 0)
+            counters["seconds"] += seconds or 0.0
+
+    def stats(self) -> dict:
+        """
+        Cancellation counters.
+
+        Returns:
+            dict: Per reason the cancelled requests, those cancelled before the model
+                started on them, generated and saved tokens, seconds spent and the
+                estimated seconds saved.
+        """
+        with self.lock:
+            generated = sum(counters["generated"] for counters in self.counters.values())
+            seconds = sum(counters["seconds"] for counters in self.counters.values())
+            per_token = seconds / generated if generated else 0.0
+            return {
+                reason: {
+                    "requests": counters["requests"],
+                    "queued": counters["queued"],
+                    "generated": counters["generated"],
+                    "saved_tokens": counters["saved_tokens"],
+                    "spent_seconds": round(counters["seconds"], 2),
+                    "saved_seconds_est": round(counters["saved_tokens"] * per_token, 2),
+                }
+                for reason, counters in self.counters.items()
+            }
+
+class _StopWhenCancelled(StoppingCriteria):
+    """
+    Stop criteria marking the rows of cancelled requests done.
+    """
+    def __init__(self, tokens: list[CancelToken | None]):
+        self.tokens = tokens
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.tensor([token is not None and token.cancelled for token in self.tokens], device=input_ids.device)
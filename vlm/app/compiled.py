@@ -0,0 +1,178 @@
+import os, threading, time
+from typing import Callable
+import torch
+from transformers import StaticCache
+
+class CompiledDecoder():
+    """
+    Greedy decoding of a single sequence with a compiled decode step and a static KV cache.
+
+    Eager decoding spends most of a step at batch size 1 on cpu in Python and the
+    dispatcher. Here the keys and values live in one preallocated `StaticCache`, so
+    every decode step has the same shapes and the forward pass of a single token is
+    compiled once with `torch.compile`. The prompt is prefilled eagerly into the same
+    cache, since prompt lengths vary. The compiled kernels are cached in `cache_dir`
+    (e.g. on the `models_cache` volume), so a restart loads them instead of
+    compiling again. One sequence decodes at a time.
+    """
+    def __init__(self, vlm, max_cache_len: int = 4096, cache_dir: str | None = None, eos: set[int] | None = None):
+        """
+        Args:
+            vlm (VisualLanguageModelForCharts): Loaded model.
+            max_cache_len (int): Tokens of the static KV cache, prompt and answer together.
+            cache_dir (str | None): Directory of the compile cache, None for the default temporary directory.
+            eos (set[int] | None): Token ids ending the answer.
+        """
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+        self.vlm = vlm
+        self.max_cache_len = max_cache_len
+        self.cache_dir = cache_dir
+        self.eos = eos or set()
+        self.cache = StaticCache(config=vlm.model.config, max_cache_len=max_cache_len)
+        self.step = torch.compile(self._step, dynamic=False)
+        self.lock = threading.Lock()
+        self.warmup_seconds = 0.0
+        self.sequences = 0
+        self.fallbacks = 0
+        self.generated = 0
+        self.decode_steps = 0
+        self.decode_seconds = 0.0
+
+    def warmup(self):
+        """
+        Compile the decode step by decoding a few tokens of a dummy prompt.
+
+        The decode step has a single shape, so this is the only compilation; it is
+        loaded from the compile cache if an earlier run compiled the same model.
+        """
+        start = time.perf_counter()
+        ids = torch.tensor([self.vlm.processor.tokenizer.encode("Warm up")], device=self.vlm.device)
+        with torch.inference_mode():
+            embeds = self.vlm.model.get_input_embeddings()(ids)
+        self.generate({"inputs_embeds": embeds}, max_new_tokens=3, record=False)
+        self.warmup_seconds = time.perf_counter() - start
+        print(f"Compiled decode step ready in {self.warmup_seconds:.1f}s (cache: {self.cache_dir or 'default'})")
+
+    def fits(self, inputs: dict, max_new_tokens: int) -> bool:
+        """
+        Check that a prompt and its answer fit into the static KV cache, counting prompts that do not.
+
+        Args:
+            inputs (dict): Generation inputs from `embed_inputs`.
+            max_new_tokens (int): Maximum number of tokens to generate.
+
+        Returns:
+            bool: True if the sequence can be decoded here, False if it has to run eagerly.
+        """
+        if inputs["inputs_embeds"].shape[1] + max_new_tokens <= self.max_cache_len:
+            return True
+        with self.lock:
+            self.fallbacks += 1
+        return False
+
+    @torch.inference_mode()
+    def generate(self, inputs: dict, max_new_tokens: int, streamer=None, stop: Callable[[list[int]], bool] | None = None, record: bool = True) -> list[int]:
+        """
+        Generate the greedy answer of a single prompt.
+
+        Args:
+            inputs (dict): Generation inputs from `embed_inputs` for a single prompt
+                (inputs_embeds, optional past_key_values holding a prefix of it), fitting the cache.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            streamer (BaseStreamer | None): Streamer receiving the new tokens, as with `model.generate`.
+            stop (Callable[[list[int]], bool] | None): Check on the generated ids ending the answer early, as stopping criteria do.
+            record (bool): Count the sequence in the statistics.
+
+        Returns:
+            list[int]: Generated token ids, without the end token.
+        """
+        with self.lock:
+            if streamer is not None:
+                # like `model.generate`, the first put is the (here empty) prompt
+                streamer.put(torch.empty((1, 0), dtype=torch.long))
+            self.cache.reset()
+            length, logits = self._prefill(inputs)
+            device = logits.device
+
+            ids = [int(logits.argmax())]
+            if streamer is not None and ids[-1] not in self.eos:
+                streamer.put(torch.tensor(ids[-1:]))
+            start = time.perf_counter()
+            steps = 0
+            while ids[-1] not in self.eos and len(ids) < max_new_tokens and not (stop and stop(ids)):
+                logits = self.step(torch.tensor([ids[-1:]], device=device), torch.tensor([length], device=device))
+                ids.append(int(logits.argmax()))
+                length += 1
+                steps += 1
+                if streamer is not None and ids[-1] not in self.eos:
+                    streamer.put(torch.tensor(ids[-1:]))
+            seconds = time.perf_counter() - start
+
+            ids = ids[:next((i for i, t in enumerate(ids) if t in self.eos), len(ids))]
+            if streamer is not None:
+                streamer.end()
+            if record:
+                self.sequences += 1
+                self.generated += len(ids)
+                self.decode_steps += steps
+                self.decode_seconds += seconds
+            return ids
+
+    def stats(self) -> dict:
+        """
+        Compiled decoding counters.
+
+        Returns:
+            dict: Cache size, warmup time, decoded sequences, prompts too long for the
+                cache, generated tokens and the average time per decode step.
+        """
+        with self.lock:
+            return {
+                "max_cache_len": self.max_cache_len,
+                "warmup_seconds": round(self.warmup_seconds, 2),
+                "sequences": self.sequences,
+                "fallbacks": self.fallbacks,
+                "generated": self.generated,
+                "decode_ms_per_token": round(1000 * self.decode_seconds / self.decode_steps, 2) if self.decode_steps else 0.0,
+            }
+
+    def _prefill(self, inputs: dict) -> tuple[int, torch.Tensor]:
+        """
+        Fill the static cache with the prompt, copying a cached prefix and running the rest eagerly.
+
+        Returns:
+            tuple[int, torch.Tensor]: Prompt length and the logits of the next token.
+        """
+        embeds = inputs["inputs_embeds"]
+        past = 0
+        prefix = inputs.get("past_key_values")
+        if prefix is not None:
+            past = prefix.get_seq_length()
+            positions = torch.arange(past, device=embeds.device)
+            for layer, (k, v) in enumerate(prefix.to_legacy_cache()):
+                self.cache.update(k, v, layer, {"cache_position": positions})
+        positions = torch.arange(past, embeds.shape[1], device=embeds.device)
+        out = self.vlm.model(
+            inputs_embeds=embeds[:, past:],
+            position_ids=positions.unsqueeze(0),
+            cache_position=positions,
+            past_key_values=self.cache,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        return embeds.shape[1], out.logits[0, -1]
+
+    def _step(self, input_ids: torch.Tensor, cache_position: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass of a single token on top of the static cache, the compiled function.
+        """
+        out = self.vlm.model(
+            input_ids=input_ids,
+            position_ids=cache_position.unsqueeze(0),
+            cache_position=cache_position,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        return out.logits[0, -1]
@@ -0,0 +1,461 @@
+import queue, threading, time
+from collections import deque
+from typing import Iterator
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from PIL import Image
+from .budgets import AnswerEnd
+from .cancellation import CancelToken
+
+# marks the end of a sequence in its token queue
+_END = object()
+
+class Sequence():
+    """
+    A single request inside the continuous batching engine.
+
+    Attributes:
+        prompt (str): Question on the chart.
+        dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+        chart (PIL.Image.Image): Chart image.
+        max_new_tokens (int): Maximum number of tokens to generate.
+        answer_kind (str): Kind of answer, deciding where the answer is complete.
+        cancel (CancelToken): Cancel flag of the request.
+        answer_end (AnswerEnd): Check for the end of the answer on the generated token ids.
+        ids (list[int]): Generated token ids.
+        done (bool): Generation reached an end token, the end of the answer or the token budget.
+        length (int): Tokens of the sequence held in the KV cache, without padding.
+        tokens (queue.Queue): Generated token ids for the caller, then the end marker or an exception.
+    """
+    def __init__(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int, answer_kind: str, cancel: CancelToken, answer_end: AnswerEnd):
+        self.prompt = prompt
+        self.dynamic_prompt = dynamic_prompt
+        self.chart = chart
+        self.max_new_tokens = max_new_tokens
+        self.answer_kind = answer_kind
+        self.cancel = cancel
+        self.answer_end = answer_end
+        self.ids: list[int] = []
+        self.length = 0
+        self.done = False
+        self.finished = False
+        self.tokens: queue.Queue = queue.Queue()
+        self.enqueued_at = time.monotonic()
+        # prefill state
+        self.input_ids: torch.Tensor | None = None
+        self.embeds: torch.Tensor | None = None
+        self.pixel_values: torch.Tensor | None = None
+        self.image_features: list[torch.Tensor] = []
+        self.image_key = ""
+        self.tiles_done = 0
+        self.prefilled = 0
+        self.cache: DynamicCache | None = None
+
+    def finish(self, error: Exception | None = None):
+        """
+        End the sequence and release its caller.
+        """
+        if not self.finished:
+            self.finished = True
+            self.tokens.put(error if error is not None else _END)
+        self.embeds = self.pixel_values = self.cache = None
+        self.image_features = []
+
+class ContinuousBatchingEngine():
+    """
+    Iteration-level batching engine behind `VisualLanguageModelForCharts`.
+
+    A worker thread runs the model step by step. Every iteration it advances the
+    prefill of one waiting sequence by a chunk of at most `prefill_chunk` tokens
+    (or the image tiles worth as many tokens) and then runs one decode step for
+    all running sequences. Sequences join the running batch as soon as their
+    prefill is done and leave it as soon as they hit an end token, the end of
+    their answer or their budget, so short answers never wait for long ones.
+    Cancelled sequences are dropped at the next iteration, wherever they are.
+
+    Every sequence fills its own KV cache during prefill, starting from a copy of
+    the cached system prompt prefix. Running sequences share
+    one left-padded batch cache, which is only re-laid out when a sequence joins
+    or leaves.
+    """
+    def __init__(self, vlm, max_batch_size: int = 4, prefill_chunk: int = 256):
+        """
+        Args:
+            vlm (VisualLanguageModelForCharts): Loaded model.
+            max_batch_size (int): Maximum number of sequences prefilling or decoding at the same time.
+            prefill_chunk (int): Prompt tokens prefilled per iteration.
+        """
+        self.vlm = vlm
+        self.max_batch_size = max_batch_size
+        self.prefill_chunk = prefill_chunk
+        self.requests: queue.Queue[Sequence | None] = queue.Queue()
+        self.waiting: deque[Sequence] = deque()
+        self.prefilling: Sequence | None = None
+        self.running: list[Sequence] = []
+        self.cache: DynamicCache | None = None
+        self.mask: torch.Tensor | None = None
+        self.thread: threading.Thread | None = None
+        self.stopping = False
+        self.steps = 0
+        self.prefill_chunks = 0
+        self.prefill_tokens = 0
+        self.decode_tokens = 0
+        self.finished = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        model = self.vlm.model
+        eos = model.generation_config.eos_token_id
+        self.eos = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+        self.image_token_id = model.config.image_token_id
+        # vision tokens produced per image tile
+        self.tile_tokens = getattr(self.vlm.processor, "image_seq_length", 256)
+        self.stopping = False
+        self.thread = threading.Thread(target=self._work, name="continuous-batching", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the worker thread and fail the sequences it did not finish.
+        """
+        if self.thread is not None:
+            self.stopping = True
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+        self._receive(block=False)
+        error = RuntimeError("VLM engine stopped")
+        for seq in [*self.waiting, *self.running, *([self.prefilling] if self.prefilling else [])]:
+            seq.finish(error)
+        self.waiting.clear()
+        self.running, self.prefilling, self.cache, self.mask = [], None, None, None
+
+    def generate(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int, answer_kind: str = "free", cancel: CancelToken | None = None) -> str:
+        """
+        Run inference for a prompt-chart pair and block until the answer is complete.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            answer_kind (str): Kind of answer, deciding where the answer is complete.
+            cancel (CancelToken | None): Cancel flag of the request, the sequence is dropped once it is set.
+
+        Returns:
+            str: Response of the model.
+
+        Raises:
+            Cancelled: If the request was cancelled before its answer was complete.
+            Exception: Any error raised by the model for this request.
+        """
+        ids = list(self._tokens(self._submit(prompt, dynamic_prompt, chart, max_new_tokens, answer_kind, cancel)))
+        text = self.vlm.processor.tokenizer.decode(ids, skip_special_tokens=True)
+        return self.vlm.clean_answer(self.vlm.budgets.trim(answer_kind, text))
+
+    def stream(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int, answer_kind: str = "free", cancel: CancelToken | None = None) -> Iterator[str]:
+        """
+        Run inference for a prompt-chart pair and yield the response sentence by sentence.
+
+        If the consumer stops iterating before the end of the answer, the request is cancelled.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            answer_kind (str): Kind of answer, deciding where the answer is complete.
+            cancel (CancelToken | None): Cancel flag of the request, the sequence is dropped once it is set.
+
+        Yields:
+            str: Cleaned-up sentence chunks of the response.
+
+        Raises:
+            Cancelled: If the request was cancelled before its answer was complete.
+            Exception: Any error raised by the model for this request.
+        """
+        seq = self._submit(prompt, dynamic_prompt, chart, max_new_tokens, answer_kind, cancel)
+        tokenizer = self.vlm.processor.tokenizer
+
+        def texts() -> Iterator[str]:
+            ids, emitted = [], ""
+            for token in self._tokens(seq):
+                ids.append(token)
+                text = tokenizer.decode(ids, skip_special_tokens=True)
+                # wait for the rest of a multi-byte character
+                if text.endswith("�"):
+                    continue
+                yield text[len(emitted):]
+                emitted = text
+
+        try:
+            yield from self.vlm.to_sentences(self.vlm.budgets.trim_stream(answer_kind, texts()))
+        except GeneratorExit:
+            # the consumer left before the end of the answer
+            seq.cancel.cancel("disconnect")
+            raise
+
+    def stats(self) -> dict:
+        """
+        Engine counters.
+
+        Returns:
+            dict: Settings, waiting and running sequences, decode steps, average decode
+                batch size, prefilled and generated tokens and finished/failed/cancelled sequences.
+        """
+        return {
+            "max_batch_size": self.max_batch_size,
+            "prefill_chunk": self.prefill_chunk,
+            "waiting": self.requests.qsize() + len(self.waiting) + (1 if self.prefilling else 0),
+            "running": len(self.running),
+            "decode_steps": self.steps,
+            "decode_batch_avg": round(self.decode_tokens / self.steps, 2) if self.steps else 0.0,
+            "prefill_chunks": self.prefill_chunks,
+            "prefill_tokens": self.prefill_tokens,
+            "decode_tokens": self.decode_tokens,
+            "finished": self.finished,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+    def _submit(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int, answer_kind: str, cancel: CancelToken | None) -> Sequence:
+        """
+        Queue a new sequence for the worker.
+        """
+        if self.thread is None:
+            raise RuntimeError("VLM engine is not running")
+        seq = Sequence(prompt, dynamic_prompt, chart, max_new_tokens, answer_kind, cancel or self.vlm.cancellations.token(), self.vlm.budgets.answer_end(self.vlm.processor.tokenizer, answer_kind))
+        self.requests.put(seq)
+        return seq
+
+    def _tokens(self, seq: Sequence) -> Iterator[int]:
+        """
+        Yield the generated token ids of a sequence as they arrive.
+        """
+        while True:
+            item = seq.tokens.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _work(self):
+        """
+        Worker loop interleaving prefill chunks and decode steps.
+        """
+        with torch.inference_mode():
+            while not self.stopping:
+                idle = not self.running and self.prefilling is None and not self.waiting
+                self._receive(block=idle)
+                self._drop_cancelled()
+                if self.prefilling is None and self.waiting and len(self.running) < self.max_batch_size:
+                    self.prefilling = self.waiting.popleft()
+                if self.prefilling is not None:
+                    self._prefill_step(self.prefilling)
+                if self.running:
+                    self._decode_step()
+
+    def _receive(self, block: bool):
+        """
+        Move newly submitted sequences to the waiting list.
+        """
+        try:
+            item = self.requests.get() if block else self.requests.get_nowait()
+            while True:
+                if item is not None:
+                    self.waiting.append(item)
+                item = self.requests.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _drop_cancelled(self):
+        """
+        Release the callers of cancelled sequences that are waiting or prefilling.
+
+        Running sequences are retired after their next decode step.
+        """
+        for seq in [*self.waiting, *([self.prefilling] if self.prefilling else [])]:
+            if seq.cancel.cancelled:
+                self.cancelled += 1
+                seq.finish(seq.cancel.stopped(0, seq.max_new_tokens))
+        self.waiting = deque(seq for seq in self.waiting if not seq.finished)
+        if self.prefilling is not None and self.prefilling.finished:
+            self.prefilling = None
+
+    def _prefill_step(self, seq: Sequence):
+        """
+        Advance the prefill of a sequence by one chunk of image tiles or prompt tokens.
+        """
+        model = self.vlm.model
+        try:
+            if seq.input_ids is None:
+                seq.cancel.start()
+                inputs = self.vlm.prepare_inputs(seq.prompt, seq.dynamic_prompt, seq.chart)
+                seq.input_ids = inputs["input_ids"]
+                seq.embeds = model.get_input_embeddings()(seq.input_ids)
+                seq.image_key = inputs["image_keys"][0]
+                seq.pixel_values = inputs["pixel_values"][0]
+                if inputs["image_features"][0] is not None:
+                    # cached by the vision cache, no vision forward needed
+                    self._merge_image(seq, inputs["image_features"][0])
+                # start from the cached system prompt, only the rest is prefilled
+                seq.cache, seq.prefilled = self.vlm.prefill_prefix(seq.input_ids)
+                seq.chart = None
+
+            # encode the image a few tiles at a time, so running decodes are not stalled
+            if seq.pixel_values is not None and seq.tiles_done < seq.pixel_values.shape[0]:
+                tiles = max(1, self.prefill_chunk // self.tile_tokens)
+                pixel_values = seq.pixel_values[seq.tiles_done:seq.tiles_done + tiles]
+                seq.image_features.append(model.get_image_features(pixel_values=pixel_values))
+                seq.tiles_done += pixel_values.shape[0]
+                self.prefill_chunks += 1
+                if seq.tiles_done >= seq.pixel_values.shape[0]:
+                    features = torch.cat(seq.image_features)
+                    self.vlm.vision_cache.put(seq.image_key, features)
+                    self._merge_image(seq, features)
+                    seq.image_features = []
+                return
+
+            start = seq.prefilled
+            end = min(start + self.prefill_chunk, seq.input_ids.shape[1])
+            positions = torch.arange(start, end, device=seq.embeds.device)
+            out = model(
+                inputs_embeds=seq.embeds[:, start:end],
+                attention_mask=torch.ones((1, end), dtype=torch.long, device=seq.embeds.device),
+                position_ids=positions.unsqueeze(0),
+                cache_position=positions,
+                past_key_values=seq.cache,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+            seq.prefilled = end
+            self.prefill_chunks += 1
+            self.prefill_tokens += end - start
+            if end < seq.input_ids.shape[1]:
+                return
+
+            self.prefilling = None
+            seq.length = end
+            self._emit(seq, int(out.logits[0, -1].argmax()))
+            if seq.done:
+                self.finished += 1
+                seq.finish()
+            else:
+                self._join(seq)
+        except Exception as e:
+            self.prefilling = None
+            self.failed += 1
+            seq.finish(e)
+
+    def _merge_image(self, seq: Sequence, features: torch.Tensor):
+        """
+        Put the vision features of the chart at the image token positions of the prompt embeddings.
+        """
+        features = features.reshape(-1, seq.embeds.shape[-1])
+        seq.embeds[seq.input_ids == self.image_token_id] = features.to(seq.embeds.dtype)
+
+    def _join(self, seq: Sequence):
+        """
+        Add a prefilled sequence to the running batch.
+        """
+        cache, seq.cache = seq.cache, None
+        seq.embeds = seq.pixel_values = None
+        mask = torch.ones((1, seq.length), dtype=torch.long, device=seq.input_ids.device)
+        if not self.running:
+            self.running, self.cache, self.mask = [seq], cache, mask
+            return
+        # left-pad both to the longer cache so the newest tokens line up
+        length = max(self.mask.shape[1], seq.length)
+        self.cache = DynamicCache.from_legacy_cache(tuple(
+            (torch.cat([_pad_left(k, length, -2), _pad_left(sk, length, -2)]), torch.cat([_pad_left(v, length, -2), _pad_left(sv, length, -2)]))
+            for (k, v), (sk, sv) in zip(self.cache.to_legacy_cache(), cache.to_legacy_cache())
+        ))
+        self.mask = torch.cat([_pad_left(self.mask, length, -1), _pad_left(mask, length, -1)])
+        self.running.append(seq)
+
+    def _decode_step(self):
+        """
+        Generate the next token of every running sequence and retire the finished ones.
+        """
+        device = self.mask.device
+        try:
+            input_ids = torch.tensor([[seq.ids[-1]] for seq in self.running], device=device)
+            position_ids = torch.tensor([[seq.length] for seq in self.running], device=device)
+            self.mask = torch.cat([self.mask, torch.ones((len(self.running), 1), dtype=self.mask.dtype, device=device)], dim=1)
+            out = self.vlm.model(
+                input_ids=input_ids,
+                attention_mask=self.mask,
+                position_ids=position_ids,
+                cache_position=torch.tensor([self.mask.shape[1] - 1], device=device),
+                past_key_values=self.cache,
+                use_cache=True,
+            )
+        except Exception as e:
+            self.failed += len(self.running)
+            for seq in self.running:
+                seq.finish(e)
+            self.running, self.cache, self.mask = [], None, None
+            return
+
+        self.steps += 1
+        self.decode_tokens += len(self.running)
+        for seq, token in zip(self.running, out.logits[:, -1].argmax(-1).tolist()):
+            seq.length += 1
+            self._emit(seq, token)
+        self._retire()
+
+    def _emit(self, seq: Sequence, token: int):
+        """
+        Hand a generated token to the caller and mark the sequence finished at its end.
+        """
+        stopped = False
+        if token in self.eos:
+            seq.done = True
+        else:
+            seq.ids.append(token)
+            seq.tokens.put(token)
+            stopped = seq.answer_end(seq.ids)
+            seq.done = stopped or len(seq.ids) >= seq.max_new_tokens
+        if seq.done:
+            self.vlm.budgets.record(seq.answer_kind, len(seq.ids), seq.max_new_tokens, stopped)
+
+    def _retire(self):
+        """
+        Drop finished and cancelled sequences from the running batch and trim padding no row needs anymore.
+        """
+        keep = [i for i, seq in enumerate(self.running) if not seq.done and not seq.cancel.cancelled]
+        if len(keep) == len(self.running):
+            return
+        for seq in self.running:
+            if seq.done:
+                self.finished += 1
+                seq.finish()
+            elif seq.cancel.cancelled:
+                self.cancelled += 1
+                seq.finish(seq.cancel.stopped(len(seq.ids), seq.max_new_tokens))
+        if not keep:
+            self.running, self.cache, self.mask = [], None, None
+            return
+        index = torch.tensor(keep, device=self.mask.device)
+        mask = self.mask[index]
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self.mask = mask[:, start:]
+        self.cache = DynamicCache.from_legacy_cache(tuple(
+            (k[index, :, start:], v[index, :, start:]) for k, v in self.cache.to_legacy_cache()
+        ))
+        self.running = [self.running[i] for i in keep]
+
+def _pad_left(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    """
+    Left-pad `tensor` with zeros along `dim` (-1 or -2) to `length`.
+    """
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    return F.pad(tensor, (missing, 0) if dim == -1 else (0, 0, missing, 0))
@@ -1,9 +1,9 @@
-import os, json, dotenv
+import os, json, dotenv, time, resource
 from PIL import Image
 from io import BytesIO
 from vlm.app.dataset_utils import merge_dataset_with_prompts_from_hololens, generate_hololens_dataset_from_sample_dataset, get_stored_samples, load_n_samples, filter_sampled_images
 from typing import Dict, Any, List,  Literal
-from vlm.app.prompt_utils import build_dynamic_prompt
+from vlm.app.prompt_utils import build_dynamic_prompt, build_answer_options, answer_kind
 from pathlib import Path
 from vlm.app.scoring import compute_evaluation_scores
 from vlm.app.model import VisualLanguageModelForCharts
@@ -11,11 +11,12 @@ import pandas as pd
 from vlm.config import IMAGES_PATH, HOLOLENS_IMAGES_PATH,  SCORES_PATH
 from datasets import Dataset
 
-def evaluate(vlm: VisualLanguageModelForCharts, eval_type:Literal["scivqa", "hololens"], model_path: str):
+def evaluate(vlm: VisualLanguageModelForCharts, eval_type:Literal["scivqa", "hololens"], model_path: str, constrained: bool = True):
     # 0) load data
     dsN:Dataset = get_stored_samples()
     image_path = None
-    model_path = model_path.replace("/", "-")
+    # results of every precision are kept side by side
+    model_path = f"{model_path.replace("/", "-")}-{vlm.precision}"
 
     # 1) Set the image pathes for the current evaluation.
     if (eval_type=="hololens"):
@@ -41,13 +42,20 @@ def evaluate(vlm: VisualLanguageModelForCharts, eval_type:Literal["scivqa", "hol
         print(f"Gold: {gold}")
 
         pred = ""
+        start = time.perf_counter()
 
-        # 4) Generate a prediction with dynamic prompt as a system prompt
+        # 4) Generate a prediction with dynamic prompt as a system prompt and the token budget of the QA type,
+        # finite answer sets are answered by scoring the allowed answers instead
+        answer_options = build_answer_options(entry=data) if constrained else None
         try:
-            pred = vlm.run_vlm(prompt=question, dynamic_prompt=dynamic_prompt, chart=pillow_image)
+            if answer_options:
+                pred = vlm.choose_answer(prompt=question, dynamic_prompt=dynamic_prompt, chart=pillow_image, candidates=answer_options)
+            else:
+                pred = vlm.run_vlm(prompt=question, dynamic_prompt=dynamic_prompt, chart=pillow_image, answer_kind=answer_kind(entry=data))
         except Exception as e:
             print(f"Error:{e}")
-        print(f"Prediction: {pred}")
+        latency = time.perf_counter() - start
+        print(f"Prediction: {pred} ({latency:.2f}s)")
 
         # 5) Save prediction and gold answer as a row
         rows.append({
@@ -62,12 +70,18 @@ def evaluate(vlm: VisualLanguageModelForCharts, eval_type:Literal["scivqa", "hol
             "question": question,
             "gold": gold,
             "prediction": pred,
+            "latency_s": round(latency, 3),
         })
     
     # 6) Create a dataframe from the rows and save as csv
     ds = pd.DataFrame(rows)
     ds.to_csv(Path(SCORES_PATH) / f"{eval_type}-results_tmp_{model_path}.csv", sep=";", index=False)
     print(f"Saved results in {Path(SCORES_PATH) / f"results_tmp_{model_path}.csv"}")
+    print(f"Prefix cache: {vlm.prefix_cache.stats()}")
+    print(f"Vision cache: {vlm.vision_cache.stats()}")
+    print(f"Answer tokens: {vlm.budgets.stats()}")
+    if vlm.speculative is not None:
+        print(f"Speculative decoding: {vlm.speculative.stats()}")
 
     preds = ds["prediction"].tolist() 
     refs  = ds["gold"].tolist() 
@@ -76,6 +90,32 @@ def evaluate(vlm: VisualLanguageModelForCharts, eval_type:Literal["scivqa", "hol
     # 7) Measure the rouge and bertscore for each pred and also get the mean score from overall
     compute_evaluation_scores(predictions=preds, references=refs, results_table=ds, dataset_name=eval_type, model_path=model_path)
 
+    # 8) Save memory and latency next to the scores, to compare precisions
+    save_performance(vlm, latencies=ds["latency_s"].tolist(), dataset_name=eval_type, model_path=model_path)
+
+def save_performance(vlm: VisualLanguageModelForCharts, latencies: List[float], dataset_name: str, model_path: str):
+    """
+    Save the memory and latency of an evaluation run as csv in the scores dir.
+
+    Args:
+        vlm (VisualLanguageModelForCharts): Evaluated model.
+        latencies (list[float]): Seconds per prediction.
+        dataset_name (str): The name of the evaluated dataset.
+        model_path (str): Model name and precision used in the file names of the run.
+    """
+    latency = pd.Series(latencies)
+    performance_df = pd.DataFrame([{
+        "Precision": vlm.precision,
+        "Model memory (MB)": round(vlm.model_bytes() / 2**20, 1),
+        # ru_maxrss is in KB on linux
+        "Peak RSS (MB)": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 1),
+        "Latency mean (s)": round(latency.mean(), 3),
+        "Latency p50 (s)": round(latency.quantile(0.5), 3),
+        "Latency p95 (s)": round(latency.quantile(0.95), 3),
+    }])
+    print(f"\n{performance_df.to_string(index=False)}")
+    performance_df.to_csv(Path(SCORES_PATH) / f"performance_{dataset_name}-{model_path}.csv", sep=";", index=False)
+
 def retrieve_image_file(images_dir:str, filename:str):
     image_path = os.path.join(images_dir, filename)
     path = Path(image_path)
@@ -125,14 +165,22 @@ if __name__== "__main__":
     dotenv.load_dotenv(ENV_PATH)
     MODEL_NAME = os.getenv("MODEL_NAME") 
     FORCE_CPU = os.getenv("FORCE_CPU", "true").lower() == "true"
+    # evaluate one precision per run ("fp32", "bf16" or "int8") to compare accuracy, memory and latency
+    PRECISION = os.getenv("PRECISION") or None
+    DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME") or None
+    DRAFT_TOKENS = int(os.getenv("DRAFT_TOKENS", "4"))
+    # score the allowed answers of binary and option questions instead of generating freely
+    CONSTRAINED_ANSWERS = os.getenv("CONSTRAINED_ANSWERS", "true").lower() == "true"
+    # maximum new tokens per answer kind, e.g. {"short": 32}, on top of the defaults
+    ANSWER_TOKEN_BUDGETS = json.loads(os.getenv("ANSWER_TOKEN_BUDGETS") or "{}")
     
     # Load model
     print("Loading:", MODEL_NAME)
     vlm = VisualLanguageModelForCharts()
-    vlm.load_model(MODEL_NAME, FORCE_CPU)
+    vlm.load_model(MODEL_NAME, FORCE_CPU, draft_model_path=DRAFT_MODEL_NAME, draft_tokens=DRAFT_TOKENS, token_budgets=ANSWER_TOKEN_BUDGETS, precision=PRECISION)
 
     # evaluate one at a time and store results in "/scores" directory
     # scivqa dataset
-    #evaluate(vlm=vlm, eval_type="scivqa", model_path=MODEL_NAME)
+    #evaluate(vlm=vlm, eval_type="scivqa", model_path=MODEL_NAME, constrained=CONSTRAINED_ANSWERS)
     # hololens dataset
-    evaluate(vlm=vlm, eval_type="hololens",  model_path=MODEL_NAME)
\ No newline at end of file
+    evaluate(vlm=vlm, eval_type="hololens",  model_path=MODEL_NAME, constrained=CONSTRAINED_ANSWERS)
\ No newline at end of file
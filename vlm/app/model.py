@@ -1,34 +1,196 @@
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-from PIL import Image
+import torch, re, hashlib
+from threading import Thread
+from typing import Iterable, Iterator
+from transformers import AutoProcessor, AutoModelForImageTextToText, TextIteratorStreamer, DynamicCache, StoppingCriteriaList
+from PIL import Image, ImageDraw
+from .prefix_cache import PrefixCache
+from .vision_cache import VisionCache
+from .speculative import SpeculativeDecoder
+from .compiled import CompiledDecoder
+from .budgets import AnswerBudgets, SENTENCE_END
+from .cancellation import Cancellations, CancelToken, Cancelled
+from .snapshots import ModelSnapshots
+from .startup import StartupPhases
+
+# weight precisions of `load_model`, int8 quantizes the linear layers of the language model dynamically (cpu only)
+PRECISIONS = ("fp32", "fp16", "bf16", "int8")
 
 class VisualLanguageModelForCharts():
     """
     Class for inference of a Visual Language Model from Hugging Face (e.g. OpenGVLab/InternVL3_5-8B-HF)
     """
-    def load_model(self, model_path:str, force_cpu: bool):
+    def load_model(
+        self,
+        model_path:str,
+        force_cpu: bool,
+        prefix_cache_size: int = 8,
+        vision_cache_mb: int = 1024,
+        vision_cache_dir: str | None = None,
+        vision_cache_disk_mb: int = 4096,
+        draft_model_path: str | None = None,
+        draft_tokens: int = 4,
+        token_budgets: dict[str, int] | None = None,
+        precision: str | None = None,
+        compile: bool = False,
+        compile_max_tokens: int = 4096,
+        compile_cache_dir: str | None = None,
+        snapshot_dir: str | None = None,
+        startup: StartupPhases | None = None,
+    ):
         """
         Load vlm specified by the name in model card.
 
+        The KV cache of the system prompt is computed once here, so requests only
+        prefill the image and the question. If a draft model is given, `run_vlm` and
+        `stream_vlm` use speculative decoding: the draft model proposes tokens and
+        this model verifies them, with the same answers as without it.
+
+        The precision trades accuracy for memory and latency: "bf16" halves the
+        weights (on cpus without native bf16 support it falls back to "fp32", since
+        emulated bf16 is slower), "int8" quantizes the weights of the language model's
+        linear layers and the output head to 8 bit and quantizes their activations
+        on the fly, while the vision tower and the embeddings stay in fp32.
+
+        With `compile`, single answers decode with a compiled forward pass on a static
+        KV cache (see `CompiledDecoder`), compiled here at startup. It is not used
+        together with a draft model.
+
+        With `snapshot_dir`, the model converted to its dtype is written there as a
+        safetensors snapshot on the first start and memory-mapped from it on later
+        starts (see `ModelSnapshots`). The phases of loading are timed in `startup`.
+
         Args:
             model_path (str): Path of the model specified in the model card in hugging face hub.
             force_cpu (bool): Select cpu specifically.
+            prefix_cache_size (int): Number of system prompt prefixes (one per dynamic prompt) kept in the prefix cache, 0 disables it.
+            vision_cache_mb (int): Memory budget of the vision embedding cache in MB, 0 disables it.
+            vision_cache_dir (str | None): Directory of the on-disk tier of the vision embedding cache, None disables it.
+            vision_cache_disk_mb (int): Disk budget of the vision embedding cache in MB.
+            draft_model_path (str | None): Smaller model of the same tokenizer family drafting tokens (e.g. OpenGVLab/InternVL3-2B-hf), None disables speculative decoding.
+            draft_tokens (int): Number of tokens the draft model proposes per step.
+            token_budgets (dict[str, int] | None): Maximum new tokens per kind of answer, overriding the defaults of `AnswerBudgets`.
+            precision (str | None): Weight precision, one of `PRECISIONS`; None for fp32 on cpu and fp16 on cuda.
+            compile (bool): Decode single answers with a compiled decode step and a static KV cache.
+            compile_max_tokens (int): Tokens of the static KV cache, prompts with their answer budget beyond it decode eagerly.
+            compile_cache_dir (str | None): Directory persisting the compiled kernels across restarts, None for a temporary directory.
+            snapshot_dir (str | None): Directory of the load-ready model snapshots, None to always load from `model_path`.
+            startup (StartupPhases | None): Timings of the startup phases, None to time them on their own.
+
+        Raises:
+            IncompatibleDraftModel: If the draft model does not share the tokenizer of this model.
+            ValueError: If a token budget is given for an unknown kind of answer or the precision
+                is unknown or not supported on the device.
         """
+        self.startup = startup or StartupPhases()
+        self.budgets = AnswerBudgets(token_budgets)
+        self.cancellations = Cancellations()
         self.device = self.__pick_device(force_cpu)
-        dtype = torch.float32 if self.device.type == "cpu" else torch.float16 # because cpu has more gb in the server
+        self.precision = self.__pick_precision(precision)
+        # int8 is quantized from fp32 weights after loading
+        dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16, "int8": torch.float32}[self.precision]
 
-        self.processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
-        self.model = AutoModelForImageTextToText.from_pretrained(
-        pretrained_model_name_or_path=model_path,
-        trust_remote_code=True,
-        torch_dtype=dtype,  
-        device_map=None,     
-        ).to(self.device)
+        snapshots = ModelSnapshots(snapshot_dir) if snapshot_dir else None
+        snapshot = snapshots.find(model_path, dtype) if snapshots else None
+        source = snapshot or model_path
+        with self.startup.phase("processor"):
+            self.processor = AutoProcessor.from_pretrained(source, trust_remote_code=True)
+            # batched generation appends new tokens on the right, so prompts are padded on the left
+            self.processor.tokenizer.padding_side = "left"
+        with self.startup.phase("weights_snapshot" if snapshot else "weights"):
+            self.model = AutoModelForImageTextToText.from_pretrained(
+            pretrained_model_name_or_path=source,
+            trust_remote_code=True,
+            torch_dtype=dtype,  
+            device_map=None,     
+            ).to(self.device)
+        if snapshots and not snapshot:
+            with self.startup.phase("write_snapshot"):
+                print(f"Snapshot of {model_path} written to {snapshots.save(self.model, self.processor, model_path, dtype)}")
 
         self.model.eval()
+        if self.precision == "int8":
+            with self.startup.phase("quantize"):
+                self.__quantize_language_model()
+
+        self.vision_cache = VisionCache(vision_cache_mb * 2**20, vision_cache_dir, vision_cache_disk_mb * 2**20)
+        # vision features depend on the weights and on how images are cut into tiles
+        settings = f"{model_path}|{self.processor.image_processor.to_json_string()}|{self.processor.image_seq_length}|{dtype}"
+        self.vision_settings = hashlib.sha256(settings.encode()).digest()
+
+        self.prefix_cache = PrefixCache(prefix_cache_size)
+        with self.startup.phase("prefix_cache"):
+            self.cache_prefix("")
+
+        # tokens the chat template puts in front of an answer, fixed answers are scored after them
+        conversation = [{"role": "user", "content": [{"type": "text", "text": ""}]}]
+        without_prompt = self.processor.apply_chat_template(conversation, tokenize=False)
+        with_prompt = self.processor.apply_chat_template(conversation, add_generation_prompt=True, tokenize=False)
+        self.answer_prefix_ids = self.processor.tokenizer.encode(with_prompt[len(without_prompt):], add_special_tokens=False)
+
+        eos = self.model.generation_config.eos_token_id
+        self.eos_ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+
+        self.draft = None
+        self.speculative = None
+        if draft_model_path:
+            draft = VisualLanguageModelForCharts()
+            with self.startup.phase("draft_model"):
+                draft.load_model(
+                    draft_model_path,
+                    force_cpu,
+                    prefix_cache_size=prefix_cache_size,
+                    vision_cache_mb=vision_cache_mb,
+                    vision_cache_dir=vision_cache_dir and f"{vision_cache_dir}/draft",
+                    vision_cache_disk_mb=vision_cache_disk_mb,
+                    precision=precision,
+                    snapshot_dir=snapshot_dir,
+                )
+            SpeculativeDecoder.check_tokenizers(self.processor.tokenizer, draft.processor.tokenizer)
+            self.draft = draft
+            self.speculative = SpeculativeDecoder(self, draft, draft_tokens, self.eos_ids)
+
+        self.compiled = None
+        if compile:
+            self.compile_decoder(compile_max_tokens, compile_cache_dir)
+
+    def compile_decoder(self, max_cache_len: int = 4096, cache_dir: str | None = None):
+        """
+        Compile the decode step of single answers on a static KV cache (see `CompiledDecoder`).
+
+        `load_model` calls it with `compile`. Forked workers call it themselves after
+        setting their thread count, since the compiled kernels are built for the
+        number of threads of the process compiling them.
+
+        Args:
+            max_cache_len (int): Tokens of the static KV cache, prompts with their answer budget beyond it decode eagerly.
+            cache_dir (str | None): Directory persisting the compiled kernels across restarts, None for a temporary directory.
+        """
+        if self.speculative is not None:
+            print("Compiled decoding is not used together with a draft model, decoding speculatively")
+            return
+        with self.startup.phase("compile"):
+            self.compiled = CompiledDecoder(self, max_cache_len, cache_dir, self.eos_ids)
+            self.compiled.warmup()
+
+    def warmup(self, max_new_tokens: int = 8):
+        """
+        Answer a synthetic chart question the way a request is answered.
+
+        The first forward passes of a process allocate their buffers and pick their
+        kernels, so without a warmup the first request pays for it.
+
+        Args:
+            max_new_tokens (int): Tokens to generate.
+        """
+        chart = Image.new("RGB", (800, 600), "white")
+        draw = ImageDraw.Draw(chart)
+        for bar, height in enumerate((120, 260, 180, 340)):
+            draw.rectangle([100 + bar * 160, 540 - height, 200 + bar * 160, 540], fill=(60, 90, 200))
+        with self.startup.phase("warmup"):
+            self.run_vlm("Which bar is the highest?", "", chart, max_new_tokens, "short")
 
     @torch.inference_mode()
-    def run_vlm(self, prompt: str, dynamic_prompt:str, chart: Image.Image,  max_new_tokens: int=128) -> str:
+    def run_vlm(self, prompt: str, dynamic_prompt:str, chart: Image.Image,  max_new_tokens: int | None = None, answer_kind: str = "free", cancel: CancelToken | None = None) -> str:
         """
         Run inference for a prompt-chart pair.
 
@@ -36,9 +198,455 @@ class VisualLanguageModelForCharts():
             prompt (str): Question on the chart.
             dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
             chart (PIL.Image.Image): Chart image.
+            max_new_tokens (int | None): Maximum number of tokens to generate, None for the budget of the answer kind.
+            answer_kind (str): Kind of answer ("binary", "options", "short", "unanswerable" or "free"),
+                selecting the token budget and where generation stops.
+            cancel (CancelToken | None): Cancel flag of the request, generation stops at the next token once it is set.
 
         Returns:
             str: Response of the model.
+
+        Raises:
+            Cancelled: If the request was cancelled before its answer was complete.
+        """
+        max_new_tokens = self.budgets.max_new_tokens(answer_kind, max_new_tokens)
+        self.__start(cancel, max_new_tokens)
+        inputs = self.embed_inputs(prompt, dynamic_prompt, chart)
+
+        # generate encoded response, generating from embeddings returns the new tokens only
+        if self.speculative is not None:
+            draft_inputs = self.draft.embed_inputs(prompt, dynamic_prompt, chart)
+            output_ids = [self.speculative.generate(inputs, draft_inputs, max_new_tokens, stop=self.__answer_stop(answer_kind, cancel))]
+        elif self.compiled is not None and self.compiled.fits(inputs, max_new_tokens):
+            output_ids = [self.compiled.generate(inputs, max_new_tokens, stop=self.__answer_stop(answer_kind, cancel))]
+        else:
+            output_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                stopping_criteria=self.__stopping_criteria([answer_kind], [cancel]),
+            )
+
+        return self.__finish_answer(output_ids[0], answer_kind, max_new_tokens, cancel)
+    
+    @torch.inference_mode()
+    def run_vlm_batch(self, prompts: list[str], dynamic_prompt: str, charts: list[Image.Image], max_new_tokens: list[int], answer_kinds: list[str] | None = None, cancels: list[CancelToken | None] | None = None) -> list[str | Cancelled]:
+        """
+        Run inference for several prompt-chart pairs in one padded batch.
+
+        All pairs share one `model.generate` call. Generation runs up to the largest
+        token budget of the batch, or until every answer is complete, and every answer
+        is cut to its own budget afterwards. Cancelled rows stop early and get their
+        error instead of an answer.
+
+        Args:
+            prompts (list[str]): Questions on the charts.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt, shared by the batch.
+            charts (list[PIL.Image.Image]): Chart images, one per prompt.
+            max_new_tokens (list[int]): Maximum number of tokens to generate, one per prompt.
+            answer_kinds (list[str] | None): Kind of answer, one per prompt, None for free answers.
+            cancels (list[CancelToken | None] | None): Cancel flag, one per prompt, None if no request can be cancelled.
+
+        Returns:
+            list[str | Cancelled]: Responses of the model in the order of the prompts, or
+                the error of requests that were cancelled.
+        """
+        answer_kinds = answer_kinds or ["free"] * len(prompts)
+        cancels = cancels or [None] * len(prompts)
+        for cancel in cancels:
+            if cancel is not None:
+                cancel.start()
+        conversations = [self.__build_messages(prompt, dynamic_prompt, chart) for prompt, chart in zip(prompts, charts)]
+        inputs = self.__generation_inputs(self.__tokenize(conversations))
+
+        output_ids = self.model.generate(
+            **inputs,
+            max_new_tokens=max(max_new_tokens),
+            do_sample=False,
+            stopping_criteria=self.__stopping_criteria(answer_kinds, cancels),
+        )
+
+        answers = []
+        for ids, kind, budget, cancel in zip(output_ids, answer_kinds, max_new_tokens, cancels):
+            try:
+                answers.append(self.__finish_answer(ids[:budget], kind, budget, cancel))
+            except Cancelled as e:
+                answers.append(e)
+        return answers
+
+    def stream_vlm(self, prompt: str, dynamic_prompt: str, chart: Image.Image, max_new_tokens: int | None = None, answer_kind: str = "free", cancel: CancelToken | None = None) -> Iterator[str]:
+        """
+        Run inference for a prompt-chart pair and yield the response sentence by sentence.
+
+        Generation runs in a background thread and feeds a token streamer. Decoded text
+        is buffered until a sentence is complete, cleaned up for tts and then yielded,
+        so a client can start speaking before the whole answer is generated. If the
+        consumer stops iterating before the end of the answer (e.g. the client went
+        away), the request is cancelled and generation stops.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+            max_new_tokens (int | None): Maximum number of tokens to generate, None for the budget of the answer kind.
+            answer_kind (str): Kind of answer, selecting the token budget and where generation stops.
+            cancel (CancelToken | None): Cancel flag of the request, generation stops at the next token once it is set.
+
+        Yields:
+            str: Cleaned-up sentence chunks of the response.
+
+        Raises:
+            Cancelled: If the request was cancelled before its answer was complete.
+            Exception: Any error raised by the model during generation.
+        """
+        max_new_tokens = self.budgets.max_new_tokens(answer_kind, max_new_tokens)
+        cancel = cancel or self.cancellations.token()
+        self.__start(cancel, max_new_tokens)
+        inputs = self.embed_inputs(prompt, dynamic_prompt, chart)
+        draft_inputs = self.draft.embed_inputs(prompt, dynamic_prompt, chart) if self.speculative is not None else None
+        compiled = self.compiled is not None and self.compiled.fits(inputs, max_new_tokens)
+        streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        output_ids = []
+        errors = []
+
+        def generate():
+            try:
+                with torch.inference_mode():
+                    if self.speculative is not None:
+                        ids = self.speculative.generate(inputs, draft_inputs, max_new_tokens, streamer, stop=self.__answer_stop(answer_kind, cancel))
+                    elif compiled:
+                        ids = self.compiled.generate(inputs, max_new_tokens, streamer, stop=self.__answer_stop(answer_kind, cancel))
+                    else:
+                        criteria = self.__stopping_criteria([answer_kind], [cancel])
+                        ids = self.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, streamer=streamer, stopping_criteria=criteria)[0]
+                # finished here, so a cancelled stream is recorded even without a consumer
+                self.__finish_answer(ids, answer_kind, max_new_tokens, cancel)
+            except Exception as e:
+                errors.append(e)
+                # unblock the consumer, the streamer only ends itself on success
+                streamer.end()
+
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+
+        try:
+            yield from self.to_sentences(self.budgets.trim_stream(answer_kind, streamer))
+        except GeneratorExit:
+            # the consumer left before the end of the answer
+            cancel.cancel("disconnect")
+            raise
+        # the streamer may be left early at the end of the answer, generation stops right after it
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    @torch.inference_mode()
+    def choose_answer(self, prompt: str, dynamic_prompt: str, chart: Image.Image, candidates: list[str], cancel: CancelToken | None = None) -> str:
+        """
+        Pick the most likely of a fixed set of answers for a prompt-chart pair, e.g. "Yes"/"No" or option letters.
+
+        Instead of free generation, the prompt is prefilled once and all candidates,
+        each followed by the end token, are scored together in one forward pass on
+        top of it. The candidate with the highest total log-probability wins.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+            candidates (list[str]): Allowed answers, not empty.
+            cancel (CancelToken | None): Cancel flag of the request, checked before the prompt is prefilled.
+
+        Returns:
+            str: The chosen candidate.
+
+        Raises:
+            Cancelled: If the request was cancelled before it started.
+        """
+        self.__start(cancel, 0)
+        inputs = self.embed_inputs(prompt, dynamic_prompt, chart)
+        answer_prefix = self.model.get_input_embeddings()(torch.tensor([self.answer_prefix_ids], device=self.device))
+        inputs["inputs_embeds"] = torch.cat([inputs["inputs_embeds"], answer_prefix], dim=1)
+        cache, logits = self.prefill(inputs)
+
+        eos = self.model.generation_config.eos_token_id
+        eos = eos[0] if isinstance(eos, list) else eos
+        answers = [self.processor.tokenizer.encode(candidate, add_special_tokens=False) + [eos] for candidate in candidates]
+        scores = [float(logits.log_softmax(-1)[ids[0]]) for ids in answers]
+
+        length = max(len(ids) for ids in answers)
+        if length > 1:
+            # all but the last token of every answer, padded at the end where padding cannot influence them
+            input_ids = torch.tensor([ids[:-1] + [eos] * (length - len(ids)) for ids in answers], device=self.device)
+            cache = DynamicCache.from_legacy_cache(tuple((k.repeat(len(answers), 1, 1, 1), v.repeat(len(answers), 1, 1, 1)) for k, v in cache.to_legacy_cache()))
+            log_probs = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True).logits.log_softmax(-1)
+            for i, ids in enumerate(answers):
+                scores[i] += float(log_probs[i, torch.arange(len(ids) - 1), ids[1:]].sum())
+        return candidates[max(range(len(candidates)), key=scores.__getitem__)]
+
+    @torch.inference_mode()
+    def prefill(self, inputs: dict) -> tuple[DynamicCache, torch.Tensor]:
+        """
+        Run a single prompt through the model, continuing from its prefix cache if there is one.
+
+        Args:
+            inputs (dict): Generation inputs from `embed_inputs`.
+
+        Returns:
+            tuple[DynamicCache, torch.Tensor]: KV cache of the whole prompt and the logits of the next token.
+        """
+        cache = inputs.get("past_key_values") or DynamicCache()
+        past = cache.get_seq_length()
+        embeds = inputs["inputs_embeds"][:, past:]
+        positions = torch.arange(past, past + embeds.shape[1], device=embeds.device)
+        out = self.model(
+            inputs_embeds=embeds,
+            position_ids=positions.unsqueeze(0),
+            cache_position=positions,
+            past_key_values=cache,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        return cache, out.logits[0, -1]
+
+    @torch.inference_mode()
+    def embed_inputs(self, prompt: str, dynamic_prompt: str, chart: Image.Image) -> dict:
+        """
+        Build the generation inputs of a prompt-chart pair, continuing from the cached system prompt.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+
+        Returns:
+            dict: Generation inputs (inputs_embeds, attention_mask and past_key_values if a prefix is cached).
+        """
+        return self.__generation_inputs(self.__build_inputs(prompt, dynamic_prompt, chart))
+
+    def prepare_inputs(self, prompt: str, dynamic_prompt: str, chart: Image.Image) -> dict:
+        """
+        Tokenize a prompt-chart pair for generation outside of `model.generate`, e.g. by a batching engine.
+
+        The image is not encoded: on a vision cache miss the caller runs the vision
+        tower on `pixel_values` and stores the result with `vision_cache.put`.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+
+        Returns:
+            dict: Model inputs (input_ids, attention_mask) on the model device and, per image, its
+                cache key (image_keys) and either its cached features (image_features) or its
+                preprocessed tiles (pixel_values).
+        """
+        return self.__build_inputs(prompt, dynamic_prompt, chart, encode_images=False)
+
+    @torch.inference_mode()
+    def cache_prefix(self, dynamic_prompt: str) -> int:
+        """
+        Compute the KV cache of the system prompt for a dynamic prompt ahead of the first request using it.
+
+        Args:
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+
+        Returns:
+            int: Number of prefix tokens, 0 if the prefix cache is disabled.
+        """
+        # the prefix ends before the image, so any image and question will do
+        inputs = self.__build_inputs("", dynamic_prompt, Image.new("RGB", (32, 32)), encode_images=False)
+        _, prefix_len = self.prefill_prefix(inputs["input_ids"])
+        return prefix_len
+
+    @torch.inference_mode()
+    def prefill_prefix(self, input_ids: torch.Tensor, batch_size: int = 1) -> tuple[DynamicCache, int]:
+        """
+        Get a KV cache holding the system prompt prefix of a tokenized prompt.
+
+        The prefix is everything before the first image token. Its KV cache is taken
+        from the prefix cache or computed and stored there.
+
+        Args:
+            input_ids (torch.Tensor): Token ids of a single prompt, shape [1, seq_len], without padding.
+            batch_size (int): Number of sequences the returned cache is copied for.
+
+        Returns:
+            tuple[DynamicCache, int]: A fresh copy of the prefix cache and the number of
+                prefix tokens; an empty cache and 0 if the prefix cache is disabled.
+        """
+        image_positions = (input_ids[0] == getattr(self.model.config, "image_token_id", -1)).nonzero()
+        if not self.prefix_cache.enabled or len(image_positions) == 0:
+            return DynamicCache(), 0
+
+        prefix_len = int(image_positions[0])
+        key = tuple(input_ids[0, :prefix_len].tolist())
+        kv = self.prefix_cache.get(key)
+        if kv is None:
+            out = self.model(input_ids=input_ids[:, :prefix_len], use_cache=True, logits_to_keep=1)
+            kv = out.past_key_values.to_legacy_cache()
+            self.prefix_cache.put(key, kv)
+        return DynamicCache.from_legacy_cache(tuple((k.repeat(batch_size, 1, 1, 1), v.repeat(batch_size, 1, 1, 1)) for k, v in kv)), prefix_len
+
+    def model_bytes(self) -> int:
+        """
+        Memory held by the weights and buffers of the model, including a draft model.
+
+        Returns:
+            int: Bytes of all parameters, buffers and packed quantized weights.
+        """
+        total = 0
+        for value in self.model.state_dict().values():
+            # quantized linear layers keep their weight and bias as a packed tuple
+            for tensor in value if isinstance(value, tuple) else (value,):
+                if isinstance(tensor, torch.Tensor):
+                    total += tensor.numel() * tensor.element_size()
+        return total + (self.draft.model_bytes() if self.draft is not None else 0)
+
+    def clean_answer(self, text: str) -> str:
+        """
+        Clean up a decoded answer for tts speech.
+
+        Args:
+            text (str): Decoded answer.
+
+        Returns:
+            str: Cleaned-up answer.
+        """
+        return self.__tts_cleanup(text.strip())
+
+    def to_sentences(self, texts: Iterable[str]) -> Iterator[str]:
+        """
+        Regroup incrementally decoded text into cleaned-up sentences.
+
+        Args:
+            texts (Iterable[str]): Pieces of decoded text in generation order.
+
+        Yields:
+            str: Cleaned-up sentences, the unterminated rest last.
+        """
+        buffer = ""
+        for new_text in texts:
+            buffer += new_text
+            *sentences, buffer = SENTENCE_END.split(buffer)
+            for sentence in sentences:
+                sentence = self.clean_answer(sentence)
+                if sentence:
+                    yield sentence
+        rest = self.clean_answer(buffer)
+        if rest:
+            yield rest
+
+    def __finish_answer(self, ids: torch.Tensor | list[int], answer_kind: str, max_new_tokens: int, cancel: CancelToken | None = None) -> str:
+        """
+        Decode generated token ids, cut the answer at its end, record its length and clean it up for tts.
+
+        Raises:
+            Cancelled: If the request was cancelled, generation may have stopped before the end of the answer.
+        """
+        ids = ids.tolist() if isinstance(ids, torch.Tensor) else ids
+        # generated tokens up to the end token, or the padding of a batch row that ended early
+        stop = self.eos_ids | {self.model.generation_config.pad_token_id}
+        generated = next((i for i, token in enumerate(ids) if token in stop), len(ids))
+        if cancel is not None and cancel.cancelled:
+            raise cancel.stopped(generated, max_new_tokens)
+        text = self.processor.decode(ids, skip_special_tokens=True)
+        answer = self.budgets.trim(answer_kind, text)
+        self.budgets.record(answer_kind, generated, max_new_tokens, answer != text)
+        return self.__tts_cleanup(answer.strip())
+
+    def __answer_stop(self, answer_kind: str, cancel: CancelToken | None = None):
+        """
+        Stop check on generated token ids for the speculative and compiled decoders.
+        """
+        end = self.budgets.answer_end(self.processor.tokenizer, answer_kind)
+        return lambda ids: (cancel is not None and cancel.cancelled) or end(ids)
+
+    def __stopping_criteria(self, answer_kinds: list[str], cancels: list[CancelToken | None]) -> StoppingCriteriaList:
+        """
+        Stop criteria of `model.generate` ending every row at the end of its answer or once its request is cancelled.
+        """
+        criteria = StoppingCriteriaList([self.budgets.stopping_criteria(self.processor.tokenizer, answer_kinds)])
+        if any(cancel is not None for cancel in cancels):
+            criteria.append(self.cancellations.stopping_criteria(cancels))
+        return criteria
+
+    def __start(self, cancel: CancelToken | None, max_new_tokens: int):
+        """
+        Mark the start of the work on a request, unless it was cancelled while waiting.
+
+        Raises:
+            Cancelled: If the request was cancelled before the model started on it.
+        """
+        if cancel is None:
+            return
+        if cancel.cancelled:
+            raise cancel.stopped(0, max_new_tokens)
+        cancel.start()
+
+    def __build_inputs(self, prompt: str, dynamic_prompt: str, chart: Image.Image, encode_images: bool = True) -> dict:
+        """
+        Build the chat messages for a prompt-chart pair and tokenize them for the model.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+            encode_images (bool): Run the vision tower on images missing in the vision cache.
+
+        Returns:
+            dict: Model inputs, see `__tokenize`.
+        """
+        return self.__tokenize([self.__build_messages(prompt, dynamic_prompt, chart)], encode_images)
+
+    @torch.inference_mode()
+    def __generation_inputs(self, inputs: dict) -> dict:
+        """
+        Turn tokenized prompts into generation inputs continuing from the cached system prompt prefix.
+
+        The prompts are embedded with the image features merged in, and the padding
+        of each prompt is moved from before the prefix to right after it, so all
+        prompts share one prefix cache. Generation then only prefills the image and
+        the question.
+
+        Args:
+            inputs (dict): Left-padded model inputs from `__tokenize` sharing a dynamic prompt.
+
+        Returns:
+            dict: Generation inputs (inputs_embeds, attention_mask and past_key_values if a prefix is cached).
+        """
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        embeds = self.model.get_input_embeddings()(input_ids)
+        features = torch.cat(inputs["image_features"]).reshape(-1, embeds.shape[-1])
+        embeds[input_ids == self.model.config.image_token_id] = features.to(embeds.dtype)
+
+        pads = (attention_mask == 0).sum(dim=1).tolist()
+        cache, prefix_len = self.prefill_prefix(input_ids[:1, pads[0]:], batch_size=len(pads))
+        prefixes = [input_ids[i, pad:pad + prefix_len] for i, pad in enumerate(pads)]
+        if prefix_len == 0 or any(not torch.equal(prefix, prefixes[0]) for prefix in prefixes):
+            return {"inputs_embeds": embeds, "attention_mask": attention_mask}
+
+        length = input_ids.shape[1]
+        order = torch.stack([
+            torch.cat([torch.arange(pad, pad + prefix_len), torch.arange(pad), torch.arange(pad + prefix_len, length)])
+            for pad in pads
+        ]).to(input_ids.device)
+        return {
+            "inputs_embeds": embeds.gather(1, order.unsqueeze(-1).expand_as(embeds)),
+            "attention_mask": attention_mask.gather(1, order),
+            "past_key_values": cache,
+        }
+
+    def __build_messages(self, prompt: str, dynamic_prompt: str, chart: Image.Image) -> list:
+        """
+        Build the chat messages for a prompt-chart pair.
+
+        Args:
+            prompt (str): Question on the chart.
+            dynamic_prompt (str): Chain of thought provoking prompt for the system prompt.
+            chart (PIL.Image.Image): Chart image.
+
+        Returns:
+            list: System and user message of the conversation.
         """
         img = chart.convert("RGB")
 
@@ -66,33 +674,78 @@ class VisualLanguageModelForCharts():
                 ],
             }
         ]
+        return messages
+
+    @torch.inference_mode()
+    def __tokenize(self, conversations: list[list], encode_images: bool = True) -> dict:
+        """
+        Tokenize a batch of conversations into padded model inputs.
+
+        Images found in the vision cache are neither preprocessed nor encoded again,
+        their image tokens are expanded from the number of cached tiles.
+
+        Args:
+            conversations (list[list]): Chat messages, one list per conversation.
+            encode_images (bool): Run the vision tower on images missing in the vision cache
+                and store their features, otherwise leave them to the caller.
+
+        Returns:
+            dict: Model inputs (input_ids, attention_mask) on the model device and, per image,
+                its cache key (image_keys), its features (image_features, None if not encoded)
+                and its preprocessed tiles (pixel_values, None if cached).
+        """
+        charts = [part["image"] for conversation in conversations for message in conversation for part in message["content"] if part["type"] == "image"]
+        keys = [self.__image_key(chart) for chart in charts]
+        features = [self.vision_cache.get(key, self.device) for key in keys]
+        pixel_values: list[torch.Tensor | None] = [None] * len(charts)
+        # the same chart may be asked about several times in a batch, it is encoded once
+        misses = {key: i for i, key in reversed(list(enumerate(keys))) if features[i] is None}
+        if misses:
+            images = self.processor.image_processor(images=[charts[i] for i in misses.values()], return_tensors="pt")
+            tiles = dict(zip(misses, images["pixel_values"].to(self.device, self.model.dtype).split(images["num_patches"].tolist())))
+            encoded = {}
+            if encode_images:
+                encoded = dict(zip(misses, self.model.get_image_features(pixel_values=torch.cat(list(tiles.values()))).split([t.shape[0] for t in tiles.values()])))
+                for key, image_features in encoded.items():
+                    self.vision_cache.put(key, image_features)
+            for i, key in enumerate(keys):
+                if features[i] is None:
+                    pixel_values[i], features[i] = tiles[key], encoded.get(key)
 
-        # Applies a Jinja template to the messages and tokenizes it 
-        inputs = self.processor.apply_chat_template(
-            conversation = messages,
+        # Applies a Jinja template to the messages, then expands the image placeholders like the processor does
+        texts = self.processor.apply_chat_template(
+            conversation = conversations,
             add_generation_query=True,
-            tokenize=True,
-            return_tensors="pt", # return pytorch tensor (torch.Tesor(shape[batch, seq_len]))
-            return_dict=True, # keys: input_ids, attention_mask
+            tokenize=False,
         )
+        num_tiles = iter([f.shape[0] if f is not None else p.shape[0] for f, p in zip(features, pixel_values)])
+        texts = [
+            re.sub(re.escape(self.processor.image_token), lambda _: self.__image_tokens(next(num_tiles)), text)
+            for text in texts
+        ]
+        inputs = self.processor.tokenizer(texts, padding=True, return_tensors="pt") # return pytorch tensor (torch.Tesor(shape[batch, seq_len]))
 
         # make inputs device specific
-        inputs = {k: v.to(self.device) if hasattr(v, "to") else v for k, v in inputs.items()}
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        inputs.update(image_keys=keys, image_features=features, pixel_values=pixel_values)
 
-        # generate encoded response
-        output_ids = self.model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False,
-        )
+        return inputs
+
+    def __image_tokens(self, num_tiles: int) -> str:
+        """
+        Text standing in for an image of `num_tiles` tiles in the prompt.
+        """
+        return f"{self.processor.start_image_token}{self.processor.image_token * self.processor.image_seq_length * num_tiles}{self.processor.end_image_token}"
+
+    def __image_key(self, chart: Image.Image) -> str:
+        """
+        Vision cache key of an image: hash of its pixels and the preprocessing settings.
+        """
+        digest = hashlib.sha256(self.vision_settings)
+        digest.update(f"{chart.mode}|{chart.size}".encode())
+        digest.update(chart.tobytes())
+        return digest.hexdigest()
 
-        # decode
-        query_len = inputs["input_ids"].shape[1]
-        generated_answer_ids = output_ids[:, query_len:]
-        text = self.processor.batch_decode(generated_answer_ids, skip_special_tokens=True)[0]
-        tts_friendly_resp = self.__tts_cleanup(text.strip())
-        return tts_friendly_resp
-    
     def __pick_device(self, force_cpu: bool) -> torch.device:
         """
         Pick cpu or a cuda supporting device if available.
@@ -107,6 +760,45 @@ class VisualLanguageModelForCharts():
             return torch.device("cpu")
         return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
        
+    def __pick_precision(self, precision: str | None) -> str:
+        """
+        Validate the requested precision against the device.
+
+        Args:
+            precision (str | None): Requested precision, None for the default of the device.
+
+        Returns:
+            str: Precision to load the model in.
+
+        Raises:
+            ValueError: If the precision is unknown or int8 is requested on cuda.
+        """
+        if precision is None:
+            # cpu has more gb in the server
+            return "fp32" if self.device.type == "cpu" else "fp16"
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+        if precision == "int8" and self.device.type != "cpu":
+            raise ValueError("Precision 'int8' uses dynamic quantization, which runs on cpu only")
+        if precision == "bf16":
+            supported = torch.cuda.is_bf16_supported() if self.device.type == "cuda" else torch.ops.mkldnn._is_mkldnn_bf16_supported()
+            if not supported:
+                fallback = "fp32" if self.device.type == "cpu" else "fp16"
+                print(f"Precision 'bf16' is not supported natively by this {self.device.type}, loading in {fallback}")
+                return fallback
+        return precision
+
+    def __quantize_language_model(self):
+        """
+        Replace the linear layers of the language model and the output head with dynamically quantized int8 layers.
+        """
+        targets = (self.model.language_model, self.model.get_output_embeddings())
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        spec = {name: qconfig for name, module in self.model.named_modules() if any(module is target for target in targets)}
+        # only linear layers are swapped, the token embeddings of the language model stay in fp32
+        mapping = {torch.nn.Linear: torch.ao.nn.quantized.dynamic.Linear}
+        torch.ao.quantization.quantize_dynamic(self.model, qconfig_spec=spec, dtype=torch.qint8, mapping=mapping, inplace=True)
+
     def __tts_cleanup(self, text: str) -> str:
         """
         Remove special chars or hard-to-spell words for tts speech.
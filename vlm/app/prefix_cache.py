@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+import torch
+
+# per layer key and value states of shape [batch, heads, tokens, head_dim]
+LegacyCache = tuple[tuple[torch.Tensor, torch.Tensor], ...]
+
+class PrefixCache():
+    """
+    LRU cache of the KV cache of prompt prefixes.
+
+    Every prompt starts with the same system text, followed by the dynamic prompt, so
+    the keys and values of these tokens only need to be computed once. Entries are
+    keyed by the token ids of the prefix and hold its KV cache for a single sequence;
+    callers copy it before generating on top of it.
+    """
+    def __init__(self, max_entries: int = 8):
+        """
+        Args:
+            max_entries (int): Maximum number of cached prefixes, 0 disables the cache.
+        """
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[int, ...], LegacyCache] = OrderedDict()
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.saved_tokens = 0
+        self.computed_tokens = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: tuple[int, ...]) -> LegacyCache | None:
+        """
+        Look up the KV cache of a prefix.
+
+        Args:
+            key (tuple[int, ...]): Token ids of the prefix.
+
+        Returns:
+            LegacyCache | None: Cached keys and values, or None on a miss.
+        """
+        with self.lock:
+            self.lookups += 1
+            kv = self.entries.get(key)
+            if kv is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_tokens += len(key)
+            return kv
+
+    def put(self, key: tuple[int, ...], kv: LegacyCache):
+        """
+        Store the KV cache of a prefix, evicting the least recently used one if full.
+
+        Args:
+            key (tuple[int, ...]): Token ids of the prefix.
+            kv (LegacyCache): Keys and values of the prefix for a single sequence.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.computed_tokens += len(key)
+            self.entries[key] = kv
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Prefix cache counters.
+
+        Returns:
+            dict: Settings, cached prefixes, lookups, hits, hit rate, prefill tokens
+                saved by hits and prefix tokens computed on misses.
+        """
+        with self.lock:
+            return {
+                "max_entries": self.max_entries,
+                "entries": len(self.entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "saved_prefill_tokens": self.saved_tokens,
+                "computed_prefix_tokens": self.computed_tokens,
+            }
@@ -1,9 +1,12 @@
 
 import re
 from typing import Any, MutableMapping, Mapping
-import ast
+import ast, itertools
 from collections.abc import Mapping
 
+# answer the prompt asks for when a question cannot be answered from the chart
+UNANSWERABLE_ANSWER = "It is not possible to answer this question based only on the provided data."
+
 def build_dynamic_prompt(entry: Any | Mapping | list | MutableMapping | dict) -> str:
     """
     Build a dynamic prompt for the model based on the provided entry.
@@ -57,7 +60,7 @@ def build_dynamic_prompt(entry: Any | Mapping | list | MutableMapping | dict) ->
             prompt += "\nRespond only with the corresponding option keyword(s) (e.g., 'A' or 'A,B' if multiple apply, without space between)."
             prompt += "\nDo not include explanations, full sentences, or option text."
 
-    prompt += "\nIf the answer cannot be inferred from the figure and caption, please reply with the sentence: 'It is not possible to answer this question based only on the provided data.'"
+    prompt += f"\nIf the answer cannot be inferred from the figure and caption, please reply with the sentence: '{UNANSWERABLE_ANSWER}'"
 
     prompt += (
         "\n"
@@ -76,6 +79,54 @@ def build_dynamic_prompt(entry: Any | Mapping | list | MutableMapping | dict) ->
     return prompt.strip()
 
 
+def build_answer_options(entry: Any | Mapping | list | MutableMapping | dict) -> list[str] | None:
+    """
+    Build the allowed answers of a finite-answer-set question, matching the format
+    that `build_dynamic_prompt` asks the model for.
+
+    Binary questions are answered with 'Yes' or 'No', option questions with one or
+    more option keywords joined by a comma (e.g. 'A' or 'A,B'). Since the prompt
+    allows every question to be declined, `UNANSWERABLE_ANSWER` is allowed as well.
+
+    Args:
+        entry (dict): A dictionary containing the information needed to build the prompt. Based on the Dataset format from SciVQA.
+
+    Returns:
+        list[str] | None: The allowed answers, or None if the answer set is not finite or
+            the question is unanswerable, which is left to generation.
+    """
+    qa_types = parse_qa_types(entry.get("qa_pair_type"))
+    if "finite answer set" not in qa_types or "unanswerable" in qa_types:
+        return None
+    if "binary" in qa_types:
+        return ["Yes", "No", UNANSWERABLE_ANSWER]
+
+    parsed_options = ast.literal_eval(str(entry.get("answer_options", "")))
+    keys = [k for d in parsed_options for k, v in d.items() if v is not None]
+    if not keys:
+        return None
+    return [",".join(combination) for size in range(1, len(keys) + 1) for combination in itertools.combinations(keys, size)] + [UNANSWERABLE_ANSWER]
+
+def answer_kind(entry: Any | Mapping | list | MutableMapping | dict) -> str:
+    """
+    Classify the answer a question asks for, which selects its token budget and stop criteria.
+
+    Args:
+        entry (dict): A dictionary containing the information needed to build the prompt. Based on the Dataset format from SciVQA.
+
+    Returns:
+        str: "unanswerable", "binary", "options", "short" for an infinite answer set, or "free"
+            for questions without a QA type, such as live questions from the Hololens app.
+    """
+    qa_types = parse_qa_types(entry.get("qa_pair_type"))
+    if "unanswerable" in qa_types:
+        return "unanswerable"
+    if "finite answer set" in qa_types:
+        return "binary" if "binary" in qa_types else "options"
+    if "infinite answer set" in qa_types:
+        return "short"
+    return "free"
+
 def parse_qa_types(qa_type_raw: str) -> set[str]:
     """
     Parse the QA type string to identify the types of questions.
@@ -0,0 +1,292 @@
+import gc, threading, time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from .batching import MicroBatcher
+from .engine import ContinuousBatchingEngine
+
+# schedulers of a served model, see `ServedModel`
+SCHEDULERS = ("continuous", "static", "none")
+
+class ServedModel():
+    """
+    A loaded model with the scheduler serving its requests.
+
+    "continuous" batches the requests at every decode step, "static" micro-batches
+    whole requests and "none" runs every request on its own.
+    """
+    def __init__(self, name: str, vlm, scheduler: str = "continuous", max_batch_size: int = 4, batch_window: float = 0.02, prefill_chunk: int = 256):
+        """
+        Args:
+            name (str): Name of the model, as requested by clients.
+            vlm (VisualLanguageModelForCharts): Loaded model.
+            scheduler (str): One of `SCHEDULERS`.
+            max_batch_size (int): Maximum number of requests batched together.
+            batch_window (float): Seconds the micro-batcher waits for more requests after the first one.
+            prefill_chunk (int): Prompt tokens the continuous batching engine prefills between two decode steps.
+
+        Raises:
+            ValueError: If the scheduler is unknown.
+        """
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f"Unknown scheduler {scheduler!r}, expected one of {SCHEDULERS}")
+        self.name = name
+        self.vlm = vlm
+        self.scheduler = scheduler
+        self.engine = ContinuousBatchingEngine(vlm, max_batch_size=max_batch_size, prefill_chunk=prefill_chunk) if scheduler == "continuous" else None
+        self.batcher = MicroBatcher(vlm.run_vlm_batch, window=batch_window, max_batch_size=max_batch_size) if scheduler == "static" else None
+        self.bytes = vlm.model_bytes()
+        self.pinned = False
+        self.in_flight = 0
+        self.requests = 0
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+    def start(self):
+        """
+        Start the scheduler.
+        """
+        for scheduler in (self.engine, self.batcher):
+            if scheduler is not None:
+                scheduler.start()
+
+    def stop(self):
+        """
+        Stop the scheduler.
+        """
+        for scheduler in (self.engine, self.batcher):
+            if scheduler is not None:
+                scheduler.stop()
+
+    def stats(self) -> dict:
+        """
+        Counters of the scheduler, empty without one.
+        """
+        scheduler = self.engine or self.batcher
+        return scheduler.stats() if scheduler is not None else {}
+
+class ModelRegistry():
+    """
+    Models served by the service, loaded on demand and evicted least recently used.
+
+    A model that is not resident is loaded by the first request naming it; further
+    requests for it wait for the same load. When the resident models would take
+    more than the memory budget, idle models are evicted, the least recently used
+    first. Pinned models and models with requests in flight are never evicted, so
+    the budget may be exceeded while they are busy. A budget of 0 keeps no model
+    besides the pinned ones once another one is needed.
+
+    The default model answers requests that name no model. It can be replaced
+    while it serves (`replace_default`); requests already running on it finish
+    on it before it is freed (`retire`).
+    """
+    def __init__(self, load: Callable[[str], ServedModel], default: str, budget_bytes: int = 0):
+        """
+        Args:
+            load (Callable[[str], ServedModel]): Loads a model by name, with its scheduler started.
+            default (str): Name of the default model.
+            budget_bytes (int): Memory budget of the weights of all resident models.
+        """
+        self.load = load
+        self.default = default
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.models: dict[str, ServedModel] = {}
+        # one lock per model name, held while the model loads
+        self.loading: dict[str, threading.Lock] = {}
+        # bytes of models loaded before, to make room for them before they load again
+        self.sizes: dict[str, int] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def add(self, served: ServedModel, pinned: bool = False):
+        """
+        Register a model loaded outside of the registry.
+
+        Args:
+            served (ServedModel): The model, with its scheduler started.
+            pinned (bool): Never evict the model.
+        """
+        served.pinned = pinned
+        with self.lock:
+            self.models[served.name] = served
+            self.sizes[served.name] = served.bytes
+
+    def replace_default(self, served: ServedModel) -> list[ServedModel]:
+        """
+        Make a loaded model the default, atomically for new requests.
+
+        Args:
+            served (ServedModel): The new default model, with its scheduler started.
+
+        Returns:
+            list[ServedModel]: The replaced models, the previous default and a resident model
+                of the same name, to be retired.
+        """
+        served.pinned = True
+        with self.lock:
+            replaced = [self.models.pop(name) for name in dict.fromkeys([self.default, served.name]) if name in self.models]
+            self.models[served.name] = served
+            self.sizes[served.name] = served.bytes
+            self.default = served.name
+        return replaced
+
+    def retire(self, served: ServedModel, poll: float = 0.1):
+        """
+        Free a model taken out of the registry once its requests in flight are answered.
+
+        Args:
+            served (ServedModel): The model.
+            poll (float): Seconds between checks of the requests in flight.
+        """
+        while True:
+            with self.lock:
+                if not served.in_flight:
+                    break
+            time.sleep(poll)
+        served.stop()
+        # the weights are freed once nothing refers to them anymore
+        gc.collect()
+        print(f"Retired model {served.name} ({served.bytes / 2**20:.0f} MB, {served.requests} requests served)")
+
+    @contextmanager
+    def use(self, name: str | None = None) -> Iterator[ServedModel]:
+        """
+        Use a model for a request, loading it if it is not resident.
+
+        The model is not evicted or retired while it is in use.
+
+        Args:
+            name (str | None): Name of the model, None for the default model at the time of the call.
+
+        Yields:
+            ServedModel: The model.
+        """
+        served = self._acquire(name)
+        try:
+            yield served
+        finally:
+            with self.lock:
+                served.in_flight -= 1
+                served.last_used = time.monotonic()
+
+    def get(self, name: str | None = None) -> ServedModel | None:
+        """
+        A resident model, without counting a request on it.
+
+        Args:
+            name (str | None): Name of the model, None for the default model.
+
+        Returns:
+            ServedModel | None: The model, None if it is not resident.
+        """
+        with self.lock:
+            return self.models.get(name or self.default)
+
+    def resident(self) -> list[dict]:
+        """
+        Resident models, the most recently used first.
+
+        Returns:
+            list[dict]: Per model its name, weight bytes, whether it is pinned, requests in
+                flight and served, when it was loaded and the seconds since it was last used.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    "model": served.name,
+                    "bytes": served.bytes,
+                    "pinned": served.pinned,
+                    "in_flight": served.in_flight,
+                    "requests": served.requests,
+                    "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(served.loaded_at)),
+                    "idle_seconds": round(now - served.last_used, 1) if not served.in_flight else 0.0,
+                }
+                for served in sorted(self.models.values(), key=lambda served: served.last_used, reverse=True)
+            ]
+
+    def stop(self):
+        """
+        Stop the schedulers of all resident models.
+        """
+        with self.lock:
+            models = list(self.models.values())
+        for served in models:
+            served.stop()
+
+    def stats(self) -> dict:
+        """
+        Registry counters.
+
+        Returns:
+            dict: Default model, memory budget and bytes of the resident models, their number,
+                and the models loaded on demand and evicted so far.
+        """
+        with self.lock:
+            return {
+                "default": self.default,
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": sum(served.bytes for served in self.models.values()),
+                "resident": len(self.models),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def _acquire(self, name: str | None) -> ServedModel:
+        """
+        Count a request on a resident model, or load the model first.
+        """
+        with self.lock:
+            name = name or self.default
+            served = self._take(name)
+            if served is not None:
+                return served
+            loading = self.loading.setdefault(name, threading.Lock())
+        with loading:
+            with self.lock:
+                served = self._take(name)
+                if served is not None:
+                    return served
+                self._evict(self.sizes.get(name, 0))
+            print(f"Loading model {name} on demand")
+            start = time.perf_counter()
+            served = self.load(name)
+            with self.lock:
+                self.models[name] = served
+                self.sizes[name] = served.bytes
+                self.loads += 1
+                served.in_flight += 1
+                served.requests += 1
+                self._evict(0, keep=name)
+            print(f"Loaded model {name} in {time.perf_counter() - start:.1f}s ({served.bytes / 2**20:.0f} MB)")
+            return served
+
+    def _take(self, name: str) -> ServedModel | None:
+        """
+        Count a request on a resident model, None if it is not resident. Called with the lock held.
+        """
+        served = self.models.get(name)
+        if served is not None:
+            served.in_flight += 1
+            served.requests += 1
+            served.last_used = time.monotonic()
+        return served
+
+    def _evict(self, needed: int, keep: str | None = None):
+        """
+        Evict idle models, least recently used first, until the needed bytes fit the budget. Called with the lock held.
+        """
+        evicted = False
+        while sum(served.bytes for served in self.models.values()) + needed > self.budget_bytes:
+            idle = [served for served in self.models.values() if not served.pinned and not served.in_flight and served.name != keep]
+            if not idle:
+                break
+            served = min(idle, key=lambda served: served.last_used)
+            del self.models[served.name]
+            served.stop()
+            self.evictions += 1
+            evicted = True
+            print(f"Evicted model {served.name} ({served.bytes / 2**20:.0f} MB, idle for {time.monotonic() - served.last_used:.0f}s)")
+        if evicted:
+            # the weights are freed once nothing refers to them anymore
+            gc.collect()
@@ -0,0 +1,98 @@
+import json, os, re, shutil, time
+import torch
+import transformers
+
+# written last into a snapshot, a directory without it is incomplete
+SNAPSHOT_INFO = "snapshot.json"
+
+def model_dirname(model_path: str) -> str:
+    """
+    Directory name of a model, its hub or disk path with the separators replaced.
+    """
+    return re.sub(r"[^\w.-]+", "--", model_path.strip("/"))
+
+class ModelSnapshots():
+    """
+    Load-ready copies of models, converted to the dtype they are served in.
+
+    Loading a model from the hub cache resolves the checkpoint, runs remote code
+    and converts every weight to the requested dtype, which copies all of them into
+    the memory of the process. On the first start the converted model and its
+    processor are written as a safetensors snapshot (e.g. on the `models_cache`
+    volume). Later starts load the snapshot, whose weights already have the right
+    dtype, so they are memory-mapped and only read from disk when they are first
+    used; the pages are shared by all processes loading the same snapshot.
+
+    The snapshot is not updated when the model changes upstream, delete its
+    directory to convert the model again.
+    """
+    def __init__(self, root: str):
+        """
+        Args:
+            root (str): Directory of the snapshots.
+        """
+        self.root = root
+
+    def path(self, model_path: str, dtype: torch.dtype) -> str:
+        """
+        Directory of the snapshot of a model in a dtype.
+
+        Args:
+            model_path (str): Path of the model in the hugging face hub or on disk.
+            dtype (torch.dtype): Dtype of the weights.
+
+        Returns:
+            str: The directory, whether or not the snapshot exists.
+        """
+        return os.path.join(self.root, model_dirname(model_path), str(dtype).removeprefix("torch."))
+
+    def find(self, model_path: str, dtype: torch.dtype) -> str | None:
+        """
+        Find the complete snapshot of a model in a dtype, written by this version of transformers.
+
+        Args:
+            model_path (str): Path of the model in the hugging face hub or on disk.
+            dtype (torch.dtype): Dtype of the weights.
+
+        Returns:
+            str | None: Directory of the snapshot, None if there is none to load.
+        """
+        path = self.path(model_path, dtype)
+        try:
+            with open(os.path.join(path, SNAPSHOT_INFO)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if info.get("transformers") != transformers.__version__:
+            print(f"Snapshot {path} was written by transformers {info.get('transformers')}, converting {model_path} again")
+            return None
+        return path
+
+    def save(self, model, processor, model_path: str, dtype: torch.dtype) -> str:
+        """
+        Write the snapshot of a loaded model.
+
+        The snapshot is written into a temporary directory and moved into place
+        when complete, so an interrupted start or a second replica writing the same
+        snapshot never leaves a partial one behind.
+
+        Args:
+            model (PreTrainedModel): Model with weights of the dtype, before any quantization.
+            processor (ProcessorMixin): Processor of the model.
+            model_path (str): Path of the model in the hugging face hub or on disk.
+            dtype (torch.dtype): Dtype of the weights.
+
+        Returns:
+            str: Directory of the snapshot.
+        """
+        path = self.path(model_path, dtype)
+        tmp = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        model.save_pretrained(tmp, safe_serialization=True)
+        processor.save_pretrained(tmp)
+        info = {"model": model_path, "dtype": str(dtype), "transformers": transformers.__version__, "created": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+        with open(os.path.join(tmp, SNAPSHOT_INFO), "w") as f:
+            json.dump(info, f, indent=2)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        return path
@@ -0,0 +1,165 @@
+import threading, time
+from typing import Callable
+import torch
+from transformers import PreTrainedTokenizerBase
+
+class IncompatibleDraftModel(ValueError):
+    """
+    Raised when the draft model does not share the vocabulary of the target model.
+    """
+
+class SpeculativeDecoder():
+    """
+    Greedy speculative decoding of a single sequence with a small draft model.
+
+    Each step the draft model proposes up to `draft_tokens` tokens one by one and
+    the target model checks all of them in one forward pass. The longest prefix the
+    target agrees with is kept, followed by the target's own next token, so the
+    answer is exactly the greedy answer of the target model while it runs fewer,
+    wider forward passes. Both models prefill the prompt from their own embeddings,
+    since their vision towers and hidden sizes differ.
+    """
+    def __init__(self, target, draft, draft_tokens: int = 4, eos: set[int] | None = None):
+        """
+        Args:
+            target (VisualLanguageModelForCharts): Model whose greedy answer is produced.
+            draft (VisualLanguageModelForCharts): Smaller model with the same vocabulary proposing tokens.
+            draft_tokens (int): Maximum number of tokens proposed per step.
+            eos (set[int] | None): Token ids ending the answer.
+        """
+        self.target = target
+        self.draft = draft
+        self.draft_tokens = draft_tokens
+        self.eos = eos or set()
+        # out_features, since the weight of a quantized head is packed
+        self.target_vocab = target.model.get_output_embeddings().out_features
+        self.draft_vocab = draft.model.get_input_embeddings().weight.shape[0]
+        self.lock = threading.Lock()
+        self.steps = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+        self.seconds = 0.0
+
+    @staticmethod
+    def check_tokenizers(target: PreTrainedTokenizerBase, draft: PreTrainedTokenizerBase):
+        """
+        Check that the draft model speaks the token ids of the target model.
+
+        Only the regular vocabulary is compared; added tokens such as the image tokens
+        may differ, the target simply rejects them if they are ever proposed.
+
+        Args:
+            target (PreTrainedTokenizerBase): Tokenizer of the target model.
+            draft (PreTrainedTokenizerBase): Tokenizer of the draft model.
+
+        Raises:
+            IncompatibleDraftModel: If regular tokens of the draft map to other ids for the target.
+        """
+        target_vocab = target.get_vocab()
+        added = draft.get_added_vocab()
+        vocab = {token: i for token, i in draft.get_vocab().items() if token not in added}
+        mismatched = [token for token, i in vocab.items() if target_vocab.get(token) != i]
+        if mismatched:
+            raise IncompatibleDraftModel(
+                f"Draft model tokenizer is incompatible with the target model: {len(mismatched)} of {len(vocab)} "
+                f"tokens map to other ids (e.g. {mismatched[:5]}); use a draft model of the same tokenizer family"
+            )
+
+    @torch.inference_mode()
+    def generate(self, target_inputs: dict, draft_inputs: dict, max_new_tokens: int, streamer=None, stop: Callable[[list[int]], bool] | None = None) -> list[int]:
+        """
+        Generate the greedy answer of the target model.
+
+        Args:
+            target_inputs (dict): Generation inputs of the target model for a single prompt
+                (inputs_embeds, optional past_key_values holding a prefix of it).
+            draft_inputs (dict): Generation inputs of the draft model for the same prompt.
+            max_new_tokens (int): Maximum number of tokens to generate.
+            streamer (BaseStreamer | None): Streamer receiving the new tokens, as with `model.generate`.
+            stop (Callable[[list[int]], bool] | None): Check on the generated ids ending the answer early, as stopping criteria do.
+
+        Returns:
+            list[int]: Generated token ids, without the end token.
+        """
+        start = time.perf_counter()
+        if streamer is not None:
+            # like `model.generate`, the first put is the (here empty) prompt
+            streamer.put(torch.empty((1, 0), dtype=torch.long))
+        target_cache, logits = self.target.prefill(target_inputs)
+        draft_cache, _ = self.draft.prefill(draft_inputs)
+        device = logits.device
+
+        ids = [int(logits.argmax())]
+        if streamer is not None and ids[-1] not in self.eos:
+            streamer.put(torch.tensor(ids[-1:]))
+        draft_prompt = draft_cache.get_seq_length()
+        # generated tokens already in the draft cache
+        draft_seen = 0
+        drafting = True
+        proposed = accepted = steps = 0
+        while ids[-1] not in self.eos and len(ids) < max_new_tokens and not (stop and stop(ids)):
+            # the token after a fully accepted proposal comes for free, so propose one less than the budget left
+            budget = min(self.draft_tokens, max_new_tokens - len(ids) - 1) if drafting else 0
+            proposal = []
+            feed = ids[draft_seen:]
+            for _ in range(budget):
+                out = self.draft.model(input_ids=torch.tensor([feed], device=device), past_key_values=draft_cache, use_cache=True)
+                token = int(out.logits[0, -1].argmax())
+                if token >= self.target_vocab:
+                    break
+                proposal.append(token)
+                feed = [token]
+
+            out = self.target.model(input_ids=torch.tensor([[ids[-1], *proposal]], device=device), past_key_values=target_cache, use_cache=True)
+            predicted = out.logits[0].argmax(-1).tolist()
+            n = 0
+            while n < len(proposal) and proposal[n] == predicted[n]:
+                n += 1
+            steps += 1
+            proposed += len(proposal)
+            accepted += n
+
+            # drop the keys and values of rejected proposals
+            target_cache.crop(target_cache.get_seq_length() - (len(proposal) - n))
+            if budget > 0:
+                kept = min(n, draft_cache.get_seq_length() - draft_prompt - len(ids))
+                draft_cache.crop(draft_prompt + len(ids) + kept)
+                draft_seen = len(ids) + kept
+            new = (proposal[:n] + [predicted[n]])[:max_new_tokens - len(ids)]
+            # the draft cannot embed target-only tokens, the rest of the answer is decoded without it
+            drafting = drafting and predicted[n] < self.draft_vocab
+            ids.extend(new)
+            if streamer is not None:
+                streamer.put(torch.tensor([t for t in new if t not in self.eos]))
+
+        ids = ids[:next((i for i, t in enumerate(ids) if t in self.eos), len(ids))]
+        if streamer is not None:
+            streamer.end()
+        with self.lock:
+            self.steps += steps
+            self.proposed += proposed
+            self.accepted += accepted
+            self.generated += len(ids)
+            self.seconds += time.perf_counter() - start
+        return ids
+
+    def stats(self) -> dict:
+        """
+        Speculative decoding counters.
+
+        Returns:
+            dict: Draft length, target forward passes, proposed and accepted draft tokens,
+                acceptance rate, tokens per target pass and generated tokens per second.
+        """
+        with self.lock:
+            return {
+                "draft_tokens": self.draft_tokens,
+                "steps": self.steps,
+                "proposed": self.proposed,
+                "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 4) if self.proposed else 0.0,
+                "tokens_per_step": round(self.generated / self.steps, 2) if self.steps else 0.0,
+                "generated": self.generated,
+                "tokens_per_second": round(self.generated / self.seconds, 2) if self.seconds else 0.0,
+            }
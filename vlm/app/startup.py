@@ -0,0 +1,74 @@
+import threading, time
+from contextlib import contextmanager
+from typing import Iterator
+
+class StartupPhases():
+    """
+    Timings and readiness of the startup of the service.
+
+    Every phase (loading the processor and the weights, writing the snapshot,
+    compiling, warming up, ...) is timed and logged as it finishes. The service is
+    ready once the warmup request went through; until then it is alive but does
+    not take requests. A failed startup keeps the error, so it can be reported.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.phases: dict[str, float] = {}
+        self.ready_seconds: float | None = None
+        self.error: str | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_seconds is not None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Time a phase of the startup.
+
+        Args:
+            name (str): Name of the phase, phases of the same name add up.
+        """
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        print(f"Startup phase {name}: {seconds:.2f}s")
+
+    def mark_ready(self):
+        """
+        Mark the service ready and log the time since the start.
+        """
+        with self.lock:
+            self.ready_seconds = time.monotonic() - self.started_at
+            phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        print(f"Ready after {self.ready_seconds:.2f}s ({phases})")
+
+    def mark_failed(self, error: Exception):
+        """
+        Record the error the startup failed with.
+
+        Args:
+            error (Exception): The error.
+        """
+        with self.lock:
+            self.error = repr(error)
+        print(f"Startup failed after {time.monotonic() - self.started_at:.2f}s: {self.error}")
+
+    def stats(self) -> dict:
+        """
+        Startup timings.
+
+        Returns:
+            dict: Whether the service is ready, the seconds it took to get ready, the
+                seconds of every phase and the error of a failed startup.
+        """
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "ready_seconds": round(self.ready_seconds, 2) if self.ready_seconds is not None else None,
+                "phases": {name: round(seconds, 2) for name, seconds in self.phases.items()},
+                "error": self.error,
+            }
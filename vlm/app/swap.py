@@ -0,0 +1,88 @@
+import json, mmap, multiprocessing, time
+
+# states of a model swap, a swap in one of SWAP_RUNNING refuses another one
+SWAP_STATES = ("idle", "loading", "starting_workers", "draining", "done", "failed")
+SWAP_RUNNING = ("loading", "starting_workers", "draining")
+
+class SwapStatus():
+    """
+    Progress of the latest hot swap of the default model.
+
+    A swap loads the new model while the current one keeps serving ("loading"),
+    with WORKERS starts the workers of the new model ("starting_workers"), then
+    switches new requests to it and waits for the requests of the current model
+    to finish before freeing it ("draining"). It ends "done" or, with the current
+    model still serving, "failed".
+
+    The status is kept in shared memory, so all worker processes forked after it
+    was created report the swap the supervisor runs for them, and only one swap
+    runs at a time across the processes.
+    """
+    def __init__(self, size: int = 2**16):
+        """
+        Args:
+            size (int): Bytes of shared memory holding the status.
+        """
+        self.memory = mmap.mmap(-1, size)
+        self.lock = multiprocessing.get_context("fork").Lock()
+        self._write({"state": "idle"})
+
+    def begin(self, model: str, precision: str | None, previous: str) -> bool:
+        """
+        Start a swap unless one is running.
+
+        Args:
+            model (str): Name of the new model.
+            precision (str | None): Precision of the new model, None for the default.
+            previous (str): Identity of the model serving until the swap is done.
+
+        Returns:
+            bool: Whether the swap started.
+        """
+        with self.lock:
+            if self._read()["state"] in SWAP_RUNNING:
+                return False
+            self._write({"state": "loading", "model": model, "precision": precision, "previous": previous, "started": time.monotonic()})
+        print(f"Swapping model {previous} for {model} ({precision or 'default precision'})")
+        return True
+
+    def update(self, state: str, **fields):
+        """
+        Move the running swap on to its next state.
+
+        Args:
+            state (str): One of `SWAP_STATES`.
+            **fields: Further fields of the status, e.g. the error of a failed swap.
+        """
+        with self.lock:
+            previous = self._read()
+            status = {**previous, **fields, "state": state}
+            if state in ("done", "failed"):
+                status["seconds"] = round(time.monotonic() - status["started"], 2)
+            self._write(status)
+        if state != previous["state"]:
+            print(f"Model swap to {status.get('model')}: {state} after {time.monotonic() - status['started']:.1f}s" + (f" ({fields['error']})" if fields.get("error") else ""))
+
+    def stats(self) -> dict:
+        """
+        Status of the latest swap.
+
+        Returns:
+            dict: State, new and previous model, precision, seconds it took (so far),
+                timings of the loading phases and the error of a failed swap.
+        """
+        with self.lock:
+            status = self._read()
+        started = status.pop("started", None)
+        if started is not None and "seconds" not in status:
+            status["seconds"] = round(time.monotonic() - started, 2)
+        return status
+
+    def _read(self) -> dict:
+        size = int.from_bytes(self.memory[:4], "little")
+        return json.loads(self.memory[4:4 + size])
+
+    def _write(self, status: dict):
+        data = json.dumps(status).encode()
+        self.memory[4:4 + len(data)] = data
+        self.memory[:4] = len(data).to_bytes(4, "little")
@@ -0,0 +1,87 @@
+import json, os, time
+
+# settings the tuner measures, named like the environment variables of the service
+TUNED_SETTINGS = ("WORKERS", "THREADS_PER_WORKER", "INTEROP_THREADS", "THREADPOOL_SIZE", "CPU_AFFINITY")
+
+# what the best configuration is best at: median or 95th percentile latency, or requests per second
+OBJECTIVES = ("p50", "p95", "throughput")
+
+def best_settings(results: list[dict]) -> dict[str, dict]:
+    """
+    Pick the best measured configuration for every objective.
+
+    Args:
+        results (list[dict]): Measured configurations, the `TUNED_SETTINGS` next to
+            "p50_ms", "p95_ms" and "requests_per_second"; failed ones have an "error".
+
+    Returns:
+        dict[str, dict]: Settings of the best configuration by objective, empty if none succeeded.
+    """
+    measured = [result for result in results if "error" not in result]
+    if not measured:
+        return {}
+    best = {
+        "p50": min(measured, key=lambda result: result["p50_ms"]),
+        "p95": min(measured, key=lambda result: result["p95_ms"]),
+        "throughput": max(measured, key=lambda result: result["requests_per_second"]),
+    }
+    return {objective: {name: result[name] for name in TUNED_SETTINGS} for objective, result in best.items()}
+
+def save_tuning(path: str, results: list[dict], **info) -> dict:
+    """
+    Write the measured configurations and the best one per objective to a tuning file.
+
+    Args:
+        path (str): Path of the JSON file.
+        results (list[dict]): Measured configurations, see `best_settings`.
+        **info: Context of the measurement (model, precision, cpus, workload, ...).
+
+    Returns:
+        dict: Content of the file.
+    """
+    tuning = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        **info,
+        "best": best_settings(results),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(tuning, f, indent=2)
+    return tuning
+
+def load_tuning(path: str | None, objective: str = "p95", model: str | None = None) -> dict:
+    """
+    Read the best settings for an objective from a tuning file written by `python -m vlm.tune`.
+
+    The settings were measured on one machine for one model, so a file measured
+    for another model or number of cpus is still used but reported.
+
+    Args:
+        path (str | None): Path of the JSON file, None to not use tuned settings.
+        objective (str): One of `OBJECTIVES`.
+        model (str | None): Name of the served model, compared with the tuned one.
+
+    Returns:
+        dict: Settings by name of `TUNED_SETTINGS`, empty without a tuning file.
+
+    Raises:
+        ValueError: If the objective is unknown.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown tuning objective {objective!r}, expected one of {OBJECTIVES}")
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            tuning = json.load(f)
+    except FileNotFoundError:
+        print(f"No tuning file at {path}, run `python -m vlm.tune` to create it")
+        return {}
+    settings = tuning.get("best", {}).get(objective, {})
+    if model and tuning.get("model") != model:
+        print(f"Tuning file {path} was measured for {tuning.get('model')}, not {model}")
+    if tuning.get("cpus") != len(os.sched_getaffinity(0)):
+        print(f"Tuning file {path} was measured on {tuning.get('cpus')} cpus, not {len(os.sched_getaffinity(0))}")
+    print(f"Tuned settings for {objective} from {path}: {settings}")
+    return settings
@@ -0,0 +1,164 @@
+import os, threading
+from collections import OrderedDict
+import torch
+
+class VisionCache():
+    """
+    Two-tier LRU cache of projected vision embeddings, keyed by image content.
+
+    The memory tier holds the features of recently seen images on the model device
+    and is bounded by `max_bytes`. The optional disk tier keeps one file per image
+    in `disk_dir` (e.g. on the `models_cache` volume), bounded by `disk_max_bytes`,
+    so features survive restarts. Disk hits are promoted to memory.
+    """
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        """
+        Args:
+            max_bytes (int): Memory budget of the cached features, 0 disables the cache.
+            disk_dir (str | None): Directory of the disk tier, None disables it.
+            disk_max_bytes (int): Disk budget of the cached features.
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir if max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self.entries: OrderedDict[str, torch.Tensor] = OrderedDict()
+        self.bytes = 0
+        self.disk_entries: OrderedDict[str, int] = OrderedDict()
+        self.disk_bytes = 0
+        # keys being written to disk, so concurrent misses on the same image write it once
+        self.writing: set[str] = set()
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # least recently used first, hits touch their file
+            files = [f for f in os.scandir(self.disk_dir) if f.name.endswith(".pt")]
+            for f in sorted(files, key=lambda f: f.stat().st_mtime):
+                self.disk_entries[f.name[:-3]] = f.stat().st_size
+                self.disk_bytes += f.stat().st_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str, device: torch.device) -> torch.Tensor | None:
+        """
+        Look up the vision features of an image.
+
+        Args:
+            key (str): Content hash of the image and the preprocessing settings.
+            device (torch.device): Device to load disk entries to.
+
+        Returns:
+            torch.Tensor | None: Features of shape [tiles, tokens_per_tile, hidden], or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            self.lookups += 1
+            features = self.entries.get(key)
+            if features is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return features
+            if key not in self.disk_entries:
+                return None
+        try:
+            features = torch.load(self.__path(key), map_location=device, weights_only=True)
+            os.utime(self.__path(key))
+        except (OSError, RuntimeError):
+            with self.lock:
+                self.disk_bytes -= self.disk_entries.pop(key, 0)
+            return None
+        with self.lock:
+            self.disk_hits += 1
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+            self.__remember(key, features)
+        return features
+
+    def put(self, key: str, features: torch.Tensor):
+        """
+        Store the vision features of an image in memory and, if enabled, on disk.
+
+        Args:
+            key (str): Content hash of the image and the preprocessing settings.
+            features (torch.Tensor): Features of shape [tiles, tokens_per_tile, hidden].
+        """
+        if not self.enabled:
+            return
+        # never keep the autograd graph of the vision tower alive with the entry
+        features = features.detach()
+        with self.lock:
+            self.__remember(key, features)
+            if not self.disk_dir or key in self.disk_entries or key in self.writing:
+                return
+            self.writing.add(key)
+        # write to a temporary file first, so readers never see a partial entry; it is
+        # unique per writer, since worker processes share the directory
+        path = self.__path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            torch.save(features.cpu(), tmp)
+            os.replace(tmp, path)
+            size = os.path.getsize(path)
+        except OSError:
+            with self.lock:
+                self.writing.discard(key)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self.lock:
+            self.writing.discard(key)
+            if key in self.disk_entries:
+                return
+            self.disk_entries[key] = size
+            self.disk_bytes += size
+            while self.disk_bytes > self.disk_max_bytes and len(self.disk_entries) > 1:
+                old_key, size = self.disk_entries.popitem(last=False)
+                self.disk_bytes -= size
+                try:
+                    os.remove(self.__path(old_key))
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        """
+        Vision cache counters.
+
+        Returns:
+            dict: Settings, cached images and bytes per tier, lookups, memory and
+                disk hits and the overall hit rate.
+        """
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            return {
+                "max_bytes": self.max_bytes,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "disk_dir": self.disk_dir,
+                "disk_entries": len(self.disk_entries),
+                "disk_bytes": self.disk_bytes,
+                "lookups": self.lookups,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "hit_rate": round(hits / self.lookups, 4) if self.lookups else 0.0,
+            }
+
+    def __remember(self, key: str, features: torch.Tensor):
+        """
+        Insert features into the memory tier and evict the least recently used ones beyond the budget.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = features
+        self.bytes += features.nbytes
+        while self.bytes > self.max_bytes and self.entries:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.nbytes
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.pt")
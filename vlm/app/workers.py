@@ -0,0 +1,377 @@
+import gc, json, os, select, signal, time
+from typing import Callable
+import torch
+import uvicorn
+from .swap import SwapStatus
+
+# seconds before a crashed worker is started again, so a worker failing at startup does not spin
+RESTART_DELAY_S = 1.0
+# seconds the supervisor waits for a message of the workers before it checks for exited ones
+POLL_S = 0.5
+
+# "none" lets the kernel place the threads, "cores" pins every worker to its own block of cpus
+AFFINITIES = ("none", "cores")
+
+class WorkerPool():
+    """
+    Supervisor of uvicorn worker processes sharing one copy of the model weights.
+
+    The model is loaded once in the supervisor, which then forks the workers. The
+    weights are never written to after loading, so the workers share their memory
+    pages copy-on-write and the pool needs about the memory of one model, plus the
+    KV caches and embedding caches every worker keeps for itself. All workers
+    accept connections from one listening socket and run their own scheduler, so
+    pre- and post-processing of concurrent requests is no longer serialized by a
+    single interpreter. Every worker runs the model with its own number of
+    intra-op and inter-op threads, optionally pinned to its own cpus.
+
+    The supervisor keeps a single thread until it forks, since the OpenMP thread
+    pool of torch does not survive a fork. Crashed workers are started again and
+    SIGTERM or SIGINT stop all of them.
+
+    A worker can ask the supervisor to swap the model (`request_swap`). The
+    supervisor loads the new model while the workers keep serving the current
+    one, and forks a new generation of workers from it. Workers of a later
+    generation warm up before they accept connections and report to the
+    supervisor once they are up. Then the previous workers are stopped, and they
+    finish their requests in flight before they exit, which frees the previous
+    model. If a new worker fails to start, the previous workers keep serving.
+    """
+    def __init__(self, app, workers: int, threads: int | None = None, interop_threads: int | None = None, affinity: str = "none", **options):
+        """
+        Args:
+            app (FastAPI): Application served by every worker.
+            workers (int): Number of worker processes.
+            threads (int | None): Intra-op threads of every worker, None to split the default threads of torch among the workers.
+            interop_threads (int | None): Inter-op threads of every worker, None for the default of torch.
+            affinity (str): One of `AFFINITIES`.
+            **options: Options of `uvicorn.Config` (host, port, proxy_headers, ...).
+
+        Raises:
+            ValueError: If the affinity is unknown.
+        """
+        if affinity not in AFFINITIES:
+            raise ValueError(f"Unknown cpu affinity {affinity!r}, expected one of {AFFINITIES}")
+        self.config = uvicorn.Config(app, **options)
+        self.workers = workers
+        self.threads = threads or max(1, torch.get_num_threads() // workers)
+        self.interop_threads = interop_threads
+        self.affinity = affinity
+        # index of the worker in a worker process, None in the supervisor
+        self.index: int | None = None
+        self.pids: dict[int, int] = {}
+        self.stopping = False
+        self.socket = None
+        # workers replaced by those of a new model, until they exited
+        self.retiring: dict[int, int] = {}
+        # workers of a new model that did not report their startup yet
+        self.starting: set[int] = set()
+        # number of times the workers were replaced, workers of a later generation start warm
+        self.generation = 0
+        # pipe the workers send messages to the supervisor through
+        self.control: tuple[int, int] | None = None
+        self.reload: Callable[[dict], Callable[[], None]] | None = None
+        self.restore: Callable[[], None] | None = None
+        self.status: SwapStatus | None = None
+
+    @staticmethod
+    def preload(load: Callable[[], None]):
+        """
+        Load the model in the supervisor before the workers are forked.
+
+        Args:
+            load (Callable[[], None]): Loads the model shared by the workers.
+        """
+        # a single thread, so no OpenMP thread pool is running at the fork
+        torch.set_num_threads(1)
+        # tokenizers turn their thread pool off in forked processes anyway, without warning about it
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        load()
+        # the loaded objects are never collected, moving them out of the collector keeps
+        # it from writing to their pages and copying them into every worker
+        gc.collect()
+        gc.freeze()
+
+    def run(self, reload: Callable[[dict], Callable[[], None]] | None = None, status: SwapStatus | None = None):
+        """
+        Fork the workers and supervise them until SIGTERM or SIGINT.
+
+        Args:
+            reload (Callable[[dict], Callable[[], None]] | None): Loads the new model of a swap
+                request in the supervisor and returns a function restoring the previous one,
+                None to refuse swaps.
+            status (SwapStatus | None): Progress of the swaps, shared with the workers.
+        """
+        self.reload = reload
+        self.status = status
+        self.socket = self.config.bind_socket()
+        self.control = os.pipe()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while self.pids or self.retiring:
+            if select.select([self.control[0]], [], [], POLL_S)[0]:
+                # messages are single short writes, which a pipe never interleaves
+                for line in os.read(self.control[0], 2**16).decode().splitlines():
+                    self._receive(json.loads(line))
+            self._reap()
+        self.socket.close()
+
+    def request_swap(self, request: dict):
+        """
+        Ask the supervisor to swap the model of all workers, from a worker.
+
+        Args:
+            request (dict): Swap request passed to the `reload` function of the supervisor.
+        """
+        self._send({"swap": request})
+
+    def notify_started(self, ready: bool):
+        """
+        Report the end of the startup of a worker of a later generation to the supervisor.
+
+        Args:
+            ready (bool): Whether the worker is ready to take requests.
+        """
+        self._send({"started": os.getpid(), "ready": ready})
+
+    def stats(self) -> dict:
+        """
+        Identity and memory of the current worker and memory of the whole pool.
+
+        Every worker reports for itself, the other metrics of a response are those of
+        the worker that answered it. Shared pages count fully in the resident memory
+        (RSS) of every process, while the proportional memory (PSS) splits them among
+        the processes sharing them, so the PSS of the pool is its actual memory.
+
+        Returns:
+            dict: Worker index and pid, number of workers, intra-op and inter-op threads,
+                cpus the worker runs on, RSS, PSS and shared memory of the worker in bytes
+                and RSS and PSS of the pool including the supervisor.
+        """
+        memory = _memory(os.getpid())
+        pool = [_memory(pid) for pid in [os.getppid(), *_children(os.getppid())]]
+        return {
+            "worker": self.index,
+            "pid": os.getpid(),
+            "workers": self.workers,
+            "threads": torch.get_num_threads(),
+            "interop_threads": torch.get_num_interop_threads(),
+            "cpus": sorted(os.sched_getaffinity(0)),
+            "rss_bytes": memory.get("Rss", 0),
+            "pss_bytes": memory.get("Pss", 0),
+            "shared_bytes": memory.get("Shared_Clean", 0) + memory.get("Shared_Dirty", 0),
+            "pool_rss_bytes": sum(m.get("Rss", 0) for m in pool),
+            "pool_pss_bytes": sum(m.get("Pss", 0) for m in pool),
+        }
+
+    def _send(self, message: dict):
+        """
+        Send a message to the supervisor, from a worker.
+        """
+        os.write(self.control[1], (json.dumps(message) + "\n").encode())
+
+    def _receive(self, message: dict):
+        """
+        Handle a message of a worker.
+        """
+        if "swap" in message:
+            self._swap(message["swap"])
+        elif message.get("started") in self.starting:
+            self.starting.discard(message["started"])
+            if not message["ready"]:
+                self._abort_swap(f"worker (pid {message['started']}) of the new model failed to start")
+            elif not self.starting:
+                self._retire()
+
+    def _reap(self):
+        """
+        Collect exited workers, starting crashed ones again.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            if self.retiring.pop(pid, None) is not None:
+                if not self.retiring and self.status is not None and self.status.stats()["state"] == "draining":
+                    self.status.update("done")
+                continue
+            index = self.pids.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if pid in self.starting:
+                self._abort_swap(f"worker {index} (pid {pid}) of the new model exited with status {code}")
+                continue
+            print(f"Worker {index} (pid {pid}) exited with status {code}, starting it again")
+            time.sleep(RESTART_DELAY_S)
+            if not self.stopping:
+                self._spawn(index)
+
+    def _swap(self, request: dict):
+        """
+        Load the new model of a swap and fork its workers next to the serving ones.
+        """
+        if self.reload is None or self.stopping:
+            return
+        # the previous model is collected once it is replaced, so it is moved back into the collector
+        gc.unfreeze()
+        try:
+            self.restore = self.reload(request)
+        except Exception as e:
+            self.status.update("failed", error=repr(e))
+            return
+        finally:
+            gc.collect()
+            gc.freeze()
+        if self.stopping:
+            return
+        self.status.update("starting_workers")
+        self.generation += 1
+        self.retiring, self.pids = self.pids, {}
+        for index in range(self.workers):
+            self._spawn(index)
+        self.starting = set(self.pids)
+
+    def _retire(self):
+        """
+        Stop the workers of the previous model once all workers of the new one are ready.
+        """
+        self.status.update("draining")
+        for pid in self.retiring:
+            _terminate(pid)
+        # the previous model is freed in the supervisor, and everywhere once its workers exited
+        self.restore = None
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+
+    def _abort_swap(self, error: str):
+        """
+        Stop the workers of the new model and keep the previous ones serving.
+        """
+        self.starting = set()
+        self.pids, self.retiring = self.retiring, self.pids
+        for pid in self.retiring:
+            _terminate(pid)
+        if self.restore is not None:
+            self.restore()
+            self.restore = None
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+        self.status.update("failed", error=error)
+
+    def _spawn(self, index: int):
+        """
+        Fork a worker serving the application on the shared socket.
+        """
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
+            return
+        code = 0
+        try:
+            # uvicorn installs its own handlers for a graceful shutdown
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            self.index = index
+            self.pids = {}
+            configure_process(self.threads, self.interop_threads, worker_cpus(index, self.threads, self.affinity))
+            print(f"Worker {index} (pid {os.getpid()}) started with {self.threads} threads on cpus {sorted(os.sched_getaffinity(0))}")
+            uvicorn.Server(self.config).run(sockets=[self.socket])
+        except BaseException as e:
+            print(f"Worker {index} failed: {e!r}")
+            code = 1
+        finally:
+            # never return into the supervisor's code
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        """
+        Stop the workers on SIGTERM or SIGINT.
+        """
+        self.stopping = True
+        for pid in [*self.pids, *self.retiring]:
+            _terminate(pid)
+
+def worker_cpus(index: int, threads: int, affinity: str = "none") -> list[int] | None:
+    """
+    Cpus a worker is pinned to.
+
+    With "cores" worker i gets the i-th block of `threads` consecutive cpus of those
+    the service may use, wrapping around if the workers need more cpus than there are.
+
+    Args:
+        index (int): Index of the worker.
+        threads (int): Intra-op threads of the worker.
+        affinity (str): One of `AFFINITIES`.
+
+    Returns:
+        list[int] | None: The cpus, None to leave the placement to the kernel.
+
+    Raises:
+        ValueError: If the affinity is unknown.
+    """
+    if affinity not in AFFINITIES:
+        raise ValueError(f"Unknown cpu affinity {affinity!r}, expected one of {AFFINITIES}")
+    if affinity == "none":
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    return sorted({cpus[(index * threads + i) % len(cpus)] for i in range(threads)})
+
+def configure_process(threads: int | None, interop_threads: int | None = None, cpus: list[int] | None = None):
+    """
+    Set the torch threads and cpu affinity of the current process, before it runs the model.
+
+    Args:
+        threads (int | None): Intra-op threads, None to keep the default.
+        interop_threads (int | None): Inter-op threads, None to keep the default.
+        cpus (list[int] | None): Cpus to run on, None to keep the current affinity.
+    """
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+
+def _terminate(pid: int):
+    """
+    Ask a worker to shut down gracefully, uvicorn answers its requests in flight first.
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+def _memory(pid: int) -> dict[str, int]:
+    """
+    Memory of a process in bytes by field of /proc/<pid>/smaps_rollup, empty if it cannot be read.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    memory = {}
+    for line in lines[1:]:
+        field, _, value = line.partition(":")
+        if value.strip().endswith("kB"):
+            memory[field] = int(value.split()[0]) * 1024
+    return memory
+
+def _children(pid: int) -> list[int]:
+    """
+    Pids of the child processes of a process.
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
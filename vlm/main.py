@@ -1,17 +1,94 @@
-import os, dotenv, base64, json
+import os, dotenv, base64, json, asyncio, threading, hmac
+import anyio, torch, uvicorn
 from PIL import Image
 from io import BytesIO
 from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException
+from typing import AsyncIterator, Callable, Iterator, Literal
+from fastapi import FastAPI, HTTPException, Body, Header, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from contextlib import asynccontextmanager
-from app.model import VisualLanguageModelForCharts
+from app.model import PRECISIONS, VisualLanguageModelForCharts
+from app.registry import ModelRegistry, ServedModel
+from app.snapshots import model_dirname
+from app.cancellation import Cancelled, CancelToken
+from app.workers import WorkerPool, configure_process, worker_cpus
+from app.tuning import load_tuning
+from app.startup import StartupPhases
+from app.swap import SwapStatus
 
 #otenv.load_dotenv(".env")
 
 MODEL_NAME = os.getenv("MODEL_NAME") 
 print("model name is ", MODEL_NAME)
 FORCE_CPU = os.getenv("FORCE_CPU", "true").lower() == "true"
+# "fp32", "bf16" or "int8" (dynamic quantization of the language model), empty for fp32 on cpu and fp16 on cuda
+PRECISION = os.getenv("PRECISION") or None
+# token budget of free answers, the other answer kinds can be tuned as JSON, e.g. {"short": 32}
 MAX_NEW_TOKENS_DEFAULT = int(os.getenv("MAX_NEW_TOKENS", "128"))
+ANSWER_TOKEN_BUDGETS = {**json.loads(os.getenv("ANSWER_TOKEN_BUDGETS") or "{}"), "free": MAX_NEW_TOKENS_DEFAULT}
+# smaller model of the same tokenizer family proposing tokens for speculative decoding
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME") or None
+DRAFT_TOKENS = int(os.getenv("DRAFT_TOKENS", "4"))
+# compiled decode step on a static KV cache, compiled at startup and cached in COMPILE_CACHE_DIR across restarts
+COMPILE = os.getenv("COMPILE", "false").lower() == "true"
+COMPILE_MAX_TOKENS = int(os.getenv("COMPILE_MAX_TOKENS", "4096"))
+COMPILE_CACHE_DIR = os.getenv("COMPILE_CACHE_DIR") or None
+# "continuous" batches at every decode step, "static" micro-batches whole requests,
+# "none" runs every request on its own (the only one using speculative or compiled decoding)
+SCHEDULER = os.getenv("SCHEDULER", "none" if DRAFT_MODEL_NAME or COMPILE else "continuous").lower()
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "4"))
+# static: requests arriving within this window after the first one share a forward pass
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "20"))
+# continuous: prompt tokens prefilled between two decode steps
+PREFILL_CHUNK_TOKENS = int(os.getenv("PREFILL_CHUNK_TOKENS", "256"))
+# system prompt prefixes (one per dynamic prompt) whose KV cache is kept, 0 disables the prefix cache
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", "8"))
+# vision embeddings of recently seen charts, 0 disables the cache; the directory adds a disk tier
+VISION_CACHE_MB = int(os.getenv("VISION_CACHE_MB", "1024"))
+VISION_CACHE_DIR = os.getenv("VISION_CACHE_DIR") or None
+VISION_CACHE_DISK_MB = int(os.getenv("VISION_CACHE_DISK_MB", "4096"))
+# requests are cancelled after this many seconds, the gateway sends its own timeout in X-Request-Timeout
+REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "300"))
+# seconds between checks whether the client of a running request disconnected
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_S", "0.5"))
+# best settings for TUNING_OBJECTIVE ("p50", "p95" or "throughput") measured by `python -m vlm.tune`,
+# the defaults of the settings below; settings in the environment still take precedence
+TUNING = load_tuning(os.getenv("TUNING_FILE") or None, os.getenv("TUNING_OBJECTIVE", "p95"), MODEL_NAME)
+# worker processes forked after loading the model once (`python main.py`), sharing its weights
+WORKERS = int(os.getenv("WORKERS") or TUNING.get("WORKERS", 1))
+# intra-op threads per worker, empty for the default threads of torch split among the workers
+THREADS_PER_WORKER = int(os.getenv("THREADS_PER_WORKER") or TUNING.get("THREADS_PER_WORKER") or 0) or None
+# inter-op threads per worker, empty for the default of torch
+INTEROP_THREADS = int(os.getenv("INTEROP_THREADS") or TUNING.get("INTEROP_THREADS") or 0) or None
+# threads running blocking requests per worker, empty for the default of 40
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE") or TUNING.get("THREADPOOL_SIZE") or 0) or None
+# "none" or "cores" (every worker pinned to its own THREADS_PER_WORKER cpus)
+CPU_AFFINITY = os.getenv("CPU_AFFINITY") or TUNING.get("CPU_AFFINITY", "none")
+PORT = int(os.getenv("PORT", "5001"))
+# load-ready snapshots of the model converted to its precision, written on the first start; empty disables them
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR") or None
+# answer a synthetic request before reporting ready
+WARMUP = os.getenv("WARMUP", "true").lower() == "true"
+# further models requests may name (comma separated), loaded on demand with the settings of MODEL_NAME but no draft model
+MODELS = list(dict.fromkeys([MODEL_NAME, *(name.strip() for name in os.getenv("MODELS", "").split(",") if name.strip())]))
+# memory of the weights of all resident models, idle on-demand models are evicted least recently used beyond it;
+# the default model is always resident, 0 keeps at most one further model
+MODEL_MEMORY_MB = int(os.getenv("MODEL_MEMORY_MB", "0"))
+# bearer token of the admin endpoints (hot swap of the default model), empty disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or None
+
+class SwapRequest(BaseModel):
+    """
+    Request body schema of a hot swap of the default model.
+
+    Args:
+        model: Name of the new default model in the hugging face hub or on disk. If None, the
+            current default model is loaded again, e.g. in another precision.
+        precision: Weight precision of the new model, "fp32", "fp16", "bf16" or "int8". If None, PRECISION is used.
+    """
+    model: str | None = None
+    precision: str | None = None
 
 class VLMRequest(BaseModel):
     """
@@ -21,22 +98,179 @@ class VLMRequest(BaseModel):
         query: Natural-language prompt/question to ask the model about the image.
         image_b64: Base64-encoded image bytes (no data URI prefix expected).
         extension: Image file extension hint (e.g., "png", "jpg"). Defaults to "png".
-        max_new_tokens: Optional maximum number of tokens to generate. If None, adefault value is used.
+        max_new_tokens: Optional maximum number of tokens to generate. If None, the budget of the answer type is used.
+        answer_type: "free" for a generated description, "short" for a generated word or phrase,
+            "binary" for "Yes"/"No" or "options" for one of `answer_options`, picked by scoring instead of generation.
+        answer_options: Allowed answers for answer_type "options" (e.g. ["A", "B", "A,B"]).
+        model: Name of the answering model, one of MODELS. If None, the default model answers.
     """
     query: str
     image_b64: str          
     extension: str = "png"  
     max_new_tokens: int | None = None
+    answer_type: Literal["free", "short", "binary", "options"] = "free"
+    answer_options: list[str] | None = None
+    model: str | None = None
+
+# the default model, loaded before the workers fork so they share it
+vlm: VisualLanguageModelForCharts | None = None
+# supervisor of the worker processes, None when the app runs in a single process
+pool: WorkerPool | None = None
+startup = StartupPhases()
+# progress of the latest hot swap of the default model (`/admin/swap`), shared with the workers
+swap = SwapStatus()
+
+def load_model(name: str = MODEL_NAME, precision: str | None = PRECISION, compile: bool = COMPILE, phases: StartupPhases | None = None) -> VisualLanguageModelForCharts:
+    """
+    Load a VLM with the configured settings.
+
+    Only MODEL_NAME gets the draft model, which has to share its tokenizer. Other
+    models keep their vision embeddings on disk in their own subdirectory of
+    VISION_CACHE_DIR.
+
+    Args:
+        name: Name of the model.
+        precision: Weight precision, see PRECISION.
+        compile: Compile the decode step, off when the workers compile it for their own thread count.
+        phases: Timings of the loading phases, None to time them on their own.
+    """
+    model = VisualLanguageModelForCharts()
+    model.load_model(
+        name,
+        FORCE_CPU,
+        prefix_cache_size=PREFIX_CACHE_SIZE,
+        vision_cache_mb=VISION_CACHE_MB,
+        vision_cache_dir=os.path.join(VISION_CACHE_DIR, model_dirname(name)) if VISION_CACHE_DIR and name != MODEL_NAME else VISION_CACHE_DIR,
+        vision_cache_disk_mb=VISION_CACHE_DISK_MB,
+        draft_model_path=DRAFT_MODEL_NAME if name == MODEL_NAME else None,
+        draft_tokens=DRAFT_TOKENS,
+        token_budgets=ANSWER_TOKEN_BUDGETS,
+        precision=precision,
+        compile=compile,
+        compile_max_tokens=COMPILE_MAX_TOKENS,
+        compile_cache_dir=COMPILE_CACHE_DIR,
+        snapshot_dir=SNAPSHOT_DIR,
+        startup=phases,
+    )
+    return model
+
+def load_served_model(name: str) -> ServedModel:
+    """
+    Load a further model of MODELS on demand, start its scheduler and warm it up.
+
+    Args:
+        name: Name of the model.
+    """
+    model = load_model(name)
+    served = _serve(name, model)
+    if WARMUP:
+        model.warmup()
+    return served
+
+def _serve(name: str, model: VisualLanguageModelForCharts) -> ServedModel:
+    """
+    Put a loaded model behind the configured scheduler.
+    """
+    served = ServedModel(name, model, SCHEDULER, MAX_BATCH_SIZE, BATCH_WINDOW_MS / 1000, PREFILL_CHUNK_TOKENS)
+    served.start()
+    return served
+
+# served models by name, the default model is added pinned once it is up
+registry = ModelRegistry(load_served_model, MODEL_NAME, MODEL_MEMORY_MB * 2**20)
+
+def load_default_model(request: dict | None = None) -> Callable[[], None]:
+    """
+    Load the default model in the supervisor of the workers, before they fork (see `WorkerPool`).
+
+    Args:
+        request: Swap request with the name and precision of the new default model,
+            None for MODEL_NAME at startup.
+
+    Returns:
+        A function restoring the previous default model, if the workers of a swapped-in model fail to start.
+    """
+    global vlm, startup
+    previous = vlm, startup, registry.default
+    name, precision = (request["model"], request["precision"]) if request else (MODEL_NAME, PRECISION)
+    # the workers of a swapped-in model report the timings of its loading
+    phases = StartupPhases() if request else startup
+    model = load_model(name, precision, compile=False, phases=phases)
+    if request:
+        swap.update("loading", phases=phases.stats()["phases"])
+    vlm, startup, registry.default = model, phases, name
+
+    def restore():
+        global vlm, startup
+        vlm, startup, registry.default = previous
+    return restore
+
+def start_service():
+    """
+    Bring the service up: load the model, start the scheduler, warm up and report ready.
+
+    In a worker process the model is already loaded by the supervisor, the worker
+    only compiles the decode step (with COMPILE). A failed startup is recorded, so
+    `/health` reports it and the container or the worker is restarted.
+    """
+    global vlm
+    try:
+        if pool is None:
+            vlm = load_model(phases=startup)
+        elif COMPILE:
+            vlm.compile_decoder(COMPILE_MAX_TOKENS, COMPILE_CACHE_DIR)
+        served = _serve(registry.default, vlm)
+        if WARMUP:
+            vlm.warmup()
+        registry.add(served, pinned=True)
+        startup.mark_ready()
+    except Exception as e:
+        startup.mark_failed(e)
+
+def swap_model(name: str, precision: str | None):
+    """
+    Hot swap the default model in a single process.
+
+    The new model loads and warms up while the current one serves. Then new
+    requests go to the new model, while the requests in flight finish on the
+    current one, which is freed after the last of them.
 
-vlm = VisualLanguageModelForCharts()
+    Args:
+        name: Name of the new default model.
+        precision: Weight precision of the new model, see PRECISION.
+    """
+    global vlm
+    served = None
+    try:
+        phases = StartupPhases()
+        model = load_model(name, precision, phases=phases)
+        served = _serve(name, model)
+        if WARMUP:
+            model.warmup()
+    except Exception as e:
+        if served is not None:
+            served.stop()
+        swap.update("failed", error=repr(e))
+        return
+    swap.update("draining", phases=phases.stats()["phases"])
+    replaced = registry.replace_default(served)
+    vlm = model
+    for previous in replaced:
+        registry.retire(previous)
+    swap.update("done")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Application lifespan handler for startup/shutdown behavior.
 
-    This context manager runs at application startup to load the VLM model and
-    then yields control to allow the application to serve requests.
+    This context manager runs at application startup and brings the service up
+    in the background (`start_service`: loading the VLM model, starting the
+    configured scheduler and warming up), so `/health` and `/ready` answer while
+    the model loads. Requests are refused until the service is ready. Workers
+    forked for a swapped-in model (see `WorkerPool`) start up before they take
+    connections instead. The schedulers of all resident models are stopped on
+    shutdown. The thread pool running blocking requests
+    gets THREADPOOL_SIZE threads.
 
     Args:
         app: The FastAPI application instance.
@@ -44,50 +278,554 @@ async def lifespan(app: FastAPI):
     Yields:
         None
     """
-    vlm.load_model(MODEL_NAME, FORCE_CPU)
+    if THREADPOOL_SIZE:
+        anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    if pool is not None and pool.generation:
+        # workers of a swapped-in model take connections once they are warm, the previous workers serve until then
+        await anyio.to_thread.run_sync(start_service)
+        pool.notify_started(startup.ready)
+    else:
+        threading.Thread(target=start_service, name="startup", daemon=True).start()
     yield
+    registry.stop()
 
 app = FastAPI(lifespan=lifespan)
 
 @app.post("/vlm/generate")
-def generate(req: VLMRequest):
+async def generate(req: VLMRequest, request: Request):
     """
     Generate a model response for a given prompt and base64-encoded image.
 
     This endpoint decodes the provided base64 image, loads it into a PIL Image,
-    and runs the visual language model with the given prompt.
+    and runs the visual language model with the given prompt. It is kept for
+    clients that still send JSON; the gateway uses `/vlm/generate/raw`.
 
     Args:
         req: Request payload containing the prompt, base64 image, and optional
             generation parameters.
+        request: Incoming request, watched for a client disconnect.
 
     Returns:
         A JSON object containing the generated text under the "text" key.
 
     Raises:
-        HTTPException: If the base64 image is invalid (400) or model inference fails (500).
+        HTTPException: If the base64 image or the model is invalid (400), the client disconnected (499),
+            the service is not ready (503), the request timed out (504) or model inference fails (500).
     """
+    _require_ready()
+    model = _model_name(req.model)
     try:
         raw = base64.b64decode(req.image_b64)
         img = Image.open(BytesIO(raw))
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image_b64: {e}")
 
-    max_new_tokens = req.max_new_tokens or MAX_NEW_TOKENS_DEFAULT
+    candidates = _answer_candidates(req.answer_type, req.answer_options)
+    cancel = _cancel_token(request)
+    return await _run_cancellable(request, cancel, lambda: _run_generation(model, req.query, img, req.max_new_tokens, candidates, req.answer_type, cancel))
+
+@app.post("/vlm/generate/raw")
+async def generate_raw(
+    request: Request,
+    image: bytes = Body(..., media_type="application/octet-stream"),
+    query: str = Query(...),
+    extension: str = Query("png"),
+    max_new_tokens: int | None = Query(None),
+    answer_type: Literal["free", "short", "binary", "options"] = Query("free"),
+    answer_options: list[str] | None = Query(None),
+    model: str | None = Query(None),
+):
+    """
+    Generate a model response for raw image bytes.
+
+    The image is sent as the request body (`application/octet-stream`) and the
+    prompt and generation parameters as query parameters. Compared to
+    `/vlm/generate` this avoids the base64 inflation of the payload and the JSON
+    parsing of a multi-MB string. Generation is cancelled when the client
+    disconnects or the request runs past its timeout (`X-Request-Timeout` header
+    in seconds, `REQUEST_TIMEOUT_S` by default).
+
+    Args:
+        request: Incoming request, watched for a client disconnect.
+        image: Raw image bytes from the request body.
+        query: Natural-language prompt/question to ask the model about the image.
+        extension: Image file extension hint (e.g., "png", "jpg"). Defaults to "png".
+        max_new_tokens: Optional maximum number of tokens to generate. If None, the budget of the answer type is used.
+        answer_type: "free" or "short" for a generated answer, "binary" or "options" for a scored fixed answer.
+        answer_options: Allowed answers for answer_type "options", repeated query parameter.
+        model: Name of the answering model, one of MODELS. If None, the default model answers.
+
+    Returns:
+        A JSON object containing the generated text under the "text" key.
+
+    Raises:
+        HTTPException: If the image bytes, answer options or model are invalid (400), the client disconnected (499),
+            the service is not ready (503), the request timed out (504) or model inference fails (500).
+    """
+    _require_ready()
+    model = _model_name(model)
+    candidates = _answer_candidates(answer_type, answer_options)
+    try:
+        img = Image.open(BytesIO(image))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+    cancel = _cancel_token(request)
+    return await _run_cancellable(request, cancel, lambda: _run_generation(model, query, img, max_new_tokens, candidates, answer_type, cancel))
+
+@app.post("/vlm/generate/stream")
+def generate_stream(
+    request: Request,
+    image: bytes = Body(..., media_type="application/octet-stream"),
+    query: str = Query(...),
+    extension: str = Query("png"),
+    max_new_tokens: int | None = Query(None),
+    answer_type: Literal["free", "short", "binary", "options"] = Query("free"),
+    answer_options: list[str] | None = Query(None),
+    model: str | None = Query(None),
+):
+    """
+    Stream a model response for raw image bytes as server-sent events.
+
+    Takes the same input as `/vlm/generate/raw`. Every cleaned-up sentence is sent
+    as a `data: {"text": ...}` event as soon as it is generated, followed by a final
+    `done` event with the full answer. Errors during generation are sent as an
+    `error` event, since the response status is already committed. Generation
+    is cancelled when the client disconnects or the request times out.
+
+    Args:
+        request: Incoming request, read for its `X-Request-Timeout` header.
+        image: Raw image bytes from the request body.
+        query: Natural-language prompt/question to ask the model about the image.
+        extension: Image file extension hint (e.g., "png", "jpg"). Defaults to "png".
+        max_new_tokens: Optional maximum number of tokens to generate. If None, the budget of the answer type is used.
+        answer_type: "free" or "short" for a generated answer, "binary" or "options" for a scored fixed answer,
+            which is sent as a single chunk.
+        answer_options: Allowed answers for answer_type "options", repeated query parameter.
+        model: Name of the answering model, one of MODELS. If None, the default model answers.
+
+    Returns:
+        A `text/event-stream` response with the answer chunks.
+
+    Raises:
+        HTTPException: If the image bytes, answer options or model are invalid (400) or the service is not ready (503).
+    """
+    _require_ready()
+    model = _model_name(model)
+    candidates = _answer_candidates(answer_type, answer_options)
+    try:
+        img = Image.open(BytesIO(image))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+    cancel = _cancel_token(request)
+    events = _sse_events(model, lambda served: _stream_answer(served, query, img, max_new_tokens, candidates, answer_type, cancel))
+    return StreamingResponse(_cancel_on_close(request, events, cancel), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def _cancel_on_close(request: Request, events: Iterator[str], cancel: CancelToken) -> AsyncIterator[str]:
+    """
+    Relay server-sent events and cancel the request if the client disconnects before the last one.
+
+    Starlette only notices a disconnect when it sends the next event, which may be
+    a whole sentence later, so the connection is also checked while waiting for it.
+
+    Args:
+        request: Incoming request, checked for a disconnect every `DISCONNECT_POLL_S` seconds.
+        events: Server-sent events of the answer.
+        cancel: Cancel flag of the request.
+
+    Yields:
+        str: The events.
+    """
+    chunks = iterate_in_threadpool(events)
+    finished = False
+    try:
+        while True:
+            try:
+                event = await _until_done(request, cancel, asyncio.ensure_future(anext(chunks)))
+            except StopAsyncIteration:
+                break
+            yield event
+        finished = True
+    finally:
+        if not finished:
+            cancel.cancel("disconnect")
+
+def _sse_events(model: str | None, answer: Callable[[ServedModel], Iterator[str]]) -> Iterator[str]:
+    """
+    Encode answer chunks as server-sent events.
+
+    The model is loaded when the stream starts, if it is not resident, and kept
+    until the stream ends; errors, including a failed load, surface as an event.
+
+    Args:
+        model: Name of the answering model, None for the default model.
+        answer: Yields the sentence chunks of the answer of the model.
+
+    Yields:
+        str: One SSE event per chunk, then a `done` or `error` event.
+    """
+    texts = []
     try:
-        text = vlm.run_vlm(prompt=req.query, dynamic_prompt="", chart=img, max_new_tokens=max_new_tokens)
+        with registry.use(model) as served:
+            for chunk in answer(served):
+                texts.append(chunk)
+                yield f"data: {json.dumps({'text': chunk})}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps({'detail': f'VLM inference failed: {e}'})}\n\n"
+        return
+    text = " ".join(texts)
+    print(f"Model answered: {text}")
+    yield f"event: done\ndata: {json.dumps({'text': text, 'model': _model_identity(served)})}\n\n"
+
+def _answer_candidates(answer_type: str, answer_options: list[str] | None) -> list[str] | None:
+    """
+    Resolve the allowed answers of a constrained request.
+
+    Args:
+        answer_type: "free", "short", "binary" or "options".
+        answer_options: Allowed answers for answer_type "options".
+
+    Returns:
+        The allowed answers, or None for a generated answer.
+
+    Raises:
+        HTTPException: If answer_type "options" comes without non-empty answer options (400).
+    """
+    if answer_type == "binary":
+        return ["Yes", "No"]
+    if answer_type == "options":
+        options = [option.strip() for option in answer_options or [] if option.strip()]
+        if not options:
+            raise HTTPException(status_code=400, detail="answer_options are required for answer_type 'options'")
+        return options
+    return None
+
+def _stream_answer(served: ServedModel, query: str, img: Image.Image, max_new_tokens: int | None, candidates: list[str] | None, answer_kind: str, cancel: CancelToken) -> Iterator[str]:
+    """
+    Stream the answer of a model in sentence chunks, a fixed answer as a single chunk.
+    """
+    served.vlm.cancellations.bind(cancel)
+    if candidates:
+        yield served.vlm.choose_answer(prompt=query, dynamic_prompt="", chart=img, candidates=candidates, cancel=cancel)
+        return
+    max_new_tokens = served.vlm.budgets.max_new_tokens(answer_kind, max_new_tokens)
+    if served.engine is not None:
+        yield from served.engine.stream(prompt=query, dynamic_prompt="", chart=img, max_new_tokens=max_new_tokens, answer_kind=answer_kind, cancel=cancel)
+    else:
+        # the micro-batcher has no streaming, streams are generated one by one
+        yield from served.vlm.stream_vlm(prompt=query, dynamic_prompt="", chart=img, max_new_tokens=max_new_tokens, answer_kind=answer_kind, cancel=cancel)
+
+def _model_name(model: str | None) -> str | None:
+    """
+    Resolve the model a request names, None for the default model.
+
+    Raises:
+        HTTPException: If the model is neither one of MODELS nor the default model (400).
+    """
+    if model is None or model == registry.default:
+        return model
+    if model not in MODELS:
+        raise HTTPException(status_code=400, detail=f"Unknown model {model!r}, available: {', '.join(MODELS)}")
+    return model
+
+def _require_ready():
+    """
+    Refuse requests until the model is loaded and warmed up.
+
+    Raises:
+        HTTPException: If the service is still starting or its startup failed (503).
+    """
+    if not startup.ready:
+        raise HTTPException(status_code=503, detail=f"VLM startup failed: {startup.error}" if startup.error else "VLM is starting")
+
+def _require_admin(authorization: str | None):
+    """
+    Check the bearer token of an admin request against ADMIN_TOKEN.
+
+    Raises:
+        HTTPException: If the token is missing or wrong (401) or ADMIN_TOKEN is not set (403).
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+def _cancel_token(request: Request) -> CancelToken:
+    """
+    Create the cancel token of a request with the timeout the client sent, or `REQUEST_TIMEOUT_S`.
+
+    The token is bound to the counters of the model answering the request once
+    the registry hands it out, which may be another model than the default one.
+    """
+    try:
+        timeout = float(request.headers.get("x-request-timeout") or REQUEST_TIMEOUT_S)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid X-Request-Timeout header")
+    return CancelToken(timeout=timeout)
+
+async def _run_cancellable(request: Request, cancel: CancelToken, run: Callable[[], dict]) -> dict:
+    """
+    Run a blocking generation in the thread pool and cancel it when the client disconnects.
+
+    Args:
+        request: Incoming request, checked for a disconnect every `DISCONNECT_POLL_S` seconds.
+        cancel: Cancel flag of the request, passed to the generation.
+        run: The generation.
+
+    Returns:
+        The response of the generation.
+    """
+    return await _until_done(request, cancel, asyncio.ensure_future(run_in_threadpool(run)))
+
+async def _until_done(request: Request, cancel: CancelToken, task: asyncio.Future):
+    """
+    Wait for work on a request, cancelling the request once its client disconnects.
+
+    The work itself notices the cancellation and ends early, so it is still awaited.
+    """
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_S)
+            if not task.done() and not cancel.cancelled and await request.is_disconnected():
+                cancel.cancel("disconnect")
+    except asyncio.CancelledError:
+        cancel.cancel("disconnect")
+        raise
+    return task.result()
+
+def _run_generation(model: str | None, query: str, img: Image.Image, max_new_tokens: int | None, candidates: list[str] | None = None, answer_kind: str = "free", cancel: CancelToken | None = None) -> dict:
+    """
+    Run a VLM on a decoded image and wrap the answer for the response.
+
+    A model that is not resident is loaded first, evicting idle models beyond
+    MODEL_MEMORY_MB. The request is queued at the scheduler of the model and
+    shares forward passes with concurrent requests, or runs on its own without
+    a scheduler. Generation
+    stops at the end of the answer or at the token budget of its kind. Requests
+    with allowed answers skip generation and score the candidates in one pass.
+    A cancelled request stops at its next decode step, or is dropped while it
+    still waits for the model.
+
+    Args:
+        model: Name of the answering model, None for the default model.
+        query: Natural-language prompt/question to ask the model about the image.
+        img: Decoded chart image.
+        max_new_tokens: Optional maximum number of tokens to generate. If None, the budget of the answer kind is used.
+        candidates: Allowed answers of a constrained request, None to generate freely.
+        answer_kind: "free" or "short", selecting the token budget and where generation stops.
+        cancel: Cancel flag of the request, None if it cannot be cancelled.
+
+    Returns:
+        A JSON object containing the generated text under the "text" key and the
+        name of the answering model under the "model" key.
+
+    Raises:
+        HTTPException: If the client disconnected (499), the request timed out (504) or loading the model
+            or model inference fails (500).
+    """
+    try:
+        with registry.use(model) as served:
+            if cancel is not None:
+                served.vlm.cancellations.bind(cancel)
+            max_new_tokens = served.vlm.budgets.max_new_tokens(answer_kind, max_new_tokens)
+            if candidates:
+                text = served.vlm.choose_answer(prompt=query, dynamic_prompt="", chart=img, candidates=candidates, cancel=cancel)
+            elif served.engine is not None:
+                text = served.engine.generate(prompt=query, dynamic_prompt="", chart=img, max_new_tokens=max_new_tokens, answer_kind=answer_kind, cancel=cancel)
+            elif served.batcher is not None:
+                text = served.batcher.submit(prompt=query, dynamic_prompt="", chart=img, max_new_tokens=max_new_tokens, answer_kind=answer_kind, cancel=cancel)
+            else:
+                text = served.vlm.run_vlm(prompt=query, dynamic_prompt="", chart=img, max_new_tokens=max_new_tokens, answer_kind=answer_kind, cancel=cancel)
         print(f"Model answered: {text}")
-        return {"text": text}
+        return {"text": text, "model": _model_identity(served)}
+    except Cancelled as e:
+        raise HTTPException(status_code=504 if e.reason == "timeout" else 499, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"VLM inference failed: {e}")
 
 
+def _model_identity(served: ServedModel) -> str:
+    """
+    Name of a served model, with its precision if the weights are reduced to bf16 or int8.
+    """
+    if served.vlm.precision in ("bf16", "int8"):
+        return f"{served.name}@{served.vlm.precision}"
+    return served.name
+
+@app.get("/vlm/model")
+async def model_identity():
+    """
+    Report the identity of the default model.
+
+    The gateway uses it to key cached answers, so answers of one model are never
+    served for another, nor answers of a reduced precision for full precision.
+    It changes with a hot swap of the default model.
+
+    Returns:
+        A JSON object with the model name under the "model" key.
+
+    Raises:
+        HTTPException: If the service is not ready (503), the precision is only known once the model is loaded.
+    """
+    _require_ready()
+    return {"model": _model_identity(registry.get())}
+
+@app.get("/vlm/metrics")
+async def metrics():
+    """
+    Runtime statistics of the VLM service.
+
+    Returns:
+        A JSON object with the active scheduler under "scheduler", its
+        counters under "batching", the prefix cache hit rate and saved
+        prefill tokens under "prefix_cache", the vision embedding cache
+        counters under "vision_cache", the acceptance rate and tokens/s of
+        speculative decoding under "speculative" (null without a draft model),
+        the decode latency of compiled decoding under "compiled" (null unless
+        COMPILE is set), the generated tokens versus budget per answer kind
+        under "answer_tokens", the weight precision and memory under
+        "precision" and "model_bytes", the requests cancelled on a client
+        disconnect or timeout with the decoding they saved under "cancelled",
+        the answering worker with the memory of the worker pool under
+        "worker" (null in a single process), the startup phase timings
+        under "startup", the memory budget and on-demand loads and
+        evictions of the models (see `/models`) under "models" and the
+        latest hot swap of the default model under "swap". The other
+        counters are those of the default model. With WORKERS every worker
+        keeps its own counters, so they cover the requests of the answering
+        worker. Until the service is ready only "startup" is reported.
+    """
+    if not startup.ready:
+        return {"startup": startup.stats()}
+    served = registry.get()
+    vlm = served.vlm
+    return {
+        "scheduler": SCHEDULER,
+        "batching": served.stats(),
+        "prefix_cache": vlm.prefix_cache.stats(),
+        "vision_cache": vlm.vision_cache.stats(),
+        "speculative": vlm.speculative.stats() if vlm.speculative is not None else None,
+        "compiled": vlm.compiled.stats() if vlm.compiled is not None else None,
+        "cancelled": vlm.cancellations.stats(),
+        "answer_tokens": vlm.budgets.stats(),
+        "precision": vlm.precision,
+        "model_bytes": vlm.model_bytes(),
+        "worker": pool.stats() if pool is not None else None,
+        "startup": startup.stats(),
+        "models": registry.stats(),
+        "swap": swap.stats(),
+    }
+
+@app.get("/models")
+async def models():
+    """
+    List the models requests may name and the ones resident in memory.
+
+    Models of MODELS load on the first request naming them and are evicted
+    again, least recently used first, when the resident weights would exceed
+    MODEL_MEMORY_MB. With WORKERS every worker loads its own copy, so the list
+    covers the answering worker.
+
+    Returns:
+        A JSON object with the default model under "default", the models
+        requests may name under "available", the memory budget and weight bytes
+        of the resident models under "budget_bytes" and "resident_bytes", and per
+        resident model its bytes, requests in flight and served, load time and
+        idle seconds under "resident", the most recently used first.
+    """
+    stats = registry.stats()
+    return {
+        "default": stats["default"],
+        "available": list(dict.fromkeys([stats["default"], *MODELS])),
+        "budget_bytes": stats["budget_bytes"],
+        "resident_bytes": stats["resident_bytes"],
+        "resident": registry.resident(),
+    }
+
+@app.post("/admin/swap", status_code=202)
+async def swap_default_model(req: SwapRequest, authorization: str | None = Header(None)):
+    """
+    Hot swap the default model without downtime.
+
+    The new model is loaded in the background while the current one keeps
+    serving. Once it is warmed up, new requests go to it, while the requests in
+    flight finish on the current model, which is freed after the last of them.
+    With WORKERS the supervisor loads the new model and replaces all workers (see
+    `WorkerPool`). Both models are in memory during the swap. `/ready` stays
+    ready throughout and reports the progress under "swap". Needs ADMIN_TOKEN as
+    bearer token.
+
+    Args:
+        req: Request payload with the new model and its precision.
+        authorization: Authorization header with the admin token.
+
+    Returns:
+        A JSON object with the status of the swap, see `SwapStatus`.
+
+    Raises:
+        HTTPException: If the precision is unknown (400), the admin token is wrong (401),
+            swaps are disabled without ADMIN_TOKEN (403), a swap is running (409) or the service is not ready (503).
+    """
+    _require_admin(authorization)
+    _require_ready()
+    if req.precision is not None and req.precision not in PRECISIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown precision {req.precision!r}, expected one of {', '.join(PRECISIONS)}")
+    name = req.model or registry.default
+    precision = req.precision or PRECISION
+    if not swap.begin(name, precision, _model_identity(registry.get())):
+        raise HTTPException(status_code=409, detail=f"A model swap is running: {swap.stats()}")
+    if pool is not None:
+        pool.request_swap({"model": name, "precision": precision})
+    else:
+        threading.Thread(target=swap_model, args=(name, precision), name="swap", daemon=True).start()
+    return swap.stats()
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness check endpoint.
+
+    The service is ready once the model is loaded and the warmup request went
+    through; route requests to it only then. It stays ready during a hot swap
+    of the default model, whose progress it reports.
+
+    Returns:
+        A JSON object with the seconds the startup took and the status of the
+        latest model swap under "swap".
+
+    Raises:
+        HTTPException: If the service is still starting or its startup failed (503).
+    """
+    _require_ready()
+    return {"ready": True, "seconds": startup.stats()["ready_seconds"], "swap": swap.stats()}
+
 @app.get("/health", status_code=200)
-def health():
+async def health():
     """
     Health check endpoint.
 
+    The service is alive while it starts, see `/ready` for whether it takes
+    requests. It runs on the event loop, so it answers even while a small thread
+    pool (THREADPOOL_SIZE) is busy with generations.
+
     Returns:
         A JSON object indicating service health.
+
+    Raises:
+        HTTPException: If the startup failed (503).
     """
-    return {"health": "Ok"} 
\ No newline at end of file
+    if startup.error:
+        raise HTTPException(status_code=503, detail=f"VLM startup failed: {startup.error}")
+    return {"health": "Ok"}
+
+if __name__ == "__main__":
+    if WORKERS > 1:
+        pool = WorkerPool(app, WORKERS, THREADS_PER_WORKER, INTEROP_THREADS, CPU_AFFINITY, host="0.0.0.0", port=PORT, proxy_headers=True)
+        pool.preload(load_default_model)
+        pool.run(load_default_model, swap)
+    else:
+        threads = THREADS_PER_WORKER or torch.get_num_threads()
+        configure_process(THREADS_PER_WORKER, INTEROP_THREADS, worker_cpus(0, threads, CPU_AFFINITY))
+        uvicorn.run(app, host="0.0.0.0", port=PORT, proxy_headers=True)
@@ -0,0 +1,158 @@
+"""
+Thread, worker and cpu affinity tuner of the VLM service.
+
+Loads the model once and, for every configuration of the grid, forks the workers
+the service would fork (see `WorkerPool`), each with its intra-op and inter-op
+threads and optionally pinned to its own cpus. The workers answer a fixed burst of
+chart questions with `run_vlm`, every worker with as many concurrent requests as
+its thread pool has threads. Per configuration the median and 95th percentile
+request latency and the requests per second are measured.
+
+The best configuration for each of p50, p95 and throughput is written to the
+tuning file, which the service reads at startup (TUNING_FILE, with TUNING_OBJECTIVE
+selecting which of the three it uses). Settings given as environment variables
+still take precedence over the tuned ones.
+
+By default the grid covers 1, 2, 4 and 8 workers (up to the number of cpus), the
+cpus split evenly among the workers or half of that, thread pools of 1 and 4 and
+both affinities, so the default of torch, all cores for every request, is compared
+with configurations that do not oversubscribe the cores.
+
+Usage:
+    python -m vlm.tune --model OpenGVLab/InternVL3_5-8B-HF [--output /models/tuning.json] \
+        [--workers 1 2 4] [--threads 4 8] [--interop-threads 1] [--threadpool 1 4] \
+        [--affinity none cores] [--requests 16] [--max-new-tokens 32] [--precision bf16]
+"""
+import argparse, itertools, multiprocessing, os, queue, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
+
+from vlm.app.model import VisualLanguageModelForCharts
+from vlm.app.tuning import save_tuning
+from vlm.app.workers import AFFINITIES, WorkerPool, configure_process, worker_cpus
+
+QUERIES = [
+    "What is the trend of the chart?",
+    "Which bar is the highest?",
+    "Is the last value larger than the first one?",
+    "How many bars are there?",
+]
+
+def make_chart(index: int) -> Image.Image:
+    img = Image.new("RGB", (800, 600), "white")
+    draw = ImageDraw.Draw(img)
+    for bar in range(6):
+        height = 80 + ((bar * 37 + index * 53) % 400)
+        draw.rectangle([80 + bar * 110, 540 - height, 160 + bar * 110, 540], fill=(40 + bar * 30, 90, 200))
+    draw.line([60, 540, 760, 540], fill="black", width=3)
+    return img
+
+def grid(args: argparse.Namespace, cpus: int) -> list[dict]:
+    settings = []
+    for workers in args.workers or [w for w in (1, 2, 4, 8) if w <= cpus]:
+        threads = args.threads or sorted({max(1, cpus // workers), max(1, cpus // (2 * workers))}, reverse=True)
+        for t, interop, pool, affinity in itertools.product(threads, args.interop_threads, args.threadpool, args.affinity):
+            settings.append({"WORKERS": workers, "THREADS_PER_WORKER": t, "INTEROP_THREADS": interop, "THREADPOOL_SIZE": pool, "CPU_AFFINITY": affinity})
+    return settings
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+def worker(vlm: VisualLanguageModelForCharts, index: int, setting: dict, requests: list[tuple[str, Image.Image]], max_new_tokens: int, ready, results):
+    try:
+        threads = setting["THREADS_PER_WORKER"]
+        configure_process(threads, setting["INTEROP_THREADS"], worker_cpus(index, threads, setting["CPU_AFFINITY"]))
+        # the first request of a process pays for one-time allocations
+        vlm.run_vlm(QUERIES[0], "", make_chart(-1 - index), max_new_tokens)
+        ready.wait()
+
+        def one(request: tuple[str, Image.Image]) -> float:
+            start = time.perf_counter()
+            vlm.run_vlm(request[0], "", request[1], max_new_tokens)
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(setting["THREADPOOL_SIZE"]) as pool:
+            results.put(list(pool.map(one, requests)))
+    except Exception as e:
+        results.put(repr(e))
+
+def measure(vlm: VisualLanguageModelForCharts, setting: dict, requests: list[tuple[str, Image.Image]], max_new_tokens: int, timeout: float) -> dict:
+    context = multiprocessing.get_context("fork")
+    workers = setting["WORKERS"]
+    ready = context.Barrier(workers + 1, timeout=timeout)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(vlm, index, setting, requests[index::workers], max_new_tokens, ready, results), daemon=True)
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        ready.wait()
+        start = time.perf_counter()
+        latencies = []
+        for _ in processes:
+            result = results.get(timeout=timeout)
+            if isinstance(result, str):
+                return {**setting, "error": result}
+            latencies.extend(result)
+        elapsed = time.perf_counter() - start
+    except (threading.BrokenBarrierError, queue.Empty):
+        return {**setting, "error": f"no answer within {timeout:.0f} s"}
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+    return {
+        **setting,
+        "p50_ms": round(1000 * percentile(latencies, 50), 1),
+        "p95_ms": round(1000 * percentile(latencies, 95), 1),
+        "requests_per_second": round(len(latencies) / elapsed, 3),
+    }
+
+def main(args: argparse.Namespace):
+    vlm = VisualLanguageModelForCharts()
+    # loaded once and shared copy-on-write with the forked workers, as in the service
+    WorkerPool.preload(lambda: vlm.load_model(args.model, args.force_cpu, vision_cache_dir=None, precision=args.precision))
+    cpus = len(os.sched_getaffinity(0))
+    requests = [(QUERIES[i % len(QUERIES)], make_chart(i)) for i in range(args.requests)]
+
+    results = []
+    print(f"{'workers':>7} | {'threads':>7} | {'interop':>7} | {'pool':>4} | {'affinity':>8} | {'p50 ms':>8} | {'p95 ms':>8} | {'req/s':>7}")
+    for setting in grid(args, cpus):
+        result = measure(vlm, setting, requests, args.max_new_tokens, args.timeout)
+        results.append(result)
+        row = f"{setting['WORKERS']:>7} | {setting['THREADS_PER_WORKER']:>7} | {setting['INTEROP_THREADS']:>7} | {setting['THREADPOOL_SIZE']:>4} | {setting['CPU_AFFINITY']:>8}"
+        if "error" in result:
+            print(f"{row} | failed: {result['error']}")
+        else:
+            print(f"{row} | {result['p50_ms']:>8.1f} | {result['p95_ms']:>8.1f} | {result['requests_per_second']:>7.3f}")
+
+    tuning = save_tuning(
+        args.output,
+        results,
+        model=args.model,
+        precision=vlm.precision,
+        cpus=cpus,
+        workload={"requests": args.requests, "max_new_tokens": args.max_new_tokens, "queries": QUERIES},
+    )
+    for objective, settings in tuning["best"].items():
+        print(f"best for {objective}: {settings}")
+    print(f"written to {args.output}, used by the service with TUNING_FILE={args.output} and TUNING_OBJECTIVE=p50|p95|throughput")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_NAME", "OpenGVLab/InternVL3_5-8B-HF"))
+    parser.add_argument("--force-cpu", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--precision", default=os.getenv("PRECISION") or None)
+    parser.add_argument("--output", default=os.getenv("TUNING_FILE") or "tuning.json")
+    parser.add_argument("--workers", type=int, nargs="+")
+    parser.add_argument("--threads", type=int, nargs="+")
+    parser.add_argument("--interop-threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--threadpool", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--affinity", nargs="+", choices=AFFINITIES, default=list(AFFINITIES))
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--timeout", type=float, default=1800)
+    main(parser.parse_args())